@@ -1,7 +1,8 @@
 import csv
 import auth
 import pandas as pd
-import get_toxicity
+from get_toxicity import ScoringEngine, make_scorer, SCORERS
+from scored_index import ScoredIndex
 import argparse
 import logging
 import os.path
@@ -13,12 +14,11 @@ import os.path
 
 #%%
 
-def filter_comments(comments_df, augmented_df, only_consented = False):
+def filter_comments(comments_df, index, only_consented = False):
     logging.info(f"Started with {len(comments_df)} comments")
-    if augmented_df is not None:
-        # Get the comments which aren't already in the augmented dataset
-        # Don't get toxicity for comments if the created_utc + author is already in the augmented file
-        comments_df = comments_df[~(comments_df.created_utc.astype(str) + comments_df.author_id).isin((augmented_df.created_utc.astype(str) + augmented_df.author_id))]
+    # Get the comments which aren't already in the augmented dataset
+    # Don't get toxicity for comments if the created_utc + author is already in the augmented file
+    comments_df = comments_df[~index.is_scored(comments_df)]
     if only_consented:
         logging.warning("Not yet implemented")
         #consented_users = convo_data.loc[convo_data.consented == True, 'user_id']
@@ -28,7 +28,7 @@ def filter_comments(comments_df, augmented_df, only_consented = False):
     comments_df = comments_df[pd.notna(comments_df.text)]
     return comments_df
 
-def add_toxicity(comments, augmented_file):
+def add_toxicity(comments, augmented_file, engine, index):
     header = ['created_utc', 'text', 'subreddit', 'author_id', 'toxicity_score', 'severe_toxicity_score']
     if not os.path.exists(augmented_file):
         logging.warn(f"Didn't find augmented comments file. Creating new file at {augmented_file}")
@@ -36,8 +36,7 @@ def add_toxicity(comments, augmented_file):
             out_file = csv.writer(f)
             out_file.writerow(header)
 
-    with open(augmented_file, 'a', newline='') as f:
-        out_file = csv.DictWriter(f, fieldnames = header)
+    def well_formed(comments):
         for _, comment in comments.iterrows():
             comment = comment.to_dict()
             # Not sure how these weird carriage returns are getting through, but try removing them here
@@ -47,13 +46,22 @@ def add_toxicity(comments, augmented_file):
             except ValueError:
                 logging.error(f"Malformed input for {comment}")
                 continue
-            tox_scores = get_toxicity.get_toxicity(comment['text'])
+            yield comment
+
+    written = []
+    with open(augmented_file, 'a', newline='') as f:
+        out_file = csv.DictWriter(f, fieldnames = header)
+        # The comments are scored concurrently, and the scores come back in order
+        to_score = list(well_formed(comments))
+        for comment, tox_scores in zip(to_score, engine.score(comment['text'] for comment in to_score)):
             if not tox_scores:
                 continue
             else:
                 comment['toxicity_score'] = tox_scores[0]
                 comment['severe_toxicity_score'] = tox_scores[1]
                 out_file.writerow(comment)
+                written.append(comment)
+    index.add([comment['author_id'] for comment in written], [comment['created_utc'] for comment in written])
 
 #%%
 def main():
@@ -67,6 +75,9 @@ def main():
                      '--loglevel',
                      default='warning',
                      help='Provide logging level. Example --loglevel debug, default=warning' )
+    parser.add_argument('--qps', type=float, default=1, help="Maximum Perspective requests per second (default=1)")
+    parser.add_argument('--scorer', choices=SCORERS, default='perspective', help="Score with the Perspective API or a local model (default=perspective)")
+    parser.add_argument('--model-file', dest='model_file', help="Model for the local scorer (see get_toxicity.LocalScorer)")
     args = parser.parse_args()
     logging.basicConfig( level=args.loglevel.upper() )
     logging.info( 'Logging now setup.' )
@@ -76,18 +87,17 @@ def main():
     try:
         augmented_df = pd.read_feather(args.feather_file)
         augmented_df.to_csv(augmented_file, index=False)
-    except FileNotFoundError or TypeError:
-        try:
-            augmented_df = pd.read_csv(augmented_file, dtype={'created_utc':float})
-        except FileNotFoundError or TypeError:
-            augmented_df = None
+        index = ScoredIndex(augmented_file, 'author_id', augmented_df)
+    except (FileNotFoundError, TypeError):
+        # The index of the comments in the augmented file (so we don't have to read it)
+        index = ScoredIndex(augmented_file, 'author_id')
 
 
     comments_df = pd.read_csv(raw_comments)
 
-    comments_to_augment = filter_comments(comments_df, augmented_df)
+    comments_to_augment = filter_comments(comments_df, index)
 
-    add_toxicity(comments_to_augment, augmented_file)
+    add_toxicity(comments_to_augment, augmented_file, ScoringEngine(make_scorer(args.scorer, args.model_file, qps=args.qps)), index)
 
     if args.feather_file is not None:
         pd.read_csv(augmented_file).to_feather(args.feather_file)
@@ -1,26 +1,34 @@
 import argparse
 import csv
+import sys
 import pandas as pd
-from get_toxicity import get_toxicity
+from get_toxicity import ScoringEngine, make_scorer, SCORERS
+from scored_index import ScoredIndex
 import os.path
 import logging
 
+# The conversations (and their archive) are read the same way as in the chatbot, from code/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from conversation_store import read_all_conversations
+
 
 #%%
 
-def get_convo_toxicity(text):
+def text_to_score(text):
+    '''Returns the text, or None if it's not worth scoring (empty, or the answer to the consent question)'''
+    if not isinstance(text, str):
+        return None
     lowered_text = text.strip().lower()
     if len(text) == 0 or lowered_text == 'yes' or lowered_text == 'no':
-        return (None, None)
-    return get_toxicity(text)
+        return None
+    return text
 
-def filter_conversations(convos_df, augmented_df):
-    if augmented_df is not None:
-        convos_df = convos_df[~(convos_df.created_utc.astype(str) + convos_df.user_id).isin((augmented_df.created_utc.astype(str) + augmented_df.user_id))]
+def filter_conversations(convos_df, index):
+    convos_df = convos_df[~index.is_scored(convos_df)]
     #convos = convos_df[convos_df.message_type != "initial"]
     return convos_df
 
-def add_toxicity(convos, augmented_file):
+def add_toxicity(convos, augmented_file, engine, index):
     header = list(convos.columns) + ['toxicity_score', 'severe_toxicity_score']
     if not os.path.exists(augmented_file):
         logging.warning(f"Creating a header")
@@ -29,14 +37,17 @@ def add_toxicity(convos, augmented_file):
             out.writerow(header)
     with open(augmented_file, 'a') as f:
         out_file = csv.DictWriter(f, fieldnames = header)
-        for _, row in convos.iterrows():
-            tox_scores = get_convo_toxicity(row['text'])
+        # The texts are scored concurrently, and the scores come back in order. Skipped texts get (None, None).
+        rows = (row for _, row in convos.iterrows())
+        texts = (text_to_score(text) for text in convos.text)
+        for row, tox_scores in zip(rows, engine.score(texts)):
             if not tox_scores:
                 continue
             else:
                 row['toxicity_score'] = tox_scores[0]
                 row['severe_toxicity_score'] = tox_scores[1]
                 out_file.writerow(row.to_dict())
+    index.add(convos.user_id, convos.created_utc)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -48,20 +59,22 @@ def main():
                      '--loglevel',
                      default='warning',
                      help='Provide logging level. Example --loglevel debug, default=warning' )
+    parser.add_argument('--qps', type=float, default=1, help="Maximum Perspective requests per second (default=1)")
+    parser.add_argument('--scorer', choices=SCORERS, default='perspective', help="Score with the Perspective API or a local model (default=perspective)")
+    parser.add_argument('--model-file', dest='model_file', help="Model for the local scorer (see get_toxicity.LocalScorer)")
     args = parser.parse_args()
     logging.basicConfig( level=args.loglevel.upper() )
     logging.info( 'Logging now setup.' )
 
-    raw_conversation = pd.read_csv(args.in_f)
+    raw_conversation = read_all_conversations(args.in_f)
     augmented_file = args.out_f
-    try:
-        augmented_df = pd.read_csv(augmented_file)
-    except FileNotFoundError:
+    if not os.path.exists(augmented_file):
         logging.warning(f"Didn't find {augmented_file}")
-        augmented_df = None
-    filtered_convos = filter_conversations(raw_conversation, augmented_df)
+    # The index of the messages in the augmented file (so we don't have to read it)
+    index = ScoredIndex(augmented_file, 'user_id')
+    filtered_convos = filter_conversations(raw_conversation, index)
     logging.info(f"Getting toxicity for {len(filtered_convos)} texts")
-    add_toxicity(filtered_convos, augmented_file)
+    add_toxicity(filtered_convos, augmented_file, ScoringEngine(make_scorer(args.scorer, args.model_file, qps=args.qps)), index)
 
 if __name__ == '__main__':
     main()
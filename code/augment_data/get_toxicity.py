@@ -1,39 +1,246 @@
-from perspective import PerspectiveAPI
-import auth
+import os
 import time
+import random
 import logging
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from score_cache import ScoreCache, DEFAULT_CACHE_FILE
+
+######
+# Scores texts for toxicity. ScoringEngine.score() takes an iterable of texts and yields (toxicity, severe_toxicity)
+# tuples in the same order. It reads the texts in batches, looks each one up in the score cache (see
+# score_cache.py), and sends the rest to a scorer. There are two scorers:
+#
+# PerspectiveScorer - the Perspective API. The texts in a batch are scored concurrently, with up to max_workers
+#     requests in flight over keep-alive connections, and at most qps requests started per second (Perspective's
+#     quota is per second). When Perspective says we're going too fast (429) or has an error, it halves its rate
+#     and retries the text after a jittered backoff, and then speeds back up as requests succeed.
+# LocalScorer - a model on the CPU, which scores each batch at once. See LocalScorer for the model file format.
+#
+# Texts that can't be scored (e.g., a language that Perspective doesn't support) get (None, None), and an attribute
+# that Perspective didn't return gets None. A text that fails never fails the rest of its batch.
+######
+
+ANALYZE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+TESTS = ['TOXICITY', 'SEVERE_TOXICITY']
+SCORERS = ['perspective', 'local']
 
-p = PerspectiveAPI(auth.perspective_api_key)
 remove_pattern = re.compile(r'^>.*\n', re.MULTILINE)
 
-def get_toxicity(s, tests = ['TOXICITY', 'SEVERE_TOXICITY'], remove_quoted = True):
-    if remove_quoted:
+
+def remove_quotes(s):
+    '''Strips out quoted text (lines starting with >)'''
+    new = remove_pattern.sub('', s)
+    if new != s:
+        logging.info(f"Removed quotation from \n{s}. \n Now equal to \n{new}.")
+    return new
+
+
+class PerspectiveScorer:
+
+    # Perspective's scores are cached under the plain text (without a scorer name)
+    name = None
+
+    def __init__(self, api_key=None, qps=1, max_workers=8, max_attempts=10, tests=TESTS):
+        if api_key is None:
+            import auth
+            api_key = auth.perspective_api_key
+        self.api_key = api_key
+        self.max_qps = qps
+        self.qps = qps
+        self.max_workers = max_workers
+        self.batch_size = 4 * max_workers
+        self.max_attempts = max_attempts
+        self.tests = tests
+        # One connection per worker, kept open between requests
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.next_request = 0
+
+    def wait_turn(self):
+        '''Waits until the next request can start under the current rate'''
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_request)
+            self.next_request = slot + 1 / self.qps
+        if slot > now:
+            time.sleep(slot - now)
+
+    def slow_down(self):
+        with self.lock:
+            self.qps = max(self.max_qps / 32, self.qps / 2)
+            logging.info(f"Slowing down to {self.qps:.2f} requests per second")
+
+    def speed_up(self):
+        with self.lock:
+            self.qps = min(self.max_qps, self.qps + self.max_qps / 20)
+
+    def request(self, text):
+        self.wait_turn()
+        return self.session.post(ANALYZE_URL,
+                                 params={'key': self.api_key},
+                                 json={'comment': {'text': text},
+                                       'requestedAttributes': {test: {} for test in self.tests}},
+                                 timeout=30)
+
+    def score_text(self, text):
+        '''Gets the scores for a text from Perspective, retrying when it's overloaded. Called from the worker threads.'''
+        for attempts in range(self.max_attempts):
+            try:
+                response = self.request(text)
+                status = response.status_code
+            except requests.RequestException as e:
+                logging.warning(f"Request failed: {e}")
+                status = None
+            if status == 200:
+                self.speed_up()
+                return self.read_scores(text, response)
+            if status is not None and status != 429 and status < 500:
+                # E.g., 400 for text in a language that Perspective doesn't support
+                logging.info(f"Perspective returned {status} for {text}: {response.text}")
+                return (None,) * len(self.tests)
+            self.slow_down()
+            backoff = min(60, 2 ** attempts) * random.uniform(0.5, 1.5)
+            logging.info(f"Perspective returned {status}. Trying again in {backoff:.1f} seconds (attempt {attempts + 1})")
+            time.sleep(backoff)
+        logging.error(f"Giving up on {text}")
+        return (None,) * len(self.tests)
+
+    def read_scores(self, text, response):
+        '''
+        Returns the scores in a successful response. Perspective leaves out the attributes it can't score (e.g.,
+        SEVERE_TOXICITY in some languages), and those get None. A response we can't read gets None for everything.
+        '''
         try:
-            new = remove_pattern.sub('', s)
-        except TypeError:
-            raise TypeError(f"{s} threw a TypeError")
-        if new != s:
-            logging.info(f"Removed quotation from \n{s}. \n Now equal to \n{new}.")
-        s = new
-    attempts = 0
-    while True:
+            scores = response.json()['attributeScores']
+            text_scores = tuple(scores[test]['summaryScore']['value'] if test in scores else None for test in self.tests)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Couldn't read Perspective's scores for {text}: {e!r}")
+            return (None,) * len(self.tests)
+        if None in text_scores:
+            logging.info(f"Perspective didn't return {[test for test in self.tests if test not in scores]} for {text}")
+        return text_scores
+
+    def score_batch(self, texts):
+        futures = [self.executor.submit(self.score_text, text) for text in texts]
+        scores = []
+        for text, future in zip(texts, futures):
+            try:
+                scores.append(future.result())
+            except Exception as e:
+                # Anything unexpected only loses this text's scores; the rest of the batch is still cached
+                logging.error(f"Couldn't score {text}: {e!r}")
+                scores.append((None,) * len(self.tests))
+        return scores
+
+
+class LocalScorer:
+    '''
+    Scores texts with a model loaded from model_file with joblib: a dictionary from each attribute (e.g.,
+    'TOXICITY') to a fitted model that takes a list of raw texts, such as a scikit-learn pipeline of a vectorizer
+    and a classifier or regressor. Classifiers give the probability of the positive class; the predictions of
+    regressors are clipped to [0, 1].
+    '''
+
+    def __init__(self, model_file, tests=TESTS, batch_size=1000):
+        # joblib is only needed for this scorer
+        import joblib
+        models = joblib.load(model_file)
+        missing = [test for test in tests if test not in models]
+        if missing:
+            raise ValueError(f"{model_file} doesn't have models for {missing}")
+        self.models = [models[test] for test in tests]
+        self.tests = tests
+        self.batch_size = batch_size
+        # Keeps its scores apart from Perspective's (and other models') in the cache
+        self.name = 'local:' + os.path.basename(model_file)
+
+    def predict(self, model, texts):
+        if hasattr(model, 'predict_proba'):
+            return model.predict_proba(texts)[:, 1]
+        return model.predict(texts).clip(0, 1)
+
+    def score_batch(self, texts):
+        scores = [self.predict(model, texts).tolist() for model in self.models]
+        return list(zip(*scores))
+
+
+def make_scorer(scorer='perspective', model_file=None, qps=1, api_key=None):
+    '''Makes one of the SCORERS'''
+    if scorer == 'perspective':
+        return PerspectiveScorer(api_key=api_key, qps=qps)
+    if scorer == 'local':
+        if model_file is None:
+            raise ValueError("The local scorer needs a model file")
+        return LocalScorer(model_file)
+    raise ValueError(f"Unknown scorer {scorer}; expected one of {SCORERS}")
+
+
+class ScoringEngine:
+
+    def __init__(self, scorer=None, cache_file=DEFAULT_CACHE_FILE):
+        self.scorer = scorer if scorer is not None else PerspectiveScorer()
+        # Pass cache_file=None to always use the scorer
+        self.cache = ScoreCache(cache_file) if cache_file is not None else None
+
+    @property
+    def tests(self):
+        return self.scorer.tests
+
+    def prepare(self, text, remove_quoted):
+        '''Returns the text that we send to the scorer, or None if it can't be scored'''
+        if text is None:
+            return None
+        if not isinstance(text, str):
+            logging.warning(f"Can't score {text}")
+            return None
+        return remove_quotes(text) if remove_quoted else text
+
+    def score_one(self, text, remove_quoted=True):
+        '''Returns the (toxicity, severe_toxicity) scores for a text. None (a text that the caller skipped) gets (None, None).'''
+        return self.score_batch([self.prepare(text, remove_quoted)])[0]
+
+    def score_batch(self, texts):
+        '''Scores a batch of prepared texts, using the cache for the ones that have been scored before'''
+        scores = {None: (None, None)}
+        if self.cache is not None:
+            scores.update(self.cache.get_many([text for text in texts if text is not None], self.tests, self.scorer.name))
+        # The same text (e.g., a message template) is only scored once
+        to_score = list(dict.fromkeys(text for text in texts if text not in scores))
+        if to_score:
+            new_scores = dict(zip(to_score, self.scorer.score_batch(to_score)))
+            scores.update(new_scores)
+            if self.cache is not None:
+                self.cache.put_many(new_scores, self.tests, self.scorer.name)
+        return [scores[text] for text in texts]
+
+    def score(self, texts, remove_quoted=True):
+        '''Scores the texts in batches, yielding their scores in order. Only one batch is read ahead.'''
+        batch = []
         try:
-            toxicity  = p.score(s, tests=tests)
-            return (toxicity['TOXICITY'], toxicity['SEVERE_TOXICITY'])
-        except TypeError as e:
-            print(f"TypeError for {s}")
-            return (None, None)
-        except Exception as e:
-            if e.code == 400:
-                return (None, None)
-            else:
-                print(f'Pausing for a bit (attempt {attempts})')
-                print(f'Error: {e}')
-                time.sleep(10 * attempts)
-                if attempts < 10:
-                    attempts += 1
-                    continue
-                else:
-                    print(f"Giving up on {s}")
-                    return (None, None)
\ No newline at end of file
+            for text in texts:
+                batch.append(self.prepare(text, remove_quoted))
+                if len(batch) >= self.scorer.batch_size:
+                    yield from self.score_batch(batch)
+                    batch = []
+            if batch:
+                yield from self.score_batch(batch)
+        finally:
+            if self.cache is not None:
+                self.cache.log_stats()
+
+
+_engine = None
+
+
+def get_toxicity(s, tests = TESTS, remove_quoted = True):
+    '''Scores a single text with Perspective. To score many texts, use ScoringEngine.score(), which runs them in batches.'''
+    global _engine
+    if _engine is None or _engine.tests != tests:
+        _engine = ScoringEngine(PerspectiveScorer(tests=tests))
+    return _engine.score_one(s, remove_quoted=remove_quoted)
@@ -1,9 +1,14 @@
 #%%
 import csv
-from perspective import PerspectiveAPI
-import auth
 import pandas as pd
-import time
+import os
+import sys
+from get_toxicity import ScoringEngine
+from scored_index import ScoredIndex
+
+# The conversations (and their archive) are read the same way as in the chatbot, from code/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from conversation_store import read_all_conversations
 
 ######
 # This code takes the comments made by users, adds the subreddit that we contacted them from, and
@@ -14,40 +19,18 @@ augmented_file = '../data/participant_data/augmented_comments.csv'
 participant_comments_file = '../data/participant_comments.csv'
 participants_file = '../data/participants.csv'
 conversations_file = '../data/conversations.csv'
-p = PerspectiveAPI(auth.perspective_api_key)
+engine = ScoringEngine()
 #%%
 
-def get_toxicity(s, tests = ['TOXICITY', 'SEVERE_TOXICITY']):
-    attempts = 0
-    while True:
-        try:
-            toxicity  = p.score(s, tests=tests)
-            return (toxicity['TOXICITY'], toxicity['SEVERE_TOXICITY'])
-        except TypeError as e:
-            print(f"TypeError for {s}")
-            return (None, None)
-        except Exception as e:
-            if e.code == 400:
-                return (None, None)
-            else:
-                print('Pausing for a bit')
-                time.sleep(10)
-                if attempts < 10:
-                    attempts += 1
-                    continue
-                else:
-                    print(f"Giving up on {s}")
-                    return (None, None)
-
-def get_convo_toxicity(g):
+def get_convo_text(g):
+    '''The user's messages, or None if they're not worth scoring (nothing, or just the answer to the consent question)'''
     text = g.loc[g.message_type == 'user', 'text'].str.cat(sep = ' ')
     lowered_text = text.strip().lower()
     if len(text) == 0 or lowered_text == 'yes' or lowered_text == 'no':
-        return (None, None)
-    return get_toxicity(text)
+        return None
+    return text
 
-def get_group_stats(g):
-    toxicity, severe_toxicity = get_convo_toxicity(g)
+def get_group_stats(g, toxicity, severe_toxicity):
     return pd.Series({
     'consented': 'handoff' in g.message_type.unique(),
     'messages_sent': sum(g.message_type == 'user'),
@@ -60,8 +43,12 @@ def get_group_stats(g):
 
 #%%
 # Get conversation data about participants - whether consented, and how many messages they sent
-convos = pd.read_csv(conversations_file)
-convo_data = convos.groupby('user_id').apply(get_group_stats).reset_index()
+convos = read_all_conversations(conversations_file)
+groups = list(convos.groupby('user_id'))
+# Score all of the conversations concurrently (this script never stripped quoted text, so it still doesn't)
+convo_scores = engine.score((get_convo_text(g) for _, g in groups), remove_quoted=False)
+convo_data = pd.DataFrame([get_group_stats(g, *scores) for (_, g), scores in zip(groups, convo_scores)],
+                          index=pd.Index([user_id for user_id, _ in groups], name='user_id')).reset_index()
 
 print(convo_data.head())
 #%%
@@ -77,17 +64,16 @@ with open(participants_file, 'r') as f:
     for line in participant_file:
         subreddits_dict[line['author_id']] = line['subreddit']
 
-try:
-    augmented_df = pd.read_csv(augmented_file)
-except FileNotFoundError:
-    augmented_df = None
+augmented_exists = os.path.exists(augmented_file)
+# The index of the comments in the augmented file (so we don't have to read it)
+index = ScoredIndex(augmented_file, 'author_id')
 
 comments_df = pd.read_csv(participant_comments_file)
 
-if augmented_df is not None:
+if augmented_exists:
     # Get the comments which aren't already in the augmented dataset
     print(f"Started with {len(comments_df)} comments")
-    comments = comments_df[~(comments_df.text + comments_df.created_utc.astype(str) + comments_df.author_id).isin((augmented_df.text + augmented_df.created_utc.astype(str) + augmented_df.author_id))]
+    comments = comments_df[~index.is_scored(comments_df)]
     # TODO: Remove this filter when we want to get scores for everyone
     consented_users = convo_data.loc[convo_data.consented == True, 'user_id']
     comments = comments[comments.author_id.isin(consented_users)]
@@ -96,18 +82,15 @@ else:
     comments = comments_df
 
 header = ['created_utc', 'text', 'subreddit', 'author_id', 'toxicity_score', 'severe_toxicity_score', 'messaged_subreddit']
-if augmented_df is None:
+if not augmented_exists:
     with open(augmented_file, 'w') as f:
         out_file = csv.writer(f)
         out_file.writerow(header)
 
 with open(augmented_file, 'a') as f:
     out_file = csv.DictWriter(f, fieldnames = header)
-    for _, comment in comments.iterrows():
-
-        # Turning this into a loop so that we try again when we hit a 429 error
-        attempts = 1
-        tox_scores = get_toxicity(comment['text'])
+    rows = (comment for _, comment in comments.iterrows())
+    for comment, tox_scores in zip(rows, engine.score(comments.text, remove_quoted=False)):
         if not tox_scores:
             continue
         else:
@@ -115,6 +98,7 @@ with open(augmented_file, 'a') as f:
             comment['severe_toxicity_score'] = tox_scores[1]
             comment['messaged_subreddit'] = subreddits_dict[comment['author_id']]
             out_file.writerow(comment.to_dict())
+index.add(comments.author_id, comments.created_utc)
 
 ## I forgot to add the conditions, so I'm just doing that at the end.
 
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+
+######
+# A persistent cache of toxicity scores, shared by everything that scores text (the augmentation scripts and
+# get_toxic_moderated_comments.py). Entries are keyed by a hash of the text that was sent to the scorer (i.e.,
+# after quoted text was stripped), the attributes that were requested, and the scorer (for anything other than
+# Perspective), so the same text is only scored once, however many rows or scripts it shows up in.
+#
+# The cache holds at most max_entries scores. When it grows past that, the least recently used ones are evicted.
+# Only successful scores are cached; a text that failed is tried again the next time.
+######
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/score_cache.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scores (
+    key TEXT PRIMARY KEY,
+    scores TEXT,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used);
+'''
+
+
+def cache_key(text, tests, scorer=None):
+    key = [text, sorted(tests)] if scorer is None else [text, sorted(tests), scorer]
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+class ScoreCache:
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, max_entries=1000000):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        # Several scripts can use the cache at once. Each lookup or store is its own short transaction, so no write
+        # lock is held while the scorer is working (which can take minutes when Perspective is backing off).
+        self.db = sqlite3.connect(cache_file, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.size = self.db.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, texts, tests, scorer=None):
+        '''Returns a dictionary from each of the texts that are in the cache to its scores'''
+        found = dict()
+        for text in set(texts):
+            row = self.db.execute('SELECT scores FROM scores WHERE key = ?', (cache_key(text, tests, scorer),)).fetchone()
+            if row is not None:
+                found[text] = tuple(json.loads(row[0]))
+        self.hits += len(found)
+        self.misses += len(set(texts)) - len(found)
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany('UPDATE scores SET last_used = ? WHERE key = ?',
+                                    [(now, cache_key(text, tests, scorer)) for text in found])
+        return found
+
+    def put_many(self, scores, tests, scorer=None):
+        '''Stores a dictionary from texts to their scores. Texts that failed (with a None score) are left out.'''
+        now = time.time()
+        rows = [(cache_key(text, tests, scorer), json.dumps(list(text_scores)), now)
+                for text, text_scores in scores.items() if not any(score is None for score in text_scores)]
+        if not rows:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO scores (key, scores, last_used) VALUES (?, ?, ?)', rows)
+            # rowcount also counts the rows that were replaced, and other scripts add to the cache too
+            self.size = self.db.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+            if self.size > self.max_entries:
+                self.evict()
+
+    def get(self, text, tests, scorer=None):
+        '''Returns the cached scores for the text, or None'''
+        return self.get_many([text], tests, scorer).get(text)
+
+    def put(self, text, tests, scores, scorer=None):
+        self.put_many({text: scores}, tests, scorer)
+
+    def evict(self):
+        '''Deletes the least recently used scores, down to 90% of max_entries (so we don't evict on every store)'''
+        n = self.size - int(self.max_entries * 0.9)
+        self.db.execute('DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)', (n,))
+        self.size = self.db.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        logging.info(f"Evicted {n} scores from the score cache")
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def log_stats(self):
+        logging.info(f"Score cache: {self.hits} hits, {self.misses} misses ({self.hit_rate():.1%} hit rate), {self.size} entries")
+
+    def close(self):
+        self.db.close()
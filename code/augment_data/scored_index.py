@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pandas as pd
+
+######
+# An index of the rows that are already in an augmented (scored) file, so the augmentation scripts can find the new
+# rows without reading the augmented file. Each row is keyed by an int64 hash of its (author or user id,
+# created_utc), and the keys are kept sorted in a sidecar file next to the augmented file (<file>.keys.npy). The
+# sidecar is memory-mapped, and checking which rows are new is a binary search for each of their keys.
+#
+# The sidecar is updated after rows are appended to the augmented file. If the augmented file has changed since
+# (e.g., a run crashed after appending, or the file was replaced), the index is rebuilt from it.
+######
+
+
+def hash_keys(ids, created_utc):
+    '''Returns an int64 key for each (id, created_utc) pair. Timestamps are compared as numbers, whatever their type.'''
+    keyed = pd.DataFrame({'id': pd.Series(ids).astype(str).to_numpy(),
+                          'created_utc': pd.to_numeric(pd.Series(created_utc), errors='coerce').to_numpy(dtype=float)})
+    return pd.util.hash_pandas_object(keyed, index=False).to_numpy().view(np.int64)
+
+
+def index_path(augmented_file):
+    return os.path.splitext(augmented_file)[0] + '.keys.npy'
+
+
+class ScoredIndex:
+
+    def __init__(self, augmented_file, id_column, augmented=None):
+        '''
+        id_column is the column with the author or user id in the augmented file. If the augmented file was just
+        written from a dataframe, pass it as augmented and the index is built from it instead.
+        '''
+        self.augmented_file = augmented_file
+        self.index_file = index_path(augmented_file)
+        self.id_column = id_column
+        if augmented is not None:
+            self.rebuild(augmented)
+        else:
+            self.keys = self.load()
+
+    def is_stale(self):
+        if not os.path.exists(self.index_file):
+            return True
+        # We write the index after appending, so it's only older if something else changed the augmented file
+        return os.path.exists(self.augmented_file) and os.path.getmtime(self.augmented_file) > os.path.getmtime(self.index_file)
+
+    def load(self):
+        if not os.path.exists(self.augmented_file):
+            return np.array([], dtype=np.int64)
+        if self.is_stale():
+            augmented = pd.read_csv(self.augmented_file, usecols=[self.id_column, 'created_utc'])
+            self.rebuild(augmented)
+        return np.load(self.index_file, mmap_mode='r')
+
+    def rebuild(self, augmented):
+        '''Recomputes the index from the rows of the augmented file (a dataframe with the id and created_utc columns)'''
+        self.save(np.unique(hash_keys(augmented[self.id_column], augmented.created_utc)))
+        self.keys = np.load(self.index_file, mmap_mode='r')
+
+    def save(self, keys):
+        tmp_file = self.index_file + '.tmp.npy'
+        np.save(tmp_file, keys)
+        os.replace(tmp_file, self.index_file)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, keys):
+        '''Returns a boolean array; whether each key is in the index'''
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        return np.asarray(self.keys[positions]) == keys
+
+    def is_scored(self, df):
+        '''Whether each row of df (with the id and created_utc columns) is in the augmented file'''
+        return self.contains(hash_keys(df[self.id_column], df.created_utc))
+
+    def add(self, ids, created_utc):
+        '''Adds the keys for rows that were just appended to the augmented file'''
+        new_keys = hash_keys(ids, created_utc)
+        if len(new_keys) == 0 and os.path.exists(self.index_file):
+            return
+        self.save(np.union1d(np.asarray(self.keys), new_keys))
+        self.keys = np.load(self.index_file, mmap_mode='r')
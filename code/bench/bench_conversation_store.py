@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from conversation_store import ConversationStore
+from synthetic import make_messages
+
+######
+# Times ConversationStore.append (what Run.write_conversations does for every message we send or receive)
+# against conversation logs of increasing size. The cost of a write should stay flat as the log grows. It also times
+# opening the store: the first time (when the whole log is hashed into the index) and again once the index is saved
+# (when only the rows appended since then are read), which should also stay flat.
+#
+# For comparison, it also times the way write_conversations used to work: merging the new messages against the
+# whole conversations table to find the ones that weren't stored, and then concatenating them onto it.
+#
+# Usage (from code/):
+#     python bench/bench_conversation_store.py --sizes 1000 100000 400000 --writes 50
+######
+
+
+def merge_append(conversations, messages, conversations_file):
+    '''The old write_conversations'''
+    new_messages = pd.DataFrame(messages)
+    result = new_messages.merge(conversations, on=list(new_messages.columns), how='left', indicator=True)
+    new_messages = result[result['_merge'] == 'left_only'].drop(columns=['_merge'])
+    conversations = pd.concat([conversations, new_messages])
+    new_messages.to_csv(conversations_file, mode='a', header=False, index=False)
+    return conversations
+
+
+def time_writes(write, new_messages):
+    '''Writes the messages one at a time, and returns the time each write took, in milliseconds'''
+    times = []
+    for message in new_messages.itertuples(index=False, name=None):
+        start = time.perf_counter()
+        write([message])
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 400000],
+                        help="Sizes of the conversation log to time writes against")
+    parser.add_argument('--writes', type=int, default=50, help="Single-message writes to time at each size")
+    parser.add_argument('--no-baseline', dest='baseline', action='store_false',
+                        help="Don't time the old merge-based writes")
+    args = parser.parse_args()
+
+    print(f"{'messages':>10} {'index (s)':>10} {'reopen (s)':>11} {'store write (ms)':>17} {'merge write (ms)':>17}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conversations_file = os.path.join(tmp_dir, 'conversations.csv')
+            make_messages(size).to_csv(conversations_file, index=False)
+            new_messages = make_messages(args.writes, start=size)
+
+            start = time.perf_counter()
+            ConversationStore(conversations_file)
+            index_time = time.perf_counter() - start
+            store = ConversationStore(conversations_file)
+            store_times = time_writes(store.append, new_messages)
+            assert len(store) == size + args.writes
+            start = time.perf_counter()
+            store = ConversationStore(conversations_file)
+            reopen_time = time.perf_counter() - start
+            assert len(store) == size + args.writes
+
+            merge_ms = ''
+            if args.baseline:
+                conversations = pd.read_csv(conversations_file)
+                def write(messages):
+                    nonlocal conversations
+                    conversations = merge_append(conversations, pd.DataFrame(messages, columns=new_messages.columns),
+                                                 conversations_file)
+                merge_ms = f"{statistics.median(time_writes(write, make_messages(args.writes, start=2 * size))):.2f}"
+        print(f"{size:>10} {index_time:>10.2f} {reopen_time:>11.3f} {statistics.median(store_times):>17.2f} {merge_ms:>17}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from dataclasses import dataclass, fields
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from conversation_store import split_by_user, COLUMNS
+from synthetic import make_messages
+# chatbot reads shared_config.yaml from the working directory and needs auth.py, like when it runs
+import chatbot
+
+######
+# Times loading the chatbot's conversations for a large conversation log and measures how much memory their messages
+# take. The columnar conversations (chatbot.split_conversations, views over shared column arrays) are compared with
+# one slotted Message per row (built from itertuples) and with the way they used to be built: dict-backed
+# dataclasses made from iterrows. It loads the whole log as one conversation, and then split by user, as in
+# continue_convos. Splitting the table is part of the time.
+#
+# Usage (from code/):
+#     python bench/bench_records.py --messages 100000
+######
+
+
+@dataclass
+class DictMessage:
+    '''The old Message, without slots'''
+    user_id: str
+    message_type: str
+    text: str
+    created_utc: float
+    subreddit: str
+    conversation_or_message_id: str
+    is_modmail: bool
+    condition: str
+
+
+def dict_records(df):
+    return [DictMessage(**{field.name: row[field.name] for field in fields(DictMessage)}) for _, row in df.iterrows()]
+
+
+def slotted_records(df):
+    return [chatbot.Message(*row) for row in df[COLUMNS].itertuples(index=False, name=None)]
+
+
+def per_row(make_records):
+    '''Builds the records for each user's slice of the table, or for the whole table'''
+    def build(df, per_user):
+        tables = [user_df for _, user_df in split_by_user(df)] if per_user else [df]
+        return [make_records(table) for table in tables]
+    return build
+
+
+def columnar(df, per_user):
+    if per_user:
+        return [conversation.messages for conversation in chatbot.split_conversations(df, clean_modmail=False).values()]
+    return [chatbot.Conversation(df, clean_modmail=False).messages]
+
+
+def measure(build, df, per_user):
+    '''Returns (seconds, bytes allocated) to build the messages for every conversation, keeping all of them'''
+    start = time.perf_counter()
+    conversations = build(df, per_user)
+    elapsed = time.perf_counter() - start
+    assert sum(len(messages) for messages in conversations) == len(df)
+    del conversations
+    # Tracing allocations slows everything down, so the memory is measured on a second, untimed pass
+    tracemalloc.start()
+    conversations = build(df, per_user)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000, help="Messages in the synthetic log")
+    args = parser.parse_args()
+    df = make_messages(args.messages)
+    n_users = df.user_id.nunique()
+
+    print(f"{'records':>28} {'conversations':>14} {'time (s)':>9} {'memory (MB)':>12} {'bytes/message':>14}")
+    # All of the messages in one conversation (the cost per message), and then one conversation per user
+    for conversations, per_user in [(1, False), (n_users, True)]:
+        for name, build in [('dataclass from iterrows', per_row(dict_records)),
+                            ('slotted from itertuples', per_row(slotted_records)),
+                            ('columnar views', columnar)]:
+            elapsed, allocated = measure(build, df, per_user)
+            print(f"{name:>28} {conversations:>14} {elapsed:>9.2f} {allocated / 2**20:>12.1f} {allocated / args.messages:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+from conversation_store import COLUMNS
+
+######
+# Synthetic conversation logs for the benchmarks: n messages spread over n / messages_per_user users, with the
+# same columns and types as the conversations file.
+######
+
+MESSAGE_TYPES = ['initial', 'user', 'handoff', 'first_consented_message', 'user', 'AI_reply']
+
+
+def make_messages(n, messages_per_user=20, start=0):
+    '''Returns a table of n messages. Messages made with different `start`s are all different.'''
+    i = np.arange(start, start + n)
+    return pd.DataFrame({
+        'user_id': [f"user{x}" for x in i // messages_per_user],
+        'message_type': [MESSAGE_TYPES[x % len(MESSAGE_TYPES)] for x in i % messages_per_user],
+        'text': [f"This is message {x}, which is about as long as a short reply on reddit" for x in i],
+        'created_utc': 1.7e9 + i.astype(float),
+        'subreddit': 'aww',
+        'conversation_or_message_id': [f"c{x}" for x in i // messages_per_user],
+        'is_modmail': i % 2 == 0,
+        'condition': 'casual',
+    }, columns=COLUMNS)
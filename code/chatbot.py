@@ -1,28 +1,65 @@
-import praw
-from prawcore.exceptions import NotFound
-from praw.exceptions import RedditAPIException
 import os
 import csv
-import pandas as pd
 import time
 import random
-from openai import OpenAI
-from openai import BadRequestError
 import uuid
 import logging
 from dataclasses import dataclass
+from collections import Counter, deque
+from collections.abc import Sequence
+import asyncio
 import argparse
-import json
-import auth
+import signal
+import threading
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '-log',
+                         '--loglevel',
+                         default='warning',
+                         help='Provide logging level. Example --loglevel debug, default=warning' )
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='Keep running, and check for messages every --interval seconds instead of running once')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='In daemon mode, keep polling for messages and reply as soon as they arrive; new users are still contacted every --interval seconds')
+    parser.add_argument('--interval',
+                        type=float,
+                        default=None,
+                        help="Seconds between cycles in daemon mode (default: config['daemon_interval_seconds'])")
+    return parser.parse_args()
+
+# Parse the arguments before the heavy imports below, so that --help (or a bad argument) doesn't wait for them
+if __name__ == '__main__':
+    args = parse_args()
+    # Initialize logging
+    logging.basicConfig( level=args.loglevel.upper() )
+    logging.info( 'Logging now setup.' )
 
-# Open config file
-import yaml
+import praw
+from prawcore.exceptions import NotFound
+from praw.exceptions import RedditAPIException
+import numpy as np
+import pandas as pd
+import auth
+from completions import CompletionPool
+from prompt_window import window_start, count_tokens
+from conversation_summaries import SummaryStore
+from run_state import RunState
+from conversation_store import user_ranges
+from config_loader import load_config
+from storage import open_storage
+from contact_queue import ContactQueue, ContactLog
+from send_queue import SendQueue, is_transient
+from reddit_scheduler import RequestScheduler, connect
 
 CONTROL_WEIGHT = 0
 
-# Open and read the YAML file
-with open('shared_config.yaml', 'r') as file:
-    config = yaml.safe_load(file)
+CONFIG_FILE = 'shared_config.yaml'
+
+config = load_config(CONFIG_FILE)
 
 ###########
 #
@@ -50,30 +87,108 @@ with open('shared_config.yaml', 'r') as file:
 # The default condition allows users to continue chatting via modmail. We should probably have some default message we send one time,
 # and then stop responding to them.
 
-# Initialize logging
-parser = argparse.ArgumentParser()
-parser.add_argument( '-log',
-                     '--loglevel',
-                     default='warning',
-                     help='Provide logging level. Example --loglevel debug, default=warning' )
-args = parser.parse_args()
-logging.basicConfig( level=args.loglevel.upper() )
-logging.info( 'Logging now setup.' )
-
-# Initialize OpenAI client
-OpenAIClient=OpenAI(api_key = auth.openai_key)
-
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 
-def main():
+def main(args):
+    if args.daemon:
+        return run_daemon(interval=args.interval or config.get('daemon_interval_seconds', 60), stream=args.stream)
     curr_run = Run()
     curr_run.get_messages()
     curr_run.continue_convos()
     curr_run.contact_new()
+    if config.get('archive_finished_conversations'):
+        curr_run.archive_finished()
+
+
+def run_daemon(interval, stream=False):
+    '''
+    Keeps one Run in memory and loops over getting messages, replying, and contacting new users every `interval` seconds.
+    The participants, conversations, and other state are loaded once and kept current as we write to them, so a cycle
+    doesn't re-read any files. If the config file changes, it is reloaded before the next cycle. On SIGTERM or SIGINT,
+    we finish the current cycle, flush our state, and exit.
+
+    If stream is True, then we poll for new messages continuously (see Run.watch_messages) and reply to them as soon
+    as they arrive, and only contact new users every `interval` seconds.
+    '''
+    stop = threading.Event()
+    def request_stop(signum, frame):
+        logging.warning(f"Got signal {signum}. Stopping after this cycle.")
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
 
+    curr_run = Run()
+    config_watcher = ConfigWatcher(curr_run)
+    if stream:
+        return stream_replies(curr_run, stop, interval, config_watcher)
+    while not stop.is_set():
+        cycle_start = time.monotonic()
+        config_watcher.reload_if_changed()
+        try:
+            curr_run.get_messages()
+            curr_run.continue_convos()
+            curr_run.contact_new()
+            if config.get('archive_finished_conversations'):
+                curr_run.archive_finished()
+        except Exception as e:
+            logging.exception(f"Cycle failed: {e}")
+        logging.info(f"Cycle took {time.monotonic() - cycle_start:.3f} seconds")
+        stop.wait(max(0, interval - (time.monotonic() - cycle_start)))
+    curr_run.flush()
+
+
+def stream_replies(curr_run, stop, interval, config_watcher):
+    '''
+    The streaming version of the daemon loop. Users who send new messages go into a work queue, which the reply
+    step drains right away; new users are contacted every `interval` seconds.
+    '''
+    # Catch up on anything that was waiting for a reply before we started
+    curr_run.continue_convos()
+    work_queue = deque()
+    last_contacted = 0
+    for user_ids in curr_run.watch_messages(stop, min_wait=config.get('stream_min_wait_seconds', 2), max_wait=interval):
+        work_queue.extend(user_ids)
+        config_watcher.reload_if_changed()
+        try:
+            if len(work_queue) > 0:
+                pending = list(dict.fromkeys(work_queue))
+                work_queue.clear()
+                curr_run.continue_convos(user_ids=pending)
+            if time.monotonic() - last_contacted >= interval:
+                last_contacted = time.monotonic()
+                curr_run.contact_new()
+                if config.get('archive_finished_conversations'):
+                    curr_run.archive_finished()
+        except Exception as e:
+            logging.exception(f"Cycle failed: {e}")
+    curr_run.flush()
 
-@dataclass
+
+class ConfigWatcher:
+    '''Reloads the config (and re-applies it to the run) when the config file changes'''
+
+    def __init__(self, curr_run):
+        self.curr_run = curr_run
+        self.mtime = os.path.getmtime(CONFIG_FILE)
+
+    def reload_if_changed(self):
+        mtime = os.path.getmtime(CONFIG_FILE)
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        logging.warning(f"{CONFIG_FILE} changed. Reloading it.")
+        try:
+            new_config = load_config(CONFIG_FILE)
+        except Exception as e:
+            logging.error(f"Couldn't reload {CONFIG_FILE}; keeping the old config. Error: {e}")
+            return
+        config.clear()
+        config.update(new_config)
+        self.curr_run.apply_config()
+
+
+@dataclass(slots=True)
 class Message:
     user_id: str
     message_type: str # ['initial', 'clarifying', 'AI_reply', 'user']
@@ -84,7 +199,7 @@ class Message:
     is_modmail: bool
     condition: str
     
-@dataclass
+@dataclass(slots=True)
 class User:
     user_name: str
     user_id: str
@@ -96,25 +211,77 @@ class User:
     first_consented_msg: str
     initial_message: str
 
+class MessageColumns:
+    '''
+    A table of messages stored as columns instead of one object per message: the timestamps in a float64 array,
+    message_type as small-int codes, and the other fields as arrays that share the table's strings. Conversations
+    are views over it (see MessageList), so loading many conversations doesn't create an object per message.
+    '''
+
+    def __init__(self, df):
+        message_types = pd.Categorical(df.message_type)
+        self.message_type_codes = message_types.codes
+        # Code -1 (a missing message_type) picks the None at the end
+        self.message_types = np.append(message_types.categories.to_numpy(dtype=object), None)
+        self.created_utc = df.created_utc.to_numpy(dtype=float)
+        self.is_modmail = df.is_modmail.to_numpy(dtype=object)
+        self.user_id, self.text, self.subreddit, self.conversation_or_message_id, self.condition = (
+            df[column].to_numpy() for column in ['user_id', 'text', 'subreddit', 'conversation_or_message_id', 'condition'])
+
+    def message(self, row):
+        return Message(self.user_id[row], self.message_types[self.message_type_codes[row]], self.text[row],
+                       self.created_utc[row], self.subreddit[row], self.conversation_or_message_id[row],
+                       self.is_modmail[row], self.condition[row])
+
+
+class MessageList(Sequence):
+    '''
+    A conversation's messages: a sequence of row numbers (a range or an array) in a MessageColumns. Indexing builds
+    the Message; slicing gives another MessageList over the same columns.
+    '''
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(MessageColumns(df), range(len(df)))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return MessageList(self.columns, self.rows[i])
+        return self.columns.message(self.rows[i])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.columns.message(row)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def split_conversations(convo_df, clean_modmail=True):
+    '''Returns a dictionary from each user in a table of messages to their Conversation. All of them share one MessageColumns.'''
+    order, starts, ends = user_ranges(convo_df)
+    columns = MessageColumns(convo_df)
+    return {columns.user_id[order[start]]: Conversation(MessageList(columns, order[start:end]), clean_modmail)
+            for start, end in zip(starts.tolist(), ends.tolist())}
+
+
 class Conversation:
+    __slots__ = ('messages', 'user_id', 'subreddit', 'consent_status')
     
-    def __init__(self, convo_df, clean_modmail = True):
+    def __init__(self, messages, clean_modmail = True):
         """
-        Given a dataframe of messages, creates a conversation object. 
+        Given a dataframe of messages (or a MessageList), creates a conversation object. 
         If clean_modmail is True, then we remove any modmail messages
         """
-        self.messages = []
-        for _, row in convo_df.iterrows():
-            self.messages.append(Message(
-                user_id = row['user_id'],
-                message_type = row['message_type'],
-                text = row['text'],
-                created_utc = row['created_utc'],
-                subreddit = row['subreddit'],
-                conversation_or_message_id = row['conversation_or_message_id'],
-                is_modmail=row['is_modmail'],
-                condition = row['condition']
-            ))
+        self.messages = MessageList.from_frame(messages) if isinstance(messages, pd.DataFrame) else messages
         if clean_modmail:
             self.clean_messages()
         self.user_id = self.messages[0].user_id
@@ -126,19 +293,14 @@ class Conversation:
         When users are consented and then send messages to modmail, 
         we want to just ignore those messages
         '''
-        has_handoff = False
-        new_messages = []
-        for message in self.messages:
-            if message.message_type == 'handoff':
-                has_handoff = True
-            elif has_handoff == True:
-                # Don't keep the modmail messages that happened after the handoff
-                if message.is_modmail == True:
-                    continue
-            else:
-                pass
-            new_messages.append(message)
-        self.messages = new_messages
+        columns = self.messages.columns
+        rows = np.asarray(self.messages.rows)
+        types = columns.message_types[columns.message_type_codes[rows]]
+        is_handoff = types == 'handoff'
+        # Don't keep the modmail messages that happened after the handoff
+        is_dropped = (np.cumsum(is_handoff) > 0) & ~is_handoff & (columns.is_modmail[rows] == True)
+        if is_dropped.any():
+            self.messages = MessageList(columns, rows[~is_dropped])
 
 
 
@@ -191,7 +353,7 @@ class Conversation:
                                      is_modmail = True,
                                      message_type = 'initial',
                                      condition = self.messages[0].condition,
-                                     created_utc = None)] + self.messages
+                                     created_utc = None)] + list(self.messages)
 
         # We look at our last message. If it was a new message or clarifying message, then we need to check consent
         if self.consent_status is not None:
@@ -223,7 +385,8 @@ class Conversation:
 class Run:
     
     def __init__(self):
-        self.reddit = praw.Reddit(
+        # Paced by the rate-limit budget that we share with the other scripts using this account
+        self.reddit = connect(RequestScheduler(os.path.join(script_dir, config['reddit_rate_limit_file'])),
             client_id = auth.client_id,
             client_secret = auth.client_secret,
             user_agent = auth.u_agent,
@@ -232,20 +395,59 @@ class Run:
             )
         self.conversations_file, self.to_contact_file, self.participants_file, self.subreddits_file = (os.path.join(script_dir, x) for x in [config['conversations_file'], config['to_contact_file'], config['participants_file'], config['subreddits_file']])
         self.bad_accounts_file = os.path.join(script_dir, config['bad_accounts_file'])
+        # Conversations, participants, subreddit rules, and bad accounts (see storage.py)
+        self.storage = open_storage(config, script_dir)
+        self.state = RunState(os.path.join(script_dir, config['state_file']))
+        # How many pages of each listing we've requested from reddit during this run
+        self.pages_fetched = Counter()
         self.load_participants()
         self.load_bad_accounts()
         self.load_conversations()
         self.load_subreddits()
+        self.contact_queue = ContactQueue(self.to_contact_file, os.path.join(script_dir, config['contact_queue_file']))
+        # Reads the whole to_contact file, so it's only created when the first easter egg arrives
+        self.contact_log = None
+        self.send_queue = SendQueue()
+        self.completions = CompletionPool(api_key=auth.openai_key)
+        self.apply_config()
+        # Get the rules for every subreddit we're active in up front, so that replying doesn't have to
+        self.subreddit_rules.prefetch(user.subreddit for user in self.participants.values())
+
+    def apply_config(self):
+        '''
+        Sets up everything that depends on the message templates and model settings in the config. Called again
+        when the config is reloaded in daemon mode. (The data files are only read once, so changing their paths
+        requires a restart.)
+        '''
         self.initial_message_types = list(config['initial_message'].keys())
         self.prompt_options = list(config['prompt_dict'].keys())
         self.clarifying_message = config['clarifying_message']
+        self.prompt_templates = dict()
+        ttl_days = config.get('subreddit_rules_ttl_days')
+        self.subreddit_rules.ttl_seconds = ttl_days * 24 * 60 * 60 if ttl_days else None
+        if config.get('contact_priority', 'fifo') != self.contact_queue.priority:
+            self.contact_queue.set_priority(config.get('contact_priority', 'fifo'))
+        self.contact_queue.max_attempts = config.get('contact_max_attempts', 3)
+        send_config = config.get('send_queue', {})
+        self.send_queue.max_attempts = send_config.get('max_attempts', 4)
+        self.send_queue.backoff_seconds = send_config.get('backoff_seconds', 5)
+        self.send_queue.max_backoff_seconds = send_config.get('max_backoff_seconds', 300)
+        # The pool (and its rate-limit buckets) is kept across config reloads, so a reload can't reset the limits
+        self.completions.set_rate_limits(config.get('openai_rate_limits'))
+        self.completions.base_url = config.get('openai_base_url')
+        if config.get('summary_compaction', {}).get('enabled'):
+            self.summaries = SummaryStore(os.path.join(script_dir, config['summaries_file']))
+        else:
+            self.summaries = None
+
+    def flush(self):
+        '''Writes out any state that is only held in memory. Messages, participants, and bad accounts are written as they're added.'''
+        self.state.save()
 
     def load_bad_accounts(self):
-        try:
-            with open(self.bad_accounts_file, 'r') as f:
-                self.bad_accounts = json.load(f)
-        except FileNotFoundError:
-            self.bad_accounts = []
+        '''Loads the bad accounts, and also excludes everyone we've already contacted from being contacted again'''
+        self.exclusions = self.storage.exclusions()
+        self.exclusions.update(self.username_to_id_map.keys())
 
     def get_subject(self, condition):
         return "Chat with our chatbot about how people behave online"
@@ -256,52 +458,45 @@ class Run:
         return config['initial_message'][user.initial_message].format(username=user.user_name, subreddit=user.subreddit)
     
     def get_subred_rules(self, subred):
+        '''Gets the rules for a subreddit from reddit. Use self.subreddit_rules.get() to go through the cache.'''
         rules = list()
         for rule in self.reddit.subreddit(subred).rules:
             rules.append(rule)
         rules = ', '.join(map(str, rules))
         logging.info(f"Rules for {subred} are: {rules}")
-        new_sub = pd.DataFrame({'subreddit': [subred], 'rules': [rules]})
-        self.subreddits = pd.concat([self.subreddits, new_sub], ignore_index=True)
-        self.subreddits.to_csv(self.subreddits_file, index=False)
-        
         return rules
               
     def get_condition_prompt(self, user):
-        subreddit_rules = self.subreddits.loc[self.subreddits.subreddit == user.subreddit, 'rules']
-        if len(subreddit_rules) == 0:
+        '''
+        Gets the system prompt for the user. The prompt with the subreddit rules filled in is cached per (condition, subreddit),
+        so only the user's details are formatted in on each call. It's rebuilt when the rules are fetched again.
+        '''
+        subreddit_rules, fetched_utc = self.subreddit_rules.entry(user.subreddit)
+        key = (user.condition, user.subreddit)
+        cached = self.prompt_templates.get(key)
+        if cached is None or cached[0] != fetched_utc:
             try:
-                subreddit_rules = self.get_subred_rules(user.subreddit)
-            except Exception as e:
-                logging.error(e)
-                logging.error("Error getting sub rules")
-                subreddit_rules = ''
-
-        prompt_dict = config['prompt_dict'] 
+                prompt = config['prompt_dict'][user.condition]
+            except KeyError:
+                raise KeyError(f"Condition must be one of {self.prompt_options}")
+            # Escape any braces in the rules so that they survive formatting in the user
+            escaped_rules = subreddit_rules.replace('{', '{{').replace('}', '}}')
+            cached = (fetched_utc, prompt.replace('{subreddit_rules}', escaped_rules))
+            self.prompt_templates[key] = cached
         try:
-            prompt = prompt_dict[user.condition]
-            prompt = prompt.format(user=user, subreddit_rules = subreddit_rules)
-            return prompt
+            return cached[1].format(user=user)
         except KeyError:
             raise KeyError(f"Condition must be one of {self.prompt_options}")
             
             
     def load_conversations(self):
-        try:
-            self.conversations = pd.read_csv(self.conversations_file, dtype={'user_id': str,
-                                                            'message_type': str,
-                                                            'text': str,
-                                                            'created_utc': float,
-                                                            'subreddit': str,
-                                                            'conversation_or_message_id': str,
-                                                            'is_modmail': bool,
-                                                            'condition': str
-                                                            })
-        except FileNotFoundError:
-            self.conversations = pd.DataFrame(columns=[
-                'user_id', 'message_type', 'text', 'created_utc',
-                'subreddit', 'conversation_or_message_id', 'is_modmail', 'condition'
-            ])
+        self.conversations = self.storage.conversations()
+        self.conversation_states = self.storage.conversation_states()
+        # The states are missing or behind (e.g., we crashed between writing a message and its state). Both count
+        # distinct messages; read_all() drops any duplicated rows, as the store's index does.
+        if self.conversation_states.n_seen() != len(self.conversations):
+            self.conversation_states.rebuild(self.conversations.read_all())
+            self.conversation_states.set_archived(self.conversations.archived_users())
 
     def get_condition(self, user_id):
         '''Gets the condition that the user_id is in, from the participants dictionary'''
@@ -322,69 +517,103 @@ class Run:
 
     def load_participants(self):
         '''
-        Loads the table of participants; a CSV file stored in `config['participants_file']`. Should have the following columns:
+        Loads the table of participants (by default, a CSV file stored in `config['participants_file']`). Should have the following columns:
         author(str), author_id(str), subreddit (str), toxic_comments (str), condition (str), messaging_strategy (str). Converts it to
         a dictionary of User objects, indexed by author_id'''
      
-        try:
-            df = pd.read_csv(self.participants_file, index_col = 'author_id')
-        except FileNotFoundError:
-            df = pd.DataFrame()
+        df = self.storage.read_participants()
 
         self.participants = dict()
         self.username_to_id_map = dict()
-        for author_id, row in df.iterrows():
+        df = df.reindex(columns=['author', 'subreddit', 'toxic_comments', 'condition', 'messaging_strategy',
+                                 'openai_model', 'first_consented_msg', 'initial_message'])
+        for (author_id, author, subreddit, toxic_comments, condition, messaging_strategy,
+             openai_model, first_consented_msg, initial_message) in df.itertuples(name=None):
             author_id = str(author_id)
-            self.participants[author_id] = User(user_name=row['author'],
+            self.participants[author_id] = User(user_name=author,
                                                 user_id=author_id, 
-                                                subreddit=row['subreddit'], 
-                                                toxic_comments=row['toxic_comments'], 
-                                                condition=row['condition'], 
-                                                messaging_strategy=row['messaging_strategy'],
-                                                openai_model=row['openai_model'],
-                                                first_consented_msg=row['first_consented_msg'],
-                                                initial_message=row['initial_message']
+                                                subreddit=subreddit, 
+                                                toxic_comments=toxic_comments, 
+                                                condition=condition, 
+                                                messaging_strategy=messaging_strategy,
+                                                openai_model=openai_model,
+                                                first_consented_msg=first_consented_msg,
+                                                initial_message=initial_message
                                                 )
-            self.username_to_id_map[row['author']] = author_id
+            self.username_to_id_map[author] = author_id
         
 
     def load_subreddits(self):
-        '''Loads the table of subreddit info (subreddit rules). Should have the following columns:
-        subreddit (str), rules (str)'''
-
-        try:
-            self.subreddits = pd.read_csv(self.subreddits_file)
-        except FileNotFoundError:
-            self.subreddits = pd.DataFrame()
+        '''Loads the cache of subreddit info (subreddit rules). The file should have the following columns:
+        subreddit (str), rules (str), fetched_utc (float). The TTL is set in apply_config.'''
+        self.subreddit_rules = self.storage.rules_cache(fetch_rules=self.get_subred_rules)
 
     def get_messages(self):
         '''Gets the unread messages in our inbox, filters out those that aren't part of conversations with participants,
-        and writes the conversations to the conversations file.
+        and writes the conversations to the conversations file. Returns the ids of the users who sent new messages.
         '''
         
-        self.get_modmail_messages()
-        self.get_inbox_messages()
+        user_ids = self.get_modmail_messages() + self.get_inbox_messages()
+        return list(dict.fromkeys(user_ids))
+
+    def watch_messages(self, stop, min_wait=2, max_wait=60):
+        '''
+        Polls the modmail and inbox until `stop` (a threading.Event) is set. Yields the list of users with new
+        messages after every poll (which may be empty). After an empty poll, we wait twice as long as last time
+        (up to max_wait) before polling again; as soon as something arrives, we go back to min_wait.
+        '''
+        wait = min_wait
+        while not stop.is_set():
+            try:
+                user_ids = self.get_messages()
+            except Exception as e:
+                logging.exception(f"Couldn't get messages: {e}")
+                user_ids = []
+            yield user_ids
+            if len(user_ids) > 0:
+                wait = min_wait
+            else:
+                wait = min(wait * 2, max_wait)
+            stop.wait(wait)
 
         
     def get_modmail_messages(self, max_age_seconds = 24*60*60*4, archive=True):
-        ## TODO: Change temporal filter so that it only gets those newer than our last run?
-        conversations = self.reddit.subreddit("all").modmail.conversations(state='all', sort='recent')
+        '''
+        Gets the new user messages from modmail. We keep a cursor for each subreddit (the last activity time and id of the
+        newest conversation we've handled), so each run only looks at conversations with activity since the last run.
+        We never look further back than max_age_seconds.
+        '''
+        cursors = self.state.get('modmail_cursors', {})
+        # The listing is sorted by most recent activity, so we can stop at the oldest cursor
+        stop_at = time.time() - max_age_seconds
+        if len(cursors) > 0:
+            stop_at = max(stop_at, min(x['created_utc'] for x in cursors.values()))
+        new_cursors = dict(cursors)
+        conversations = PageCounter(self.reddit.subreddit("all").modmail.conversations(state='all', sort='recent'))
         
         to_add = []
         for conversation in conversations:
-            logging.info(f"Checking conversation {conversation} with {[x.author.name for x in conversation.messages]}")
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(f"Checking conversation {conversation} with {[x.author.name for x in conversation.messages]}")
             messages = conversation.messages
             last_message = messages[-1]
             
-            # Check if it's older than one day
+            # Stop once we get to conversations that we've already seen (or that are too old)
             created_utc = to_timestamp(last_message.date)
-            if created_utc < (time.time() - max_age_seconds):
-                logging.info(f"Stopping because {conversation} is older than {max_age_seconds} seconds")
+            if created_utc < stop_at:
+                logging.info(f"Stopping because {conversation} is older than our last run")
                 break
+            subreddit = conversation.owner.display_name
+            cursor = cursors.get(subreddit)
+            if cursor is not None and (created_utc < cursor['created_utc'] or
+                                       (created_utc == cursor['created_utc'] and conversation.id == cursor['conversation_id'])):
+                continue
+            if subreddit not in new_cursors or created_utc > new_cursors[subreddit]['created_utc']:
+                new_cursors[subreddit] = {'created_utc': created_utc, 'conversation_id': conversation.id}
            
             # Archive our messages if they didn't get archived.
             if messages[-1].author.name == auth.username and conversation.state != 2:
-                print(f'Trying to archive {conversation}')
+                logging.info(f'Trying to archive {conversation}')
                 conversation.archive()
 
             # Get only conversations where we initiated the conversation, and where we
@@ -402,7 +631,6 @@ class Run:
          
             text = last_message.body_markdown
             conversation_id = conversation.id
-            subreddit = conversation.owner.display_name
             to_add.append(Message(user_id = uid,
                                   message_type = 'user',
                                   text = text,
@@ -414,42 +642,64 @@ class Run:
                                  ))
             if archive:
                 conversation.archive()
-        self.write_conversations(to_add)
+        self.pages_fetched['modmail'] += conversations.pages
+        new_messages = self.write_conversations(to_add)
+        # Only move the cursors once the messages are stored
+        self.state.set('modmail_cursors', new_cursors)
+        self.state.save()
         # Just grab and archive things that Reddit filtered (for some reason not included in "all")
-        filtered_convos = self.reddit.subreddit("all").modmail.conversations(state='filtered', sort='recent')
+        filtered_convos = PageCounter(self.reddit.subreddit("all").modmail.conversations(state='filtered', sort='recent'))
         for convo in filtered_convos:
             if auth.username in convo.authors:
                 logging.info(f"Archiving message {convo.id}, which was filtered.")
                 convo.archive()
+        self.pages_fetched['modmail'] += filtered_convos.pages
+        logging.info(f"Fetched {self.pages_fetched['modmail']} pages of modmail conversations")
+        return list(new_messages.user_id)
         
     def get_inbox_messages(self):
-        ## TODO: Add a temporal filter so that we only get messages later than our last run
-        inbox = self.reddit.inbox.unread()
+        '''
+        Gets the unread replies from participants in the inbox. Messages are marked read in bulk once they have been stored.
+        We also keep a watermark of the newest message that we've handled, so if we stop before marking them as read,
+        the next run marks them without processing them again.
+        '''
+        watermark = self.state.get('inbox_watermark', {'created_utc': 0, 'ids': []})
+        new_watermark = dict(watermark)
+        inbox = PageCounter(self.reddit.inbox.unread())
         to_add = []
+        to_mark_read = []
         for message in inbox:
             if not isinstance(message, praw.models.Message):
                 continue
 
             ## Look for the easter egg which adds people to the to_contact file
-            if message.subject == 'toxictalk':
-                add_to_contact(message.author.name, message.body)
-                message.mark_read()
+            is_easter_egg = message.subject == 'toxictalk'
+            author_id = None
             # Just get the replies?
             if not message.parent_id:
                 try:
                     logging.info(f'Message from {message.author.name} not a reply: \n {message.subject} \n {message.body}')
                 except AttributeError:
                     logging.info(f"There is an unread message from {message.subreddit}")
-                continue
             else:
                 try:
                     author_id = self.username_to_id_map[message.author.name]
                 except KeyError:
                     logging.info(f"Skipping {message} due to KeyError. {message.author.name} not in list of participants")
-                    continue
                 except AttributeError:
                     logging.info(f"There is an unread message from {message.subreddit}")
-                    continue
+            if not is_easter_egg and author_id is None:
+                continue
+
+            if message.created_utc < watermark['created_utc'] or (message.created_utc == watermark['created_utc'] and
+                                                                   message.id in watermark['ids']):
+                logging.info(f"Already handled {message}. Marking it read.")
+                to_mark_read.append(message)
+                continue
+
+            if is_easter_egg:
+                self.add_to_contact(message.author.name, message.body)
+            if author_id is not None:
                 to_add.append(Message(user_id = author_id,
                                     message_type = 'user',
                                     text = message.body,
@@ -459,19 +709,32 @@ class Run:
                                     is_modmail=False,
                                     condition = self.get_condition(author_id)
                                  ))
-                message.mark_read()
-        self.write_conversations(to_add)
+            to_mark_read.append(message)
+            if message.created_utc > new_watermark['created_utc']:
+                new_watermark = {'created_utc': message.created_utc, 'ids': [message.id]}
+            elif message.created_utc == new_watermark['created_utc']:
+                new_watermark['ids'] = new_watermark['ids'] + [message.id]
+        self.pages_fetched['inbox'] += inbox.pages
+        new_messages = self.write_conversations(to_add)
+        self.state.set('inbox_watermark', new_watermark)
+        self.state.save()
+        # Reddit takes up to 25 messages per mark_read request
+        if len(to_mark_read) > 0:
+            self.reddit.inbox.mark_read(to_mark_read)
+        logging.info(f"Stored {len(new_messages)} inbox messages and marked {len(to_mark_read)} read")
+        return list(new_messages.user_id)
+
+    def add_to_contact(self, username, toxic_comment):
+        if self.contact_log is None:
+            self.contact_log = ContactLog(self.to_contact_file)
+        self.contact_log.add(username, 'survey_invite_testing', toxic_comment, timestamp=get_curr_timestamp())
 
     def add_bad_account(self, user, exception):
         if exception == 'consent_declined' or user_is_missing(exception) or user_blocked_us(exception):
             logging.error(f"Adding {user} as bad account")
-            self.bad_accounts.append(user.user_name)
-            self.bad_accounts.append(user.user_id)
+            self.exclusions.add(user.user_name, user.user_id)
         else:
             logging.error(exception)
-            return
-        with open (self.bad_accounts_file, 'w') as f:
-            json.dump(self.bad_accounts, f)
 
 
     def send_dm(self, user, subject, body, message_type):
@@ -482,6 +745,9 @@ class Run:
             self.write_conversations([message])
             return True
         except (NotFound, RedditAPIException) as e:
+            # Rate limits are retried by the send queue
+            if is_transient(e):
+                raise
             logging.error(f"Error sending message to {user.user_name}: {e}")
             self.add_bad_account(user, e)
             return False
@@ -497,9 +763,13 @@ class Run:
             self.write_conversations([message])
             sent = True
         except RedditAPIException as e:
+            if is_transient(e):
+                raise
             self.add_bad_account(user, e)
             sent = False
         except Exception as e:
+            if is_transient(e):
+                raise
             logging.error(e)
             logging.error(type(e).__name__)
             logging.error(f"Couldn't send a message to {user.user_name}")
@@ -519,15 +789,17 @@ class Run:
             self.reddit.inbox.message(message.conversation_or_message_id).reply(text_to_send)
             return True
         except RedditAPIException as e:
+            if is_transient(e):
+                raise
             user_id = message.user_id
             user = self.participants[user_id]
             self.add_bad_account(user, e)
             return False
         except Exception as e:
+            if is_transient(e):
+                raise
             logging.error(e)
             logging.error(f"Couldn't send a message to {self.participants[message.user_id].user_name}")
-            user = self.participants[user_id]
-            self.add_bad_account(user, e)
             return False
         
     def send_modmail_reply(self, message, text_to_send, archive=True): 
@@ -537,14 +809,18 @@ class Run:
             sent = True
             logging.info("Modmail message sent")
         except RedditAPIException as e:
+            if is_transient(e):
+                raise
             user_id = message.user_id
             user = self.participants[user_id]
             self.add_bad_account(user, e)
             sent = False
             logging.info("Modmail reply got reddit api exception")
         except Exception as e:
+            if is_transient(e):
+                raise
             logging.error(e)
-            logging.error(f"Couldn't send a modmail reply to {self.participants[user_id].user_name}")
+            logging.error(f"Couldn't send a modmail reply to {self.participants[message.user_id].user_name}")
             sent = False 
             logging.info("Modmail reply got other exception")
         if sent and archive:
@@ -567,6 +843,9 @@ class Run:
         if sent:
             message = self.make_message(user=user, text=message, message_type=message_type, is_modmail=is_modmail)
             self.write_conversations([message])
+            if conversation.messages[-1].created_utc is not None:
+                logging.info(f"Replied to {user.user_name} {message.created_utc - conversation.messages[-1].created_utc:.1f} seconds after their message")
+        return sent
 
     def make_message(self, user, text, message_type, is_modmail):
         return Message(user_id = user.user_id,
@@ -580,24 +859,13 @@ class Run:
 
 
     def write_conversations(self, messages):
-        """Takes in a list of message objects. Concatenates them with the existing conversations, and writes them out"""
-        if len(messages) == 0:
-            return
-        new_messages = pd.DataFrame(messages)
-        # Add these to the current conversations only if they aren't already in the 
-        # existing conversations
-        # TODO: An easier way would be to replace the current conversations file
-        # But I like that this doesn't open it for writing, just appending
-        result = new_messages.merge(self.conversations, on=list(new_messages.columns), how='left', indicator=True)
-        result = result[result['_merge'] == 'left_only']
-        new_messages = result.drop(columns=['_merge'])
-        self.conversations = pd.concat([self.conversations, new_messages])
-                         
-        # And append them to the conversations file
-        if not os.path.isfile(self.conversations_file):
-            new_messages.to_csv(self.conversations_file, index=False)
-        else:
-            new_messages.to_csv(self.conversations_file, mode = 'a', header=False, index=False)
+        """Takes in a list of message objects. Appends those that aren't already stored to the conversations file,
+        and returns them as a dataframe"""
+        # The store keeps a hashed index of every stored message, so this is a set lookup per message rather than
+        # a merge against the whole table. It only ever opens the conversations file for appending.
+        new_messages = self.conversations.append(messages)
+        self.conversation_states.update(new_messages)
+        return new_messages
 
 
 
@@ -606,13 +874,9 @@ class Run:
         messaging_strategy can be one of [default, modmail, dm]. Default starts with a modmail message, and then
         switches to DMs if the user replies. Modmail keeps using modmail, and 'dm' starts with a DM.
         '''
-        df = pd.read_csv(self.to_contact_file)
-        df = df.drop_duplicates('author')
-        df = df[df.author != '[deleted]']
-        df = df[~df.author.isin(self.username_to_id_map.keys())]
-        df = df[~df.author.isin(self.bad_accounts)]
-        df = df.iloc[:max_contacts]
-        for i, row in df.iterrows():
+        # The next max_contacts users (by config['contact_priority']) that we haven't contacted and who aren't bad accounts
+        to_contact = self.contact_queue.next_candidates(max_contacts, is_excluded=lambda author: author in self.exclusions)
+        for row in to_contact:
             user = User(
                 user_name=row['author'],
                 user_id=uuid.uuid4(),
@@ -627,39 +891,30 @@ class Run:
                 first_consented_msg=random.choice(list(config['first_consented_message'].keys())),
                 initial_message=random.choice(self.initial_message_types)
             )
-            logging.info(f"Sending initial message to {user.user_name}")
-            # For now, sending messages to control
-            #if user.condition != 'control':
-            message_sent = self.send_new_message(user)
-            #else:
-            #    message_sent = True
-            if message_sent:
-                self.add_participant(user)
+            logging.info(f"Queueing initial message to {user.user_name}")
+            self.send_queue.put('initial', lambda user=user: self.send_new_message(user),
+                                on_result=lambda sent, user=user: self.add_participant(user) if sent else None)
+        self.send_queue.run()
+        # add_participant excludes the users we contacted. The ones whose message failed stay in the queue, to be
+        # tried again later.
+        self.contact_queue.remove(row['author'] for row in to_contact if row['author'] in self.exclusions)
     
     def add_participant(self, author):
-        '''Writes to the file and also updates self.participants and self.username_to_id_map'''
-        
-        if not os.path.isfile(self.participants_file):
-            # Open the CSV file in write mode and write the header row
-            with open(self.participants_file, 'w') as f:
-                writer = csv.writer(f)
-                writer.writerow(['author', 'author_id', 'condition', 'subreddit', 
-                                 'toxic_comments', 'messaging_strategy', 'openai_model', 'first_consented_msg','initial_message'])
-        
-        with open(self.participants_file, 'a') as f:
-            out = csv.writer(f)
-            out.writerow([author.user_name,
-                            author.user_id,
-                            author.condition,                                                                                     
-                            author.subreddit,
-                            author.toxic_comments,
-                            author.messaging_strategy,
-                            author.openai_model,
-                            author.first_consented_msg,
-                            author.initial_message
-                            ])
-        self.participants[author.user_id] = author
-        self.username_to_id_map[author.user_name] = author.user_id
+        '''Writes to the participants table and also updates self.participants and self.username_to_id_map'''
+        self.storage.add_participant([author.user_name,
+                                      author.user_id,
+                                      author.condition,
+                                      author.subreddit,
+                                      author.toxic_comments,
+                                      author.messaging_strategy,
+                                      author.openai_model,
+                                      author.first_consented_msg,
+                                      author.initial_message
+                                      ])
+        # Ids are strings everywhere else (e.g., when loaded from the table), so store them that way here too
+        self.participants[str(author.user_id)] = author
+        self.username_to_id_map[author.user_name] = str(author.user_id)
+        self.exclusions.update([author.user_name])
                 
         
     def write_new_conversation(self, user, message):
@@ -699,61 +954,147 @@ class Run:
                 self.send_modmail(user, subject, message, message_type='initial')
                 return True
             except Exception as e:
+                if is_transient(e):
+                    raise
                 logging.error(f"Couldn't send new message to {user.user_id}. Error {e}, {[x.error_type for x in e.items]}")
                 return False
 
             
 
-    def continue_convos(self):
+    def continue_convos(self, user_ids=None):
         '''
-        Gets the conversations that we need to reply to, and sends a reply. This is where the logic exists that routes conversations based on
-        the messaging strategy.
+        Gets the conversations that we need to reply to, and replies to all of them. This is where the logic exists that routes conversations based on
+        the messaging strategy. The AI replies are generated concurrently, and then everything is sent in order.
+        If user_ids is given, we only look at the conversations with those users.
         '''
-        if not os.path.isfile(self.conversations_file):
-            return
-        convo_df = pd.read_csv(self.conversations_file)
-        # Filters to those where the last reply was written by users
-        convo_df = convo_df[~convo_df.user_id.isin(self.bad_accounts)]
-        convo_df = convo_df.groupby('user_id').filter(lambda x: x.iloc[-1].message_type == 'user')
+        # The conversation states tell us who is waiting for a reply, so we only load those users' messages
+        waiting = [state for state in self.conversation_states.awaiting_reply(user_ids) if state.user_id not in self.exclusions]
+        convo_df = self.conversations.for_users([state.user_id for state in waiting],
+                                                archived_user_ids=[state.user_id for state in waiting if state.archived])
+        conversations = split_conversations(convo_df)
         # Determines whether the user consented; if this is their first message to us, or if our last message was asking for consent,
         # Then we check if they consented. If they didn't, we don't reply. If it's unclear, then we send a clarifying message.
-        conversations = [Conversation(convo_df[convo_df.user_id == x]) for x in convo_df.user_id.unique()]
-        for conversation in conversations:
+        actions = []
+        for state in waiting:
+            conversation = conversations.get(state.user_id)
+            if conversation is None:
+                # The state table and the conversations table disagree (e.g., rows were removed by hand)
+                logging.warning(f"{state.user_id} is waiting for a reply, but has no stored messages. Skipping them.")
+                continue
             logging.info("Loading next convo")
             logging.info(f"Conversation with {conversation.user_id}. Messages are {conversation.messages}")
             user = self.participants[conversation.messages[0].user_id]
+            conversation.consent_status = state.consent_status()
             consent_status = conversation.get_conversation_status(user=user)
             if consent_status == 'declined': 
                 logging.info("Consent declined")
                 self.archive_modmail(conversation=conversation)
                 self.add_bad_account(user, exception = 'consent_declined')
+                self.conversation_states.set_consent_state(state.user_id, 'declined')
                 continue
             elif consent_status == 'skip':
                 logging.info("Skipping conversation (should be because it happened in modmail)")
                 continue
             elif consent_status == 'needs_clarification':
                 # Send a clarifying message if we didn't understand the response to the consent
-                return self.send_clarifying_message(user=user,
-                                             conversation=conversation)
+                actions.append(('clarifying', user, conversation))
             elif consent_status == 'needs_handoff':
-                logging.info(f"Sending handoff message to {user.user_name}")
-                return self.send_handoff_message(user=user, conversation=conversation)
+                actions.append(('handoff', user, conversation))
             elif user.condition == 'control':
                 continue
             else:
-                return self.send_ai_reply(user=user, conversation=conversation)
-            
+                actions.append(('AI_reply', user, conversation))
+
+        to_reply = [(user, conversation) for action, user, conversation in actions if action == 'AI_reply']
+        ai_replies = dict(zip((user.user_id for user, _ in to_reply), self.generate_ai_replies(to_reply)))
+
+        # Each user has at most one conversation, and so at most one action per run. The send queue sends the AI
+        # replies first, then the clarifying and handoff messages. The messages for an action (e.g., the handoff
+        # and then the first consented message) are sent in order.
+        for action, user, conversation in actions:
+            if action == 'clarifying':
+                self.send_queue.put('clarifying', lambda user=user, conversation=conversation:
+                                    self.send_clarifying_message(user=user, conversation=conversation))
+            elif action == 'handoff':
+                logging.info(f"Queueing handoff message to {user.user_name}")
+                self.queue_handoff_messages(user=user, conversation=conversation)
+            elif ai_replies[user.user_id] is not None:
+                self.send_queue.put('AI_reply', lambda user=user, conversation=conversation, message=ai_replies[user.user_id]:
+                                    self.send_ai_reply(user=user, conversation=conversation, message=message))
+        self.send_queue.run()
+
+    def is_finished(self, user_id):
+        '''
+        Whether a conversation can't need a reply anymore: the user declined or is a bad account, or we've already
+        sent them the goodbye message (an AI_reply after more than max_interactions messages).
+        '''
+        state = self.conversation_states.get(user_id)
+        if state is None:
+            return False
+        if user_id in self.exclusions or state.consent_state == 'declined':
+            return True
+        return state.last_message_type == 'AI_reply' and state.n_messages > config['max_interactions'] + 1
+
+    def archive_finished(self):
+        '''
+        Moves the finished conversations out of the conversations table and into the archive. Archiving rewrites the
+        conversations file, so we wait until there are at least config['archive_min_messages'] messages to move.
+        '''
+        finished = [state for state in self.conversation_states.unarchived() if self.is_finished(state.user_id)]
+        n_messages = sum(state.n_seen for state in finished)
+        if len(finished) == 0 or n_messages < config.get('archive_min_messages', 1000):
+            return
+        finished = [state.user_id for state in finished]
+        logging.info(f"Archiving {len(finished)} finished conversations ({n_messages} messages)")
+        self.conversations.archive(finished)
+        self.conversation_states.set_archived(finished)
+
+    def generate_ai_replies(self, to_reply):
+        '''
+        Takes a list of (user, conversation) tuples and gets the AI replies for all of them concurrently, with at most
+        `config['max_concurrent_replies']` requests to OpenAI at once (and within the per-model rate limits). Returns the replies in the same order. If getting
+        a reply fails, then its reply is None.
+        '''
+        if len(to_reply) == 0:
+            return []
+        # Build the prompts first; looking up the subreddit rules can call reddit and write the subreddits file
+        prompts = [self.get_condition_prompt(user) for user, _ in to_reply]
+        async def generate():
+            semaphore = asyncio.Semaphore(config.get('max_concurrent_replies', 4))
+            async def generate_one(user, conversation, prompt):
+                async with semaphore:
+                    return await self.get_ai_reply_async(conversation=conversation, bot_instructions=prompt,
+                                                         openai_model=user.openai_model)
+            return await asyncio.gather(*(generate_one(user, conversation, prompt)
+                                          for (user, conversation), prompt in zip(to_reply, prompts)),
+                                        return_exceptions=True)
+
+        replies = []
+        for (user, _), reply in zip(to_reply, self.completions.run(generate())):
+            if isinstance(reply, Exception):
+                logging.error(f"Couldn't get an AI reply for {user.user_name}: {reply}")
+                reply = None
+            replies.append(reply)
+        return replies
 
     def send_clarifying_message(self, user, conversation):
         '''Sends a clarifying message if we didn't understand the user's response to the consent question'''
         return self.send_reply(user=user, message=self.clarifying_message, conversation=conversation, message_type='clarifying')
 
-    def send_handoff_message(self, user, conversation):
-        '''Sends a handoff message if the user has consented to the study'''
+    def queue_handoff_messages(self, user, conversation):
+        '''
+        Queues a handoff message if the user has consented to the study, and then the first consented message.
+        The first consented message is only queued once the handoff message has been sent (or failed), so it can't go first.
+        '''
+        def queue_first_consented_message(sent=None):
+            if user.condition != 'control':
+                self.send_queue.put('first_consented_message', lambda: self.send_first_consented_message(user, conversation))
         if user.messaging_strategy == 'default':
-            self.send_reply(user=user, message=config['handoff_message'], conversation=conversation, message_type='handoff')
-        if user.condition != 'control':
-            self.send_first_consented_message(user, conversation)
+            self.send_queue.put('handoff', lambda: self.send_reply(user=user, message=config['handoff_message'],
+                                                                   conversation=conversation, message_type='handoff'),
+                                on_result=queue_first_consented_message)
+        else:
+            queue_first_consented_message()
 
     def send_first_consented_message(self, user, conversation):
         '''Sends a message to the user if they have consented to the study'''
@@ -763,16 +1104,17 @@ class Run:
         if user.messaging_strategy == 'default':
             return self.send_dm(user=user, subject=self.get_subject(user.condition), body=message, message_type='first_consented_message')
         else:
-            self.send_reply(user=user, message=message, conversation=conversation, message_type='first_consented_message')
+            return self.send_reply(user=user, message=message, conversation=conversation, message_type='first_consented_message')
 
-    def send_ai_reply(self, user, conversation):
+    def send_ai_reply(self, user, conversation, message=None):
         '''Sends a reply to the user, based on the current conversation. The curr_convo is the Conversation object.
-        Checks whether we need to send a handoff message, and if so, sends it. Otherwise, sends a message from the AI.
+        If the message has already been generated (e.g., by generate_ai_replies), it is passed in as `message`; otherwise,
+        we get a message from the AI.
         '''
-
-        bot_instructions = self.get_condition_prompt(user)
-        message = self.get_ai_reply(conversation=conversation, bot_instructions=bot_instructions,
-                                    openai_model=user.openai_model)
+        if message is None:
+            bot_instructions = self.get_condition_prompt(user)
+            message = self.get_ai_reply(conversation=conversation, bot_instructions=bot_instructions,
+                                        openai_model=user.openai_model)
         if message == 'Error occurred.':
             logging.error(f"OpenAI returned: {message}. Not sending.")
             return None
@@ -792,39 +1134,86 @@ class Run:
         except KeyError:
             raise("Tried to find {user_id} in the participants file, but it wasn't there")
 
-    def get_ai_reply(self, conversation, bot_instructions, openai_model='gpt-3.5-turbo'):
-        ## TODO: If we include more models, don't hard code this, but put it in config
+    def build_ai_request(self, conversation, bot_instructions, openai_model='gpt-3.5-turbo', summary=None, summary_start=0):
+        '''
+        Builds the list of messages to send to OpenAI. Returns (messages, None), or (None, reply) if we
+        should send a canned reply instead of calling OpenAI.
+
+        If the conversation doesn't fit in `config['max_tokens']` for the model, we keep the most recent
+        messages that do fit. If there is a summary of the first `summary_start` messages, then we send the
+        summary in place of those messages.
+        '''
         try:
             max_tokens = config['max_tokens'][openai_model]
         except KeyError: 
-            raise(f"openai_model must be one of {config['openai_models']}")
-        except Exception as e:  # Unknown Exception
-            raise(e)
+            raise KeyError(f"openai_model must be one of {config['openai_models']}")
         if len(conversation.messages) > config['max_interactions']:
-            return config['goodbye_message']
-        message_len = len(bot_instructions.split())
+            return None, config['goodbye_message']
+        if summary is not None:
+            bot_instructions += (" You are in the middle of a conversation with the user. Here is a summary of the"
+                                 f" earlier part of the conversation: {summary}")
+        recent_messages = conversation.messages[summary_start:]
+        texts = [message.text for message in recent_messages]
+        start = window_start(bot_instructions, texts, max_tokens, openai_model)
+        if start > 0 and summary is None:
+            bot_instructions += " You are in the middle of a conversation with the user."
+            start = window_start(bot_instructions, texts, max_tokens, openai_model)
+        if start == len(texts):
+            return None, "I'm sorry, but your response is too long. Can you try something shorter?"
+
         messages=[{"role": "system", "content": bot_instructions}]
-        for message in conversation.messages:
+        for message in recent_messages[start:]:
             if message.message_type == 'user':
                 role = 'user'
             else:
                 role = 'assistant'
             messages.append({"role": role, "content": message.text})
-            message_len += len(message.text.split())
-        if message_len > max_tokens:
-            if len(conversation.messages) == 1:
-                return "I'm sorry, but your response is too long. Can you try something shorter?"
-            
-            conversation.messages = conversation.messages[1:]
-            bot_instructions += " You are in the middle of a conversation with the user."
-            return self.get_ai_reply(conversation, bot_instructions)
-        
-        try:
-            gpt_response = OpenAIClient.chat.completions.create(
-                model=openai_model,
-                messages = messages)
+        return messages, None
 
-            reply = gpt_response.choices[0].message.content
+    async def update_summary(self, conversation, bot_instructions, openai_model):
+        '''
+        Once a conversation is longer than `config['summary_compaction']['threshold_tokens']`, we keep a rolling summary
+        of everything except the most recent `recent_tokens` worth of messages. The summary is only updated with the
+        messages that have aged out of the recent window since the last update.
+        Returns (summary, number of messages the summary covers), or (None, 0) if the conversation doesn't need one.
+        '''
+        settings = config['summary_compaction']
+        texts = [message.text for message in conversation.messages]
+        stored = self.summaries.get(conversation.user_id)
+        if stored is None and sum(count_tokens(text, openai_model) for text in texts) <= settings['threshold_tokens']:
+            return None, 0
+        summary, n_summarized = stored or (None, 0)
+        # The recent window is counted over the messages only (the system prompt is sent either way), and always
+        # keeps the last message, so the message we're replying to is never folded into the summary
+        start = min(window_start('', texts, settings['recent_tokens'], openai_model), len(texts) - 1)
+        if start > n_summarized:
+            transcript = '\n'.join(f"{'user' if message.message_type == 'user' else 'assistant'}: {message.text}"
+                                   for message in conversation.messages[n_summarized:start])
+            if summary is not None:
+                transcript = f"Summary so far: {summary}\n\nNew messages:\n{transcript}"
+            try:
+                summary = await self.completions.complete(model=settings.get('model', openai_model),
+                                                          messages=[{"role": "system", "content": settings['prompt']},
+                                                                    {"role": "user", "content": transcript}])
+            except Exception as e:
+                logging.error(f"Couldn't update the summary for {conversation.user_id}: {e}")
+                return stored or (None, 0)
+            n_summarized = start
+            self.summaries.set(conversation.user_id, summary, n_summarized)
+        return summary, n_summarized
+
+    async def get_ai_reply_async(self, conversation, bot_instructions, openai_model='gpt-3.5-turbo'):
+        # openai is slow to import, so we only import it once we need a reply
+        from openai import BadRequestError
+        summary, summary_start = None, 0
+        if self.summaries is not None and len(conversation.messages) <= config['max_interactions']:
+            summary, summary_start = await self.update_summary(conversation, bot_instructions, openai_model)
+        messages, reply = self.build_ai_request(conversation, bot_instructions, openai_model,
+                                                summary=summary, summary_start=summary_start)
+        if reply is not None:
+            return reply
+        try:
+            reply = await self.completions.complete(model=openai_model, messages=messages)
         
         except BadRequestError as e:
             logging.warning(f"Got a BadRequestError for {messages}. Error is {e}")
@@ -837,6 +1226,9 @@ class Run:
                 
         return reply
 
+    def get_ai_reply(self, conversation, bot_instructions, openai_model='gpt-3.5-turbo'):
+        return self.completions.run(self.get_ai_reply_async(conversation, bot_instructions, openai_model))
+
     def archive_modmail(self, conversation):
         if not conversation.messages[-1].is_modmail:
             logging.warn(f"Can't archive conversation with {conversation.messages[0].user_id}. Not in modmail")
@@ -846,11 +1238,6 @@ class Run:
         self.reddit.subreddit(sr).modmail(id).archive()
 
 
-def add_to_contact(username, toxic_comment):
-    with open(os.path.join(script_dir, config['to_contact_file']), 'a') as f:
-        out = csv.writer(f)
-        out.writerow([username, 'survey_invite_testing', toxic_comment])
-
 def user_is_missing(exception):
     for item in exception.items:
         if item.error_type == 'USER_DOESNT_EXIST':
@@ -863,6 +1250,31 @@ def user_blocked_us(exception):
             return True
     return False        
 
+class PageCounter:
+    '''
+    Iterates over a praw ListingGenerator, counting the pages (API requests) it has fetched so far in `pages`. We
+    count each new page as it's fetched, since the page size can't be worked out afterwards: with limit=None, praw
+    asks for 1024 items a page, and reddit sends at most 100.
+    '''
+
+    def __init__(self, listing):
+        self.listing = listing
+        self.pages = 0
+        self.page = None
+
+    def __iter__(self):
+        for item in self.listing:
+            self.count()
+            yield item
+        # The last request can come back empty
+        self.count()
+
+    def count(self):
+        page = getattr(self.listing, '_listing', None)
+        if page is not None and page is not self.page:
+            self.page = page
+            self.pages += 1
+
 def to_timestamp(datestring):
     return pd.Timestamp(datestring).timestamp()
                 
@@ -870,4 +1282,4 @@ def get_curr_timestamp():
     return pd.Timestamp.now().timestamp()
                 
 if __name__ == '__main__':
-    main()
+    main(args)
@@ -0,0 +1,132 @@
+import asyncio
+import time
+import logging
+from prompt_window import count_message_tokens
+
+######
+# An asyncio layer for getting chat completions from OpenAI. One client (and so one pool of HTTP connections)
+# is shared by all of the requests in a batch, and each model has a token bucket for requests per minute and
+# one for tokens per minute, so that sending a lot of replies at once doesn't get us rate limited.
+#
+# Usage:
+#     pool = CompletionPool(api_key, rate_limits=config['openai_rate_limits'])
+#     reply = pool.run(pool.complete('gpt-3.5-turbo', messages))
+#
+# To run without OpenAI (e.g., in the tests), pass a client_factory that returns something shaped like
+# openai.AsyncOpenAI; see tests/fake_openai.py.
+######
+
+
+class TokenBucket:
+    '''A bucket that holds up to `capacity` tokens and refills at `capacity` tokens per `period` seconds'''
+
+    def __init__(self, capacity, period=60):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        '''Waits until `amount` tokens are available and takes them. Asking for more than the capacity waits for a full bucket.'''
+        amount = min(amount, self.capacity)
+        while True:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def resize(self, capacity):
+        '''Changes the capacity (and so the refill rate), keeping the tokens that are in the bucket now'''
+        self.refill()
+        self.capacity = capacity
+        self.rate = capacity / self.period
+        self.tokens = min(self.tokens, capacity)
+
+    def adjust(self, amount):
+        '''Takes (or gives back, if negative) tokens without waiting; used once we know what a request actually cost'''
+        self.refill()
+        self.tokens -= amount
+
+
+class CompletionPool:
+
+    def __init__(self, api_key, rate_limits=None, base_url=None, client_factory=None):
+        '''
+        rate_limits is a dictionary of model -> {'requests_per_minute': int, 'tokens_per_minute': int}. Models that
+        aren't in it aren't limited. base_url can point the pool at a different server (e.g., a local stub).
+        client_factory is called with no arguments to make the client; by default, it's an openai.AsyncOpenAI.
+        '''
+        self.api_key = api_key
+        self.base_url = base_url
+        self.client_factory = client_factory
+        self.request_buckets = dict()
+        self.token_buckets = dict()
+        self.set_rate_limits(rate_limits)
+        self._client = None
+        self._loop = None
+
+    def set_rate_limits(self, rate_limits):
+        '''
+        Sets the per-model limits (e.g., when the config is reloaded). The buckets of models that are still limited
+        are kept, along with the tokens that are in them, so changing the limits can't let through a burst.
+        '''
+        rate_limits = rate_limits or {}
+        for buckets, key in [(self.request_buckets, 'requests_per_minute'), (self.token_buckets, 'tokens_per_minute')]:
+            limits = {model: model_limits[key] for model, model_limits in rate_limits.items() if model_limits.get(key)}
+            for model in list(buckets):
+                if model not in limits:
+                    del buckets[model]
+            for model, capacity in limits.items():
+                if model not in buckets:
+                    buckets[model] = TokenBucket(capacity)
+                elif buckets[model].capacity != capacity:
+                    buckets[model].resize(capacity)
+
+    def get_client(self):
+        '''Returns the client for the running event loop. The client can't be shared across loops, so we make a new one if the loop changed.'''
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            if self.client_factory is not None:
+                self._client = self.client_factory()
+            else:
+                # Imported here because openai is slow to import and most runs don't need a completion
+                from openai import AsyncOpenAI
+                self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+            self._loop = loop
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+        self._loop = None
+
+    async def complete(self, model, messages):
+        '''Gets a chat completion for the messages, waiting for the model's rate limits if needed. Returns the reply text.'''
+        estimated_tokens = count_message_tokens(messages, model)
+        if model in self.request_buckets:
+            await self.request_buckets[model].acquire()
+        if model in self.token_buckets:
+            await self.token_buckets[model].acquire(estimated_tokens)
+        start = time.monotonic()
+        response = await self.get_client().chat.completions.create(model=model, messages=messages)
+        logging.debug(f"Got a completion from {model} in {time.monotonic() - start:.2f} seconds")
+        if model in self.token_buckets and response.usage is not None:
+            self.token_buckets[model].adjust(response.usage.total_tokens - estimated_tokens)
+        return response.choices[0].message.content
+
+    def run(self, coro):
+        '''Runs coro to completion on a new event loop, and then closes the pool's connections'''
+        async def run_and_close():
+            try:
+                return await coro
+            finally:
+                await self.aclose()
+        return asyncio.run(run_and_close())
@@ -0,0 +1,40 @@
+import os
+import pickle
+
+######
+# Loads the YAML config. Parsing YAML is slow compared to the rest of a cron tick, so the parsed config is
+# pickled to __pycache__/ next to the config file, keyed by the file's mtime and size. The next run loads the
+# pickle instead of parsing the YAML (and doesn't import yaml at all) unless the config has changed.
+######
+
+
+def cache_path(config_file):
+    config_dir, config_name = os.path.split(os.path.abspath(config_file))
+    return os.path.join(config_dir, '__pycache__', config_name + '.pickle')
+
+
+def load_config(config_file='shared_config.yaml'):
+    stat = os.stat(config_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cache_file = cache_path(config_file)
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_key, config = pickle.load(f)
+        if cached_key == key:
+            return config
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+
+    import yaml
+    with open(config_file, 'r') as file:
+        config = yaml.safe_load(file)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((key, config), f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # Not being able to cache the config isn't a reason to stop
+        pass
+    return config
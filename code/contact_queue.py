@@ -0,0 +1,175 @@
+import io
+import os
+import csv
+import math
+import heapq
+import logging
+import pandas as pd
+from run_state import RunState
+
+######
+# The to_contact file is an append-only log of users we could contact. ContactLog is how the collectors add to
+# it; it skips users who are already in the log. ContactQueue is how the chatbot takes from it: it remembers how
+# far into the log it has read (a byte offset) and keeps the users it hasn't contacted yet in a priority queue,
+# so each run only reads the rows that were added since the last one.
+#
+# A user we try to contact stays in the queue until they're excluded or removed, so a failed send is tried again,
+# but behind the users we haven't tried yet; after max_attempts tries they're dropped from the queue.
+#
+# The queue is persisted as JSON in contact_queue_file: {'offset': int, 'seq': int, 'pending': [row, ...]}, where
+# each row also has its 'seq' and the number of 'attempts' we've made to contact them.
+######
+
+HEADER = ['author', 'subreddit', 'toxic_comments', 'timestamp', 'moderator', 'tox_score']
+
+# 'fifo' contacts users in the order they were added to the log
+PRIORITIES = ['fifo', 'tox_score', 'recency']
+
+
+class ContactLog:
+
+    def __init__(self, to_contact_file):
+        self.to_contact_file = to_contact_file
+        try:
+            log = pd.read_csv(to_contact_file, usecols=['author', 'subreddit', 'timestamp'])
+        except FileNotFoundError:
+            log = pd.DataFrame(columns=['author', 'subreddit', 'timestamp'])
+        self.authors = set(log.author.dropna())
+        # The newest removal we've logged in each subreddit, so the collectors can stop when they reach it
+        timestamps = pd.to_numeric(log.timestamp, errors='coerce')
+        self.last_timestamps = timestamps.groupby(log.subreddit).max().dropna().to_dict()
+
+    def __contains__(self, author):
+        return author in self.authors
+
+    def last_timestamp(self, subreddit):
+        '''The timestamp of the newest row for the subreddit, or 0 if there isn't one'''
+        return self.last_timestamps.get(subreddit, 0)
+
+    def add(self, author, subreddit, toxic_comments, timestamp=None, moderator=None, tox_score=None):
+        '''Appends a user to the log. Returns False (and doesn't write anything) if they're already in it.'''
+        if author in self.authors:
+            return False
+        is_new_file = not os.path.isfile(self.to_contact_file)
+        with open(self.to_contact_file, 'a', newline='') as f:
+            out = csv.writer(f)
+            if is_new_file:
+                out.writerow(HEADER)
+            out.writerow([author, subreddit, toxic_comments, timestamp, moderator, tox_score])
+        self.authors.add(author)
+        if isinstance(timestamp, (int, float)) and timestamp > self.last_timestamp(subreddit):
+            self.last_timestamps[subreddit] = timestamp
+        return True
+
+
+class ContactQueue:
+
+    def __init__(self, to_contact_file, queue_file, priority='fifo', max_attempts=3):
+        self.to_contact_file = to_contact_file
+        self.max_attempts = max_attempts
+        self.state = RunState(queue_file)
+        self.offset = self.state.get('offset', 0)
+        self.seq = self.state.get('seq', 0)
+        self.pending = []
+        self.pending_authors = set()
+        self.set_priority(priority, self.state.get('pending', []))
+
+    def priority_key(self, row):
+        '''
+        Smaller keys are contacted first. Users we've already tried to contact go after the ones we haven't, and rows
+        without a score or a timestamp go after the ones that have them.
+        '''
+        if self.priority == 'fifo':
+            value = 0
+        else:
+            value = row.get('tox_score' if self.priority == 'tox_score' else 'timestamp')
+            value = -value if isinstance(value, (int, float)) and not math.isnan(value) else math.inf
+        return (row.get('attempts', 0), value, row['seq'])
+
+    def set_priority(self, priority, rows=None):
+        if priority not in PRIORITIES:
+            raise ValueError(f"contact_priority should be one of {PRIORITIES}, not {priority}")
+        self.priority = priority
+        rows = [entry[-1] for entry in self.pending] if rows is None else rows
+        self.pending = [(*self.priority_key(row), row) for row in rows]
+        heapq.heapify(self.pending)
+        self.pending_authors = {row['author'] for row in rows}
+
+    def push(self, row):
+        heapq.heappush(self.pending, (*self.priority_key(row), row))
+        self.pending_authors.add(row['author'])
+
+    def read_new_rows(self):
+        '''Reads the rows that were added to the log since the last time. Returns True if there were any.'''
+        try:
+            size = os.path.getsize(self.to_contact_file)
+        except FileNotFoundError:
+            return False
+        if size < self.offset:
+            # The file was rewritten; start over. Users we already contacted are filtered out when we take them.
+            logging.warning(f"{self.to_contact_file} is shorter than what we've read. Reading it again.")
+            self.offset = 0
+        if size == self.offset:
+            return False
+        with open(self.to_contact_file, 'rb') as f:
+            header = f.readline()
+            f.seek(max(self.offset, len(header)))
+            data = f.read()
+        # A writer might be in the middle of a row; wait for it to finish
+        if not data.endswith(b'\n'):
+            return False
+        df = pd.read_csv(io.BytesIO(header + data))
+        df = df.reindex(columns=HEADER).astype(object)
+        df = df.where(pd.notna(df), None)
+        for row in df.to_dict('records'):
+            author = row['author']
+            if author is None or author == '[deleted]' or author in self.pending_authors:
+                continue
+            row['seq'] = self.seq
+            row['attempts'] = 0
+            self.seq += 1
+            self.push(row)
+        self.offset = max(self.offset, len(header)) + len(data)
+        return True
+
+    def next_candidates(self, n, is_excluded):
+        '''
+        Returns the next n users to contact, in priority order. Users for whom is_excluded(author) is True are removed
+        from the queue. The others stay in it until they're excluded or removed (e.g., because we contacted them), so
+        a user whose message failed to send is tried again next time, after the users we haven't tried yet. Users
+        we've already tried max_attempts times are dropped.
+        '''
+        changed = self.read_new_rows()
+        candidates = []
+        while len(candidates) < n and len(self.pending) > 0:
+            row = heapq.heappop(self.pending)[-1]
+            changed = True
+            if is_excluded(row['author']):
+                self.pending_authors.discard(row['author'])
+            elif row.get('attempts', 0) >= self.max_attempts:
+                logging.warning(f"Couldn't contact {row['author']} after {row['attempts']} attempts. Dropping them from the queue.")
+                self.pending_authors.discard(row['author'])
+            else:
+                candidates.append(row)
+        for row in candidates:
+            row['attempts'] = row.get('attempts', 0) + 1
+            self.push(row)
+        if changed:
+            self.save()
+        return candidates
+
+    def remove(self, authors):
+        '''Removes users from the queue (e.g., the ones we just contacted)'''
+        authors = set(authors) & self.pending_authors
+        if len(authors) == 0:
+            return
+        self.pending = [entry for entry in self.pending if entry[-1]['author'] not in authors]
+        heapq.heapify(self.pending)
+        self.pending_authors -= authors
+        self.save()
+
+    def save(self):
+        self.state.set('offset', self.offset)
+        self.state.set('seq', self.seq)
+        self.state.set('pending', [entry[-1] for entry in self.pending])
+        self.state.save()
@@ -0,0 +1,202 @@
+import os
+import csv
+import logging
+import pandas as pd
+from dataclasses import dataclass, astuple, fields
+
+######
+# A per-user summary of where each conversation stands: the consent state, the last message (its type, time,
+# text, channel, and conversation id), and how many messages there have been. It's updated as messages are
+# stored, so finding the users that need a reply (and whether they've consented) doesn't require going back
+# through the whole conversations table.
+#
+# The states follow the same rules as Conversation in chatbot.py: once a user has been handed off to DMs,
+# their modmail messages are ignored.
+#
+# With the CSV storage, the table is an append-only file where the last row for each user wins. It's
+# rewritten (compacted) when it's loaded and has a lot more rows than users.
+######
+
+# The bot messages after which the next user message is a reply to the consent question
+CONSENT_MESSAGE_TYPES = ['initial', 'clarifying']
+
+
+@dataclass(slots=True)
+class ConversationState:
+    user_id: str
+    consent_state: str = 'pending'  # ['pending', 'consented', 'declined']
+    last_message_type: str = None
+    prev_message_type: str = None
+    last_message_utc: float = None
+    last_text: str = None
+    is_modmail: bool = None
+    subreddit: str = None
+    conversation_id: str = None
+    n_messages: int = 0
+    n_seen: int = 0  # Including the ignored modmail messages
+    has_handoff: bool = False
+    archived: bool = False  # Whether some of the user's messages are in the archive
+
+    def apply(self, message_type, text, created_utc, subreddit, conversation_id, is_modmail):
+        '''Updates the state with a new message'''
+        self.n_seen += 1
+        if self.has_handoff and is_modmail:
+            return
+        if message_type == 'handoff':
+            self.has_handoff = True
+        if message_type in CONSENT_MESSAGE_TYPES:
+            self.consent_state = 'pending'
+        elif message_type != 'user' and self.consent_state != 'declined':
+            self.consent_state = 'consented'
+        self.prev_message_type = self.last_message_type
+        self.last_message_type = message_type
+        self.last_message_utc = created_utc
+        self.last_text = text
+        self.is_modmail = is_modmail
+        self.subreddit = subreddit
+        self.conversation_id = conversation_id
+        self.n_messages += 1
+
+    def needs_reply(self):
+        return self.last_message_type == 'user' and self.consent_state != 'declined'
+
+    def consent_status(self):
+        '''The same as Conversation.get_conversation_status(), computed from the state'''
+        if self.last_message_type != 'user':
+            return 'skip'
+        # If the initial message is missing, then the user's first message is the answer to it
+        if self.prev_message_type is None or self.prev_message_type in CONSENT_MESSAGE_TYPES:
+            words = str(self.last_text or '').lower().strip('" \n\'').split()
+            text = words[0] if len(words) > 0 else ''
+            if text in ['yes', 'sure', 'y', 'ok']:
+                return 'needs_handoff'
+            elif text in ['no', 'n', 'nope']:
+                return 'declined'
+            return 'needs_clarification'
+        return 'consented'
+
+
+COLUMNS = [field.name for field in fields(ConversationState)]
+
+
+def parse_row(row):
+    '''Converts a row of strings (from the CSV file) back into a ConversationState'''
+    def value(field):
+        # Files written before a field was added don't have it
+        x = row.get(field.name) or ''
+        if x == '':
+            return field.default
+        if field.type is bool:
+            return x == 'True'
+        if field.type is int:
+            return int(x)
+        if field.type is float:
+            return float(x)
+        return x
+    return ConversationState(**{field.name: value(field) for field in fields(ConversationState)})
+
+
+class ConversationStateTable:
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.states = self.read()
+        self.waiting = {user_id for user_id, state in self.states.items() if state.needs_reply()}
+
+    def read(self):
+        '''Returns the stored states as a dictionary of user_id -> ConversationState'''
+        states = dict()
+        n_rows = 0
+        try:
+            with open(self.state_file, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    states[row['user_id']] = parse_row(row)
+                    n_rows += 1
+        except FileNotFoundError:
+            pass
+        if n_rows > 2 * len(states) + 100:
+            self.rewrite(states.values())
+        return states
+
+    def write(self, states):
+        '''Appends the given states to the file'''
+        is_new_file = not os.path.isfile(self.state_file)
+        with open(self.state_file, 'a', newline='') as f:
+            out = csv.writer(f)
+            if is_new_file:
+                out.writerow(COLUMNS)
+            out.writerows(astuple(state) for state in states)
+
+    def rewrite(self, states):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(COLUMNS)
+            out.writerows(astuple(state) for state in states)
+        os.replace(tmp_file, self.state_file)
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, user_id):
+        return self.states.get(str(user_id))
+
+    def n_seen(self):
+        '''How many messages the table has been updated with'''
+        return sum(state.n_seen for state in self.states.values())
+
+    def apply(self, messages):
+        '''Updates the states from a table of new messages (with the conversations columns). Returns the changed states.'''
+        changed = dict()
+        messages = messages[['user_id', 'message_type', 'text', 'created_utc', 'subreddit',
+                             'conversation_or_message_id', 'is_modmail']].astype(object)
+        messages = messages.where(pd.notna(messages), None)
+        for user_id, message_type, text, created_utc, subreddit, conversation_id, is_modmail in messages.itertuples(index=False, name=None):
+            user_id = str(user_id)
+            if user_id not in self.states:
+                self.states[user_id] = ConversationState(user_id=user_id)
+            state = self.states[user_id]
+            state.apply(message_type, text, created_utc, subreddit, conversation_id, bool(is_modmail))
+            changed[user_id] = state
+        for user_id, state in changed.items():
+            if state.needs_reply():
+                self.waiting.add(user_id)
+            else:
+                self.waiting.discard(user_id)
+        return list(changed.values())
+
+    def update(self, messages):
+        '''Updates the states with newly stored messages, and saves the ones that changed'''
+        if len(messages) == 0:
+            return
+        self.write(self.apply(messages))
+
+    def rebuild(self, conversations):
+        '''Recomputes every state from the full conversations table'''
+        logging.warning(f"Rebuilding the conversation states from {len(conversations)} messages")
+        self.states = dict()
+        self.waiting = set()
+        self.apply(conversations)
+        self.rewrite(self.states.values())
+
+    def set_consent_state(self, user_id, consent_state):
+        state = self.states[str(user_id)]
+        state.consent_state = consent_state
+        if not state.needs_reply():
+            self.waiting.discard(state.user_id)
+        self.write([state])
+
+    def set_archived(self, user_ids):
+        states = [self.states[str(user_id)] for user_id in user_ids if str(user_id) in self.states]
+        for state in states:
+            state.archived = True
+        self.write(states)
+
+    def unarchived(self):
+        '''Returns the states of the users whose messages are still in the conversations table'''
+        return [state for state in self.states.values() if not state.archived]
+
+    def awaiting_reply(self, user_ids=None):
+        '''Returns the states of the users whose last message was to us (optionally, only among user_ids), sorted by user_id'''
+        waiting = self.waiting if user_ids is None else self.waiting.intersection(str(user_id) for user_id in user_ids)
+        return [self.states[user_id] for user_id in sorted(waiting)]
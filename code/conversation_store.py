@@ -0,0 +1,283 @@
+import io
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+######
+# An append-only store for the conversations file. Every message that we have stored is hashed
+# into an index, so checking whether a message is already stored doesn't require merging against
+# the whole conversations table. New messages are appended to the file and kept in a list until
+# someone asks for the full table.
+#
+# Conversations that can't need a reply anymore can be moved to an archive (conversations_archive.csv, next
+# to the conversations file), so that the conversations file only holds the active ones. The hashes of the
+# archived messages are kept in conversations_archive.keys.npy, so we still recognize them without reading
+# the archive. Use read_all_conversations() to read both.
+#
+# The index of the conversations file is kept in a sidecar too (conversations.keys.npz): the sorted hashes, and how
+# many bytes of the file they cover. On start-up only the rows appended after that are read and hashed, and the
+# conversations table itself is only read when someone asks for it.
+######
+
+COLUMNS = ['user_id', 'message_type', 'text', 'created_utc',
+           'subreddit', 'conversation_or_message_id', 'is_modmail', 'condition']
+
+DTYPES = {'user_id': str,
+          'message_type': str,
+          'text': str,
+          'created_utc': float,
+          'subreddit': str,
+          'conversation_or_message_id': str,
+          'is_modmail': bool,
+          'condition': str
+          }
+
+
+def read_conversations(conversations_file):
+    '''Reads the conversations file, or returns an empty table if it doesn't exist yet'''
+    try:
+        return pd.read_csv(conversations_file, dtype=DTYPES)
+    except FileNotFoundError:
+        return pd.DataFrame(columns=COLUMNS)
+
+
+def archive_path(conversations_file):
+    root, ext = os.path.splitext(conversations_file)
+    return root + '_archive' + ext
+
+
+def archive_keys_path(conversations_file):
+    return os.path.splitext(archive_path(conversations_file))[0] + '.keys.npy'
+
+
+def index_path(conversations_file):
+    return os.path.splitext(conversations_file)[0] + '.keys.npz'
+
+
+def drop_duplicate_messages(df):
+    return df[~pd.Series(hash_messages(df)).duplicated().to_numpy()]
+
+
+def read_all_conversations(conversations_file):
+    '''Reads the archived and the active conversations into one table, with the archived messages first'''
+    return combine_tiers(read_conversations(archive_path(conversations_file)), read_conversations(conversations_file))
+
+
+def combine_tiers(archived, active):
+    '''
+    Combines the archived and active messages, keeping one copy of each message (like the store's index does). A crash
+    while archiving can leave a message in both files, and older conversations files can have duplicated rows.
+    '''
+    combined = active if len(archived) == 0 else pd.concat([archived, active], ignore_index=True)
+    return drop_duplicate_messages(combined).reset_index(drop=True)
+
+
+def hash_messages(df):
+    '''
+    Returns a uint64 key for each row of df, computed over all of the message columns.
+    Missing values are treated as empty strings, since that is how they round-trip through the CSV.
+    '''
+    keyed = df[COLUMNS].fillna('').astype(str)
+    return pd.util.hash_pandas_object(keyed, index=False).to_numpy()
+
+
+def user_ranges(df, last_message_type=None):
+    '''
+    Finds each user's messages in a table of messages, without copying it. Returns (order, starts, ends): order is the
+    row positions of the table stable-sorted by user_id (so each user's messages stay in their original order), and
+    user i's messages are the rows at order[starts[i]:ends[i]]. Rows without a user_id are left out.
+
+    If last_message_type is given, then only the users whose last message has that type are included.
+    '''
+    user_ids = df.user_id.to_numpy()
+    order = np.flatnonzero(pd.notna(user_ids))
+    if len(order) == 0:
+        return order, order, order
+    order = order[np.argsort(user_ids[order], kind='stable')]
+    sorted_ids = user_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    if last_message_type is not None:
+        is_match = df.message_type.to_numpy()[order[ends - 1]] == last_message_type
+        starts, ends = starts[is_match], ends[is_match]
+    return order, starts, ends
+
+
+def split_by_user(df, last_message_type=None):
+    '''
+    Groups a table of messages into per-user slices in a single pass (see user_ranges). Yields (user_id, slice) pairs.
+    Works with any table that has a user_id column (e.g., augmented conversations).
+    '''
+    order, starts, ends = user_ranges(df, last_message_type)
+    df = df.iloc[order]
+    user_ids = df.user_id.to_numpy()
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield user_ids[start], df.iloc[start:end]
+
+
+class ConversationStore:
+
+    def __init__(self, conversations_file):
+        self.conversations_file = conversations_file
+        self.archive_file = archive_path(conversations_file)
+        self.archive_keys_file = archive_keys_path(conversations_file)
+        self.index_file = index_path(conversations_file)
+        # Read when it's first needed
+        self._frame = None
+        self._pending = []
+        try:
+            self._archived_keys = np.load(self.archive_keys_file)
+        except FileNotFoundError:
+            self._archived_keys = np.array([], dtype=np.uint64)
+        # The sorted keys of the messages stored before this run, and a set of the ones appended since
+        self._stored_keys = np.union1d(self.load_index(), self._archived_keys)
+        self._new_keys = set()
+
+    def load_index(self):
+        '''
+        Returns the keys of the messages in the conversations file, from the sidecar. The rows that were appended
+        after the sidecar was saved are hashed and added to it. If the file was rewritten, the index is rebuilt.
+        '''
+        try:
+            size = os.path.getsize(self.conversations_file)
+        except FileNotFoundError:
+            return np.array([], dtype=np.uint64)
+        keys, offset, end = np.array([], dtype=np.uint64), 0, b''
+        try:
+            with np.load(self.index_file) as saved:
+                keys, offset, end = saved['keys'], int(saved['offset']), saved['end'].tobytes()
+        except FileNotFoundError:
+            pass
+        if offset > 0 and (size < offset or self.read_bytes(offset - len(end), len(end)) != end):
+            logging.warning(f"{self.conversations_file} has changed since it was indexed. Rebuilding the index.")
+            keys, offset = np.array([], dtype=np.uint64), 0
+        if size > offset:
+            keys = np.union1d(keys, hash_messages(self.read_from(offset)))
+            self.save_index(keys)
+        return keys
+
+    def read_bytes(self, start, n):
+        with open(self.conversations_file, 'rb') as f:
+            f.seek(start)
+            return f.read(n)
+
+    def read_from(self, offset):
+        '''Reads the rows of the conversations file that start at or after the byte offset'''
+        if offset == 0:
+            return read_conversations(self.conversations_file)
+        with open(self.conversations_file, 'rb') as f:
+            header = f.readline()
+            f.seek(max(offset, len(header)))
+            data = f.read()
+        return pd.read_csv(io.BytesIO(header + data), dtype=DTYPES)
+
+    def save_index(self, keys):
+        '''Saves the keys of the messages in the conversations file, with the size of the file they cover'''
+        size = os.path.getsize(self.conversations_file)
+        # The last bytes that were indexed, to notice if the file was replaced by a different one
+        end = np.frombuffer(self.read_bytes(max(size - 64, 0), 64), dtype=np.uint8)
+        with open(self.index_file + '.tmp', 'wb') as f:
+            np.savez(f, keys=keys, offset=size, end=end)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def __len__(self):
+        '''The number of distinct messages stored, including the archived ones'''
+        return len(self._stored_keys) + len(self._new_keys)
+
+    def __contains__(self, message):
+        return self.is_stored([message])[0]
+
+    def is_stored(self, messages):
+        '''Returns a list of booleans; whether each message is already in the store'''
+        if len(messages) == 0:
+            return []
+        keys = hash_messages(pd.DataFrame(messages, columns=COLUMNS))
+        return [is_stored or key in self._new_keys for key, is_stored in zip(keys.tolist(), self.in_stored_keys(keys))]
+
+    def in_stored_keys(self, keys):
+        '''Returns a boolean array; whether each key was stored before this run'''
+        if len(self._stored_keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(self._stored_keys, keys).clip(max=len(self._stored_keys) - 1)
+        return self._stored_keys[positions] == keys
+
+    @property
+    def frame(self):
+        '''The full conversations table. Appended messages are only concatenated when this is requested.'''
+        if self._frame is None:
+            self._frame = read_conversations(self.conversations_file)
+            self._pending = []
+        if self._pending:
+            self._frame = pd.concat([self._frame] + self._pending, ignore_index=True)
+            self._pending = []
+        return self._frame
+
+    def for_users(self, user_ids, archived_user_ids=()):
+        '''Returns the messages for the given users. The archive is only read for the users in archived_user_ids.'''
+        frame = self.frame
+        active = frame[frame.user_id.isin([str(user_id) for user_id in user_ids])]
+        if len(archived_user_ids) == 0:
+            return active
+        archived = read_conversations(self.archive_file)
+        archived = archived[archived.user_id.isin([str(user_id) for user_id in archived_user_ids])]
+        return pd.concat([archived, active], ignore_index=True)
+
+    def read_all(self):
+        return combine_tiers(read_conversations(self.archive_file), self.frame)
+
+    def active_users(self):
+        '''The users who have messages in the conversations file (i.e., that haven't been archived)'''
+        return set(self.frame.user_id.dropna())
+
+    def archived_users(self):
+        '''The users who have messages in the archive. This reads the archive.'''
+        return set(read_conversations(self.archive_file).user_id.dropna())
+
+    def archive(self, user_ids):
+        '''Moves all of the messages for user_ids from the conversations file to the archive'''
+        frame = self.frame
+        is_archived = frame.user_id.isin([str(user_id) for user_id in user_ids]).to_numpy()
+        if not is_archived.any():
+            return
+        archived = frame[is_archived]
+        # Write the archive (and its keys) before removing anything from the conversations file
+        archived.to_csv(self.archive_file, mode='a', header=not os.path.isfile(self.archive_file), index=False)
+        self._archived_keys = np.union1d(self._archived_keys, hash_messages(archived))
+        with open(self.archive_keys_file + '.tmp', 'wb') as f:
+            np.save(f, self._archived_keys)
+        os.replace(self.archive_keys_file + '.tmp', self.archive_keys_file)
+        self._frame = frame[~is_archived].reset_index(drop=True)
+        self._frame.to_csv(self.conversations_file + '.tmp', index=False)
+        os.replace(self.conversations_file + '.tmp', self.conversations_file)
+        self.save_index(np.unique(hash_messages(self._frame)))
+
+    def append(self, messages):
+        '''
+        Takes in a list of Message objects. Appends those that aren't already stored to the conversations
+        file and returns them as a dataframe.
+        '''
+        if len(messages) == 0:
+            return pd.DataFrame(columns=COLUMNS)
+        new_messages = pd.DataFrame(messages, columns=COLUMNS)
+        # New participants get uuid objects as ids; store them as strings like the rest of the table
+        new_messages['user_id'] = new_messages.user_id.astype(str)
+        keys = hash_messages(new_messages)
+        keep = []
+        for key, is_stored in zip(keys.tolist(), self.in_stored_keys(keys)):
+            is_new = not is_stored and key not in self._new_keys
+            keep.append(is_new)
+            if is_new:
+                self._new_keys.add(key)
+        new_messages = new_messages[keep]
+        if len(new_messages) == 0:
+            return new_messages
+
+        if not os.path.isfile(self.conversations_file):
+            new_messages.to_csv(self.conversations_file, index=False)
+        else:
+            new_messages.to_csv(self.conversations_file, mode='a', header=False, index=False)
+        # If the table hasn't been read yet, it will include these when it is
+        if self._frame is not None:
+            self._pending.append(new_messages)
+        return new_messages
@@ -0,0 +1,37 @@
+import os
+import csv
+
+######
+# Rolling summaries of long conversations. For each user we store the summary text and how many of their
+# messages it covers. The file is append-only; when a summary is updated, the new row replaces the old one
+# the next time the file is loaded.
+######
+
+HEADER = ['user_id', 'n_messages', 'summary']
+
+
+class SummaryStore:
+
+    def __init__(self, summaries_file):
+        self.summaries_file = summaries_file
+        self.summaries = dict()
+        try:
+            with open(summaries_file, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    self.summaries[row['user_id']] = (row['summary'], int(row['n_messages']))
+        except FileNotFoundError:
+            pass
+
+    def get(self, user_id):
+        '''Returns (summary, n_messages) for the user, or None if we haven't summarized their conversation'''
+        return self.summaries.get(str(user_id))
+
+    def set(self, user_id, summary, n_messages):
+        user_id = str(user_id)
+        self.summaries[user_id] = (summary, n_messages)
+        is_new_file = not os.path.isfile(self.summaries_file)
+        with open(self.summaries_file, 'a', newline='') as f:
+            out = csv.writer(f)
+            if is_new_file:
+                out.writerow(HEADER)
+            out.writerow([user_id, n_messages, summary])
@@ -0,0 +1,82 @@
+import os
+import json
+
+######
+# The set of accounts that we shouldn't contact or reply to: bad accounts (users who declined, blocked us, or
+# don't exist) and, depending on the script, users who were already contacted. Keys are usernames and user ids,
+# and checking a key is a set lookup.
+#
+# Bad accounts are persisted. The file itself is a JSON list (the format the chatbot has always used), and new
+# accounts are appended to a log next to it (<file>.log, one key per line) instead of rewriting the list every
+# time. Once the log gets long, it is folded back into the JSON list.
+######
+
+
+class ExclusionRegistry:
+
+    def __init__(self, registry_file, compact_every=1000):
+        self.registry_file = registry_file
+        self.log_file = registry_file + '.log'
+        self.compact_every = compact_every
+        self.log_length = 0
+        # What's in the files, and everything we exclude (which also includes keys added with update())
+        self.persisted = set(self.read_keys())
+        self.excluded = set(self.persisted)
+
+    def read_keys(self):
+        '''Yields the keys in the JSON list and then the ones in the log'''
+        try:
+            with open(self.registry_file, 'r') as f:
+                yield from (str(key) for key in json.load(f))
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self.log_file, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        self.log_length += 1
+                        yield line.strip()
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, key):
+        return str(key) in self.excluded
+
+    def __len__(self):
+        return len(self.excluded)
+
+    def isin(self, series):
+        '''Returns a boolean mask of the values in a pandas Series that are excluded'''
+        return series.astype(str).isin(self.excluded)
+
+    def update(self, keys):
+        '''Excludes keys for this run only, without writing them to the file (e.g., users that another file already tells us about)'''
+        self.excluded.update(str(key) for key in keys)
+
+    def add(self, *keys):
+        '''Excludes keys and appends them to the log'''
+        new_keys = [str(key) for key in keys if str(key) not in self.persisted]
+        if len(new_keys) == 0:
+            return
+        self.persisted.update(new_keys)
+        self.excluded.update(new_keys)
+        self.write_keys(new_keys)
+
+    def write_keys(self, keys):
+        with open(self.log_file, 'a') as f:
+            for key in keys:
+                f.write(key + '\n')
+        self.log_length += len(keys)
+        if self.log_length >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        '''Rewrites the JSON list with everything in the log, and then empties the log'''
+        tmp_file = self.registry_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(sorted(self.persisted), f)
+        os.replace(tmp_file, self.registry_file)
+        # If we crash before this, the log is just read again; the keys are already in the list
+        if os.path.isfile(self.log_file):
+            os.remove(self.log_file)
+        self.log_length = 0
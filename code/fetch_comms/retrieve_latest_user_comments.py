@@ -1,5 +1,6 @@
 import praw
 import csv
+import sys
 import auth
 import datetime
 from tqdm import tqdm
@@ -7,15 +8,21 @@ import pandas as pd
 import os
 import json
 from prawcore.exceptions import NotFound, TooManyRequests, Forbidden
-import time
 import logging
 import argparse
+# The rate-limit scheduler and the conversation store are shared with the scripts in code/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from reddit_scheduler import RequestScheduler, connect
+from conversation_store import read_all_conversations
 
 parser = argparse.ArgumentParser()
 parser.add_argument( '-log',
                      '--loglevel',
                      default='warning',
                      help='Provide logging level. Example --loglevel debug, default=warning' )
+parser.add_argument('--rate-limit-file',
+                    default='./data/reddit_rate_limit.json',
+                    help='File with the reddit rate-limit budget, shared with the chatbot (its reddit_rate_limit_file)')
 
 args = parser.parse_args()
 
@@ -31,7 +38,7 @@ def get_unames(conversations_fn,
                unconsented_prop = .2):
 
     # Get the consented users (we'll get comments for all of them)
-    df = pd.read_csv(conversations_fn)
+    df = read_all_conversations(conversations_fn)
     df = df.loc[(pd.notna(df.subreddit)) & (df.subreddit != 'survey_invite_testing'), :]
     consented_ids = df.loc[df.message_type == 'handoff', 'user_id']
 
@@ -77,7 +84,7 @@ def get_unames(conversations_fn,
     return usernames
 
 
-def fetch_all_comments(usernames, reddit, out_f, suspended_f):
+def fetch_all_comments(usernames, reddit, out_f, suspended_f, scheduler):
     try:
         df = pd.read_csv(out_f)
         #df = df.groupby('author_id')['created_utc']
@@ -113,7 +120,7 @@ def fetch_all_comments(usernames, reddit, out_f, suspended_f):
             print(f"{user.name} messages are forbidden")
             continue
         except TooManyRequests:
-            time.sleep(60)
+            scheduler.hit_limit()
         add_status(user_id, 'exists', suspended_f)
         if user_id in df.author_id.unique():
             last_retrieved_time = df.loc[df.author_id == user_id, 'created_utc'].max()
@@ -142,13 +149,9 @@ def fetch_all_comments(usernames, reddit, out_f, suspended_f):
                     'author_id': user_id
                 })
             except TooManyRequests:
-                time.sleep(60)
+                scheduler.hit_limit()
         logging.info(f"Adding {len(curr_comments)} comments for {username}")
         write_comments(out_f, curr_comments)
-        if len(curr_comments) > 50:
-            time.sleep(3)
-        else:
-            time.sleep(2)
 
 def clean_text(s):
     s = s.strip()
@@ -181,7 +184,9 @@ def add_status(user, status, suspended_file):
                       ])
 
 if __name__ == "__main__":
-    reddit = praw.Reddit(
+    # Requests are paced by the scheduler, which spreads the rate limit evenly over each window
+    scheduler = RequestScheduler(args.rate_limit_file)
+    reddit = connect(scheduler,
         client_id=auth.client_id,
         client_secret=auth.client_secret,
         username = auth.username,
@@ -201,4 +206,4 @@ if __name__ == "__main__":
     usernames = get_unames(conversations_fn=conversations_file,
                             participants_fn=username_file,
                             unconsented_sample_fn=unconsented_sample)
-    fetch_all_comments(usernames, reddit, out_f = output_file, suspended_f=suspended_file)
\ No newline at end of file
+    fetch_all_comments(usernames, reddit, out_f = output_file, suspended_f=suspended_file, scheduler=scheduler)
\ No newline at end of file
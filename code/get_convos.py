@@ -1,30 +1,33 @@
 import pandas as pd
 import datetime
+from conversation_store import split_by_user, read_all_conversations
 
 OUT_FILE = '../data/filtered_convos.csv'
 
 # Open config file
-import yaml
-# Open and read the YAML file
-with open('shared_config.yaml', 'r') as file:
-    config = yaml.safe_load(file)
+from config_loader import load_config
+config = load_config('shared_config.yaml')
 
-df = pd.read_csv(config['conversations_file'])
+# Includes the conversations that the chatbot has archived
+df = read_all_conversations(config['conversations_file'])
 
 df = df.sort_values('created_utc')
 
 df['combined_text'] = '\n' + df.message_type + ':\n' + df.text
 
-agg_df = df.groupby('user_id').agg(
-    conversation = ('combined_text', lambda x: '\n'.join(x)),
-    first_message = ('created_utc', lambda x: datetime.datetime.fromtimestamp(x.min())),
-    subreddit = ('subreddit', 'first')
-)
+def summarize_user(user_id, g):
+    subreddits = g.subreddit.dropna()
+    return {'user_id': user_id,
+            'conversation': '\n'.join(g.combined_text.dropna()),
+            'first_message': datetime.datetime.fromtimestamp(g.created_utc.min()),
+            'subreddit': subreddits.iloc[0] if len(subreddits) > 0 else None}
+
+agg_df = pd.DataFrame([summarize_user(user_id, g) for user_id, g in split_by_user(df)])
 
 agg_df = agg_df[agg_df.conversation.str.contains('AI_reply:')]
 agg_df = agg_df[agg_df.subreddit != 'survey_invite_testing']
 
-agg_df = agg_df.sort_values('first_message').reset_index()
+agg_df = agg_df.sort_values('first_message').reset_index(drop=True)
 
 participants_df = pd.read_csv('../data/participants.csv')
 
@@ -5,6 +5,10 @@ import glob
 from pandas.errors import EmptyDataError
 import uuid
 import numpy as np
+from exclusion_registry import ExclusionRegistry
+from config_loader import load_config
+
+config = load_config('shared_config.yaml')
 
 
 modlogs_dir = '../data/modlogs/'
@@ -30,11 +34,13 @@ def filter_actions(mod_dir, contacted):
         # Filter out the NAs (TODO: figure out why they are there)
         curr_df = curr_df[curr_df.moderation_details == 'remove']
         # Filter out those already contacted
-        curr_df = curr_df[~curr_df.target_author.isin(contacted)]
+        curr_df = curr_df[~contacted.isin(curr_df.target_author)]
         dfs.append(curr_df)
     return pd.concat(dfs, axis=0, ignore_index=True)
 
-contacted = pd.read_csv('../data/to_contact.csv').author
+# Everyone get_toxic_moderated_comments.py has queued to contact, plus the bad accounts
+contacted = ExclusionRegistry(config['bad_accounts_file'])
+contacted.update(ExclusionRegistry(config['queued_users_file']).persisted)
 
 df = filter_actions(modlogs_dir, contacted)
 #%%
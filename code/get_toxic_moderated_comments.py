@@ -1,23 +1,22 @@
 #%%
-import praw
-import csv
-from perspective import PerspectiveAPI
 import auth
 import sys
-import time
-import pandas as pd
 import os
 import logging
-import re
+from itertools import tee
+from exclusion_registry import ExclusionRegistry
+from contact_queue import ContactLog
+from reddit_scheduler import RequestScheduler, connect
+from toxicity_prefilter import ToxicityPrefilter
 
 # Open config file
-import yaml
-# Open and read the YAML file
-with open('shared_config.yaml', 'r') as file:
-    config = yaml.safe_load(file)
+from config_loader import load_config
+config = load_config('shared_config.yaml')
 
-# Set up globals
-reddit = praw.Reddit(
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Set up globals. Requests are paced by the rate-limit budget that we share with the chatbot.
+reddit = connect(RequestScheduler(os.path.join(script_dir, config['reddit_rate_limit_file'])),
         client_id = auth.client_id,
         client_secret = auth.client_secret,
         user_agent = auth.u_agent,
@@ -25,81 +24,83 @@ reddit = praw.Reddit(
         password = auth.password
 )
 #%%
-p = PerspectiveAPI(auth.perspective_api_key)
-CLASSIFIERS = ["TOXICITY", "SEVERE_TOXICITY"]
-
-# Regex to remove quoted text
-remove_pattern = re.compile(r'^>.*\n', re.MULTILINE)
+# The Perspective scoring engine is shared with the scripts in augment_data/
+sys.path.append(os.path.join(script_dir, 'augment_data'))
+from get_toxicity import ScoringEngine, make_scorer
+model_file = config.get('local_model_file')
+scorer = make_scorer(config.get('scorer', 'perspective'),
+                     model_file=os.path.join(script_dir, model_file) if model_file else None,
+                     qps=config.get('perspective_qps', 1),
+                     api_key=auth.perspective_api_key)
+engine = ScoringEngine(scorer, cache_file=os.path.join(script_dir, config['score_cache_file']))
+# Rejects the removals that obviously aren't toxic before they're scored
+prefilter = ToxicityPrefilter(config.get('toxicity_prefilter'), base_dir=script_dir)
 
 subreddits = ['creepypms', 'socialskills', 'india', 'unitedstatesofindia', 'aww', 'tifu','futurology']
 
-script_dir = os.path.dirname(os.path.abspath(__file__))
-to_contact_file = os.path.join(script_dir, config['to_contact_file'])
-contacted = pd.read_csv(to_contact_file)
+contact_log = ContactLog(os.path.join(script_dir, config['to_contact_file']))
+# Everyone we've added to the to_contact file. (It's separate from the bad accounts, which the chatbot also
+# excludes, so it can't hold the users the chatbot still has to contact.)
+queued = ExclusionRegistry(os.path.join(script_dir, config['queued_users_file']))
+# The users who were added to the to_contact file before queued_users_file existed; afterwards this adds nothing
+queued.add(*contact_log.authors)
+# Skip anyone we've already queued or is a bad account
+exclusions = ExclusionRegistry(os.path.join(script_dir, config['bad_accounts_file']))
+exclusions.update(queued.persisted)
+
+
+def get_removals(subreddit, last_contacted, limit):
+    '''Yields the comment removals from the mod log that are newer than last_contacted, skipping excluded authors'''
+    for log in reddit.subreddit(subreddit).mod.log(limit=limit):
+        # Ignore all moderation actions except for comment removals
+        if log.action != "removecomment":
+            continue
+
+        # If this is earlier than a previous contact then break
+        if log.created_utc <= last_contacted:
+            logging.info('Earlier than last existing. Stopping')
+            return
+
+        if log.target_author in exclusions:
+            continue
+        yield log
 
-# Set up writer
-out_file =  os.path.join(script_dir, '../tox_users_to_contact.csv')
-f = open(out_file, 'w')
-writer = csv.writer(f)
-writer.writerow(['author','subreddit', 'toxic_comments', 'timestamp', 'moderator', 'tox_score'])
+
+def is_candidate(tox_score, moderator):
+    '''Whether a removed comment is toxic enough to contact its author'''
+    if tox_score is None:
+        return False
+    if moderator == "AutoModerator" or moderator == "reddit":
+        return tox_score >= .85
+    return tox_score >= .7
 
 
 def get_toxic_comments(subreddit, max_comments = 20, limit = 100):
     comment_count = 0
-    try:
-        last_contacted = max(contacted.loc[(contacted.subreddit==subreddit) & (pd.notna(contacted.timestamp)), 'timestamp'])
-    except ValueError:
-        last_contacted = 0
-    for log in reddit.subreddit(subreddit).mod.log(limit=limit):
+    last_contacted = contact_log.last_timestamp(subreddit)
+    # Get Perspective scores for the removals that pass the prefilter (and the ones it samples for its audit).
+    # The removals are scored in batches, and the scores come back in order.
+    removals, to_score = tee(prefilter.select(subreddit, get_removals(subreddit, last_contacted, limit),
+                                              text=lambda log: log.target_body))
+    for (log, passed), (tox_score, severe_tox_score) in zip(removals, engine.score(log.target_body for log, _ in to_score)):
         # Load relevant items
-        action = log.action
         moderator = log.mod
         target_body = log.target_body
         target_author = log.target_author
         timestamp = log.created_utc
-        details = log.details
-
-
-        # Ignore all moderation actions except for comment removals
-        if action != "removecomment":
-            continue
-
 
-        # If this is earlier than a previous contact then break
-        if timestamp <= last_contacted:
-            logging.info('Earlier than last existing. Stopping')
-            break
-
-        # Get Perspective scores
-        score_map = get_toxicity_scores(target_body)
-        if not score_map:
-            continue
-        tox_score = score_map['TOXICITY']
-        severe_tox_score = score_map['SEVERE_TOXICITY']
-        if moderator == "AutoModerator" or moderator == "reddit":
-            if tox_score < .85:
-                continue
-        if tox_score < .7:
+        prefilter.record(subreddit, passed, is_candidate(tox_score, moderator))
+        # An author can be read ahead more than once before we add them below
+        if target_author in exclusions or not is_candidate(tox_score, moderator):
             continue
 
-        writer.writerow([target_author, subreddit, target_body, timestamp, moderator, tox_score])
+        contact_log.add(target_author, subreddit, target_body, timestamp, moderator, tox_score)
+        queued.add(target_author)
+        exclusions.update([target_author])
         comment_count += 1
         if comment_count == max_comments:
             break
-        time.sleep(.01)
-
 
-def get_toxicity_scores(orig_text):
-    # Strip out quoted text
-    text = remove_pattern.sub('', orig_text)
-    if text != orig_text:
-        logging.info(f"{orig_text} changed to {text}")    
-    try:
-        score_map = p.score(text, tests=CLASSIFIERS)
-    except Exception as e:
-        logging.info(f"Received exception {e}")
-        score_map = None
-    return score_map
 
 # alternative function using keywords
 def get_users_by_keywords(subreddits, keywords, reddit, *kargs):
@@ -167,10 +168,7 @@ def get_users_by_keywords(subreddits, keywords, reddit, *kargs):
 def main():
     for s in subreddits:
         get_toxic_comments(s, max_comments=80, limit=None)
-    f.close()
-    new_to_contact = pd.read_csv(out_file)
-    combined_file = pd.concat([contacted, new_to_contact], ignore_index=True)
-    combined_file.to_csv(to_contact_file, index=False)
+    print(prefilter.report())
     
 
 
@@ -1,10 +1,10 @@
-import praw
 import invite_config
 import random
 import logging
 from prawcore.exceptions import Forbidden
 from prawcore.exceptions import NotFound
 from praw.exceptions import RedditAPIException
+from reddit_scheduler import RequestScheduler, connect
 
 
 max_size = 8000000000
@@ -44,7 +44,8 @@ Jeremy'''
 
 
 def main():
-    reddit = praw.Reddit(
+    # The invitations are sent from their own account, so the rate limit isn't shared with the other scripts
+    reddit = connect(RequestScheduler(),
         client_id=invite_config.client_id,
         client_secret=invite_config.client_secret,
         user_agent=invite_config.u_agent,
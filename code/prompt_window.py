@@ -0,0 +1,57 @@
+import math
+import functools
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+######
+# Figures out how much of a conversation fits in a model's prompt budget. Token counts come from the model's
+# tokenizer (if tiktoken is installed) and are cached per message text, so a long conversation is only
+# tokenized once even though we build a prompt from it every time the user replies.
+######
+
+# Each chat message has a few tokens of overhead for the role and separators
+TOKENS_PER_MESSAGE = 4
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+@functools.lru_cache(maxsize=2**16)
+def count_tokens(text, model):
+    '''Counts the tokens in text for the model. Without tiktoken, falls back to about 4 tokens per 3 words.'''
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text.split()) * 4 / 3)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model):
+    '''Counts the tokens in a list of chat messages (dictionaries with a 'content' key)'''
+    return sum(count_tokens(message['content'], model) + TOKENS_PER_MESSAGE for message in messages)
+
+
+def window_start(system_prompt, texts, max_tokens, model):
+    '''
+    Returns the index of the first text to keep so that the system prompt plus texts[start:] fit in max_tokens.
+    This is the largest suffix of the conversation that fits, found with a single pass from the end.
+    If not even the last text fits, returns len(texts).
+    '''
+    budget = max_tokens - count_tokens(system_prompt, model) - TOKENS_PER_MESSAGE
+    start = len(texts)
+    total = 0
+    for i in range(len(texts) - 1, -1, -1):
+        total += count_tokens(texts[i], model) + TOKENS_PER_MESSAGE
+        if total > budget:
+            break
+        start = i
+    return start
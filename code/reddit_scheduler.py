@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+import praw
+from prawcore import Requestor
+
+######
+# Paces requests to reddit so that the rate limit is spent evenly over each window. Every response from reddit
+# says how many requests are left (X-Ratelimit-Remaining) and how many seconds until the window resets
+# (X-Ratelimit-Reset); before each request we wait (seconds until reset) / (requests left) after the previous one.
+#
+# The budget belongs to the account, not to the script, so the scheduler can keep its state in a file that is
+# shared by every script using the same account (the chatbot, the comment fetcher, the modlog collector). The
+# file is locked while a request takes its slot, so two scripts running at once share the spacing instead of
+# each spending the whole budget. Without a file, it only paces the requests of one process.
+#
+# prawcore has its own rate limiter, which already spaces a script's requests by the headers of its last response.
+# So while those headers say there are requests left, ScheduledRequestor only records its request in the shared
+# state (so the other scripts space themselves around it) and doesn't wait for its slot as well. It waits when it
+# hasn't heard from reddit yet, or when the budget has run out (e.g., another script hit the limit).
+#
+# Usage:
+#     reddit = connect(RequestScheduler('../data/reddit_rate_limit.json'), client_id=..., ...)
+######
+
+
+def read_budget(headers):
+    '''Returns (requests left, reset timestamp, when we heard) from a response's rate-limit headers, or None'''
+    if 'x-ratelimit-remaining' not in headers:
+        return None
+    now = time.time()
+    return (float(headers['x-ratelimit-remaining']), now + float(headers['x-ratelimit-reset']), now)
+
+
+class RequestScheduler:
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.state = {'remaining': None, 'reset_timestamp': None, 'next_request': 0, 'updated': 0}
+
+    @contextmanager
+    def shared_state(self):
+        '''Yields the state; if there is a state file, it is read and then written back while holding a lock on it'''
+        if self.state_file is None:
+            yield self.state
+            return
+        with open(self.state_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    self.state.update(json.loads(f.read()))
+                except ValueError:
+                    # A new (empty) file
+                    pass
+                yield self.state
+                f.seek(0)
+                f.truncate()
+                json.dump(self.state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def apply_budget(state, budget):
+        '''Updates the state from a budget (see read_budget), unless another script has heard from reddit since'''
+        if budget is None:
+            return
+        remaining, reset_timestamp, updated = budget
+        if updated > state.get('updated', 0):
+            state['remaining'], state['reset_timestamp'], state['updated'] = remaining, reset_timestamp, updated
+
+    def reserve(self, budget=None, paced=False):
+        '''
+        Takes the next request slot and returns its time. budget is from our last response, if we want to record it
+        in the same lock. If paced is True, the request is already spaced by prawcore, so while there are requests
+        left the slot is now; it's still counted against the budget, and moves the next slot along.
+        '''
+        with self.shared_state() as state:
+            self.apply_budget(state, budget)
+            now = time.time()
+            slot = max(now, state['next_request'])
+            remaining, reset_timestamp = state['remaining'], state['reset_timestamp']
+            if remaining is None or reset_timestamp is None or reset_timestamp <= slot:
+                # We haven't heard from reddit yet, or the window has reset since we last did
+                state['next_request'] = slot
+                return slot
+            if remaining < 1:
+                state['next_request'] = reset_timestamp
+                return reset_timestamp
+            interval = (reset_timestamp - slot) / remaining
+            # Count this request against the budget until reddit's response tells us the real number
+            state['remaining'] = remaining - 1
+            state['next_request'] = slot + interval
+            return now if paced else slot
+
+    def wait(self, budget=None, paced=False):
+        '''Waits until it's our turn to make a request'''
+        wait = self.reserve(budget, paced) - time.time()
+        if wait > 0:
+            logging.debug(f"Waiting {wait:.2f} seconds for the reddit rate limit")
+            time.sleep(wait)
+
+    def update(self, headers):
+        '''Updates the budget from the rate-limit headers of a response'''
+        budget = read_budget(headers)
+        if budget is None:
+            return
+        with self.shared_state() as state:
+            self.apply_budget(state, budget)
+
+    def hit_limit(self, default_seconds=60):
+        '''For when reddit says we've made too many requests: nothing more is sent until the window resets'''
+        with self.shared_state() as state:
+            state['remaining'] = 0
+            state['updated'] = time.time()
+            if state['reset_timestamp'] is None or state['reset_timestamp'] <= time.time():
+                state['reset_timestamp'] = time.time() + default_seconds
+
+
+class ScheduledRequestor(Requestor):
+    '''
+    A prawcore requestor that takes a slot from the scheduler before every request. The budget from each response is
+    written to the shared state when the next request takes its slot, so each request only locks the state once.
+    '''
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.budget = None
+
+    def request(self, *args, **kwargs):
+        # While reddit's last response says there are requests left, prawcore is already spacing them out
+        paced = self.budget is not None and self.budget[0] >= 1 and self.budget[1] > time.time()
+        self.scheduler.wait(self.budget, paced)
+        response = super().request(*args, **kwargs)
+        self.budget = read_budget(response.headers) or self.budget
+        return response
+
+
+def connect(scheduler=None, **kwargs):
+    '''Returns a praw.Reddit (created with kwargs) whose requests are paced by scheduler'''
+    return praw.Reddit(requestor_class=ScheduledRequestor, requestor_kwargs={'scheduler': scheduler}, **kwargs)
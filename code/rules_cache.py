@@ -0,0 +1,104 @@
+import os
+import csv
+import time
+import logging
+import threading
+
+######
+# A cache of subreddit rules. The rules are kept in a dictionary and persisted to the subreddits file
+# (subreddit, rules, fetched_utc). Entries older than the TTL are fetched again the next time they're used.
+# The whole file is rewritten from the dictionary, so there is only ever one row per subreddit.
+#
+# If getting a subreddit's rules fails, we keep using its stale rules (or '') and don't try again for
+# retry_seconds, so a reddit outage doesn't cost a request for every reply, but a long-running daemon still
+# gets the rules once reddit is back.
+######
+
+HEADER = ['subreddit', 'rules', 'fetched_utc']
+
+
+class RulesCache:
+
+    def __init__(self, subreddits_file, fetch_rules, ttl_seconds=None, retry_seconds=600):
+        '''
+        fetch_rules is a function that takes a subreddit name and returns its rules as a string.
+        If ttl_seconds is None, then rules are never refreshed once we have them.
+        '''
+        self.subreddits_file = subreddits_file
+        self.fetch_rules = fetch_rules
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = retry_seconds
+        # Subreddit -> when getting its rules last failed
+        self.failed = dict()
+        self.lock = threading.Lock()
+        self.rules = self.read()
+
+    def read(self):
+        '''Returns the stored rules as a dictionary of subreddit -> (rules, fetched_utc)'''
+        rules = dict()
+        try:
+            with open(self.subreddits_file, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    # Files written before we tracked fetch times are treated as stale
+                    rules[row['subreddit']] = (row['rules'], float(row.get('fetched_utc') or 0))
+        except FileNotFoundError:
+            pass
+        return rules
+
+    def is_fresh(self, subreddit):
+        if subreddit not in self.rules:
+            return False
+        if self.ttl_seconds is None:
+            return True
+        return time.time() - self.rules[subreddit][1] < self.ttl_seconds
+
+    def recently_failed(self, subreddit):
+        return subreddit in self.failed and time.time() - self.failed[subreddit] < self.retry_seconds
+
+    def needs_fetch(self, subreddit):
+        return not self.is_fresh(subreddit) and not self.recently_failed(subreddit)
+
+    def get(self, subreddit):
+        '''Returns the rules for the subreddit, fetching them if they're missing or stale. Returns '' if we can't get them.'''
+        return self.entry(subreddit)[0]
+
+    def entry(self, subreddit):
+        '''
+        Like get(), but returns (rules, fetched_utc). The fetch time changes whenever the rules are fetched again,
+        so it can be used to tell whether something built from the rules is out of date.
+        '''
+        if self.needs_fetch(subreddit):
+            with self.lock:
+                # Someone else may have fetched them while we were waiting
+                if self.needs_fetch(subreddit):
+                    self.fetch(subreddit)
+                    self.save()
+        return self.rules.get(subreddit, ('', 0))
+
+    def fetch(self, subreddit):
+        try:
+            self.rules[subreddit] = (self.fetch_rules(subreddit), time.time())
+            self.failed.pop(subreddit, None)
+        except Exception as e:
+            logging.error(e)
+            logging.error(f"Error getting sub rules for {subreddit}")
+            # Keep the stale rules if we have them, and don't try again for a while
+            self.failed[subreddit] = time.time()
+
+    def prefetch(self, subreddits):
+        '''Fetches the rules for all of the subreddits that are missing or stale, and saves the file once'''
+        with self.lock:
+            to_fetch = [sr for sr in set(subreddits) if isinstance(sr, str) and self.needs_fetch(sr)]
+            for sr in to_fetch:
+                self.fetch(sr)
+            if len(to_fetch) > 0:
+                self.save()
+
+    def save(self):
+        tmp_file = self.subreddits_file + '.tmp'
+        with open(tmp_file, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(HEADER)
+            for subreddit, (rules, fetched_utc) in self.rules.items():
+                out.writerow([subreddit, rules, fetched_utc])
+        os.replace(tmp_file, self.subreddits_file)
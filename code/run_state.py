@@ -0,0 +1,31 @@
+import os
+import json
+
+######
+# A small JSON file for values that need to survive between runs of the chatbot, like how far we've
+# read in the modmail and the inbox.
+######
+
+
+class RunState:
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        try:
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = dict()
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        self.state[key] = value
+
+    def save(self):
+        '''Writes the state to a temporary file and then moves it into place, so a crash can't leave a partial file'''
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_file, self.state_file)
@@ -0,0 +1,115 @@
+import time
+import random
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from praw.exceptions import RedditAPIException
+from prawcore.exceptions import TooManyRequests, ServerError, RequestException
+
+######
+# A queue for outgoing messages. Messages are sent in order of their priority class (replies to people who
+# are already chatting first, then the consent flow, then new contacts). The requests themselves are paced by
+# the reddit scheduler (see reddit_scheduler.py). Sends that fail with a rate-limit or server error are retried
+# with jittered exponential backoff, and the time each message waited in the queue is recorded per class.
+#
+# Usage:
+#     queue = SendQueue()
+#     queue.put('AI_reply', lambda: send_reply(...), on_result=lambda sent: ...)
+#     queue.run()
+######
+
+# Lower is sent first
+PRIORITY_CLASSES = {'AI_reply': 0,
+                    'handoff': 1,
+                    'first_consented_message': 1,
+                    'clarifying': 1,
+                    'initial': 2}
+
+
+def is_transient(exception):
+    '''Whether a send that raised this exception is worth trying again'''
+    if isinstance(exception, (TooManyRequests, ServerError, RequestException)):
+        return True
+    if isinstance(exception, RedditAPIException):
+        return any(item.error_type == 'RATELIMIT' for item in exception.items)
+    return False
+
+
+@dataclass(slots=True)
+class OutboundMessage:
+    message_type: str
+    send: object  # Returns whether the message was sent
+    on_result: object = None
+    enqueued: float = field(default_factory=time.monotonic)
+    not_before: float = 0
+    attempts: int = 0
+
+
+class SendQueue:
+
+    def __init__(self, max_attempts=4, backoff_seconds=5, max_backoff_seconds=300):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.queue = []
+        self.seq = 0
+        self.latencies = defaultdict(list)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, message_type, send, on_result=None):
+        '''
+        Queues a message. send is a function that sends it and returns whether it was sent; on_result (if given)
+        is called with that result once the message has been sent or we've given up on it.
+        '''
+        self.queue.append((PRIORITY_CLASSES.get(message_type, max(PRIORITY_CLASSES.values())), self.seq,
+                           OutboundMessage(message_type, send, on_result)))
+        self.seq += 1
+
+    def next_ready(self):
+        '''Removes and returns the highest priority message that is ready to go, or None (and how long to wait) if none are'''
+        now = time.monotonic()
+        ready = [item for item in self.queue if item[2].not_before <= now]
+        if len(ready) == 0:
+            return None, min(item[2].not_before for item in self.queue) - now
+        item = min(ready, key=lambda item: item[:2])
+        self.queue.remove(item)
+        return item, 0
+
+    def run(self):
+        '''Sends everything in the queue'''
+        while len(self.queue) > 0:
+            item, wait = self.next_ready()
+            if item is None:
+                time.sleep(wait)
+                continue
+            priority, seq, message = item
+            message.attempts += 1
+            try:
+                result = message.send()
+            except Exception as e:
+                if not is_transient(e) or message.attempts >= self.max_attempts:
+                    logging.error(f"Couldn't send {message.message_type} after {message.attempts} attempts: {e}")
+                    self.finish(message, False)
+                    continue
+                backoff = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (message.attempts - 1))
+                backoff *= random.uniform(0.5, 1.5)
+                logging.warning(f"Sending {message.message_type} failed ({e}). Trying again in {backoff:.1f} seconds.")
+                message.not_before = time.monotonic() + backoff
+                self.queue.append(item)
+                continue
+            self.finish(message, result)
+        self.log_latencies()
+
+    def finish(self, message, result):
+        if result:
+            self.latencies[message.message_type].append(time.monotonic() - message.enqueued)
+        if message.on_result is not None:
+            message.on_result(result)
+
+    def log_latencies(self):
+        '''Logs how long the messages of each class have waited in the queue, since the queue was made'''
+        for message_type, latencies in self.latencies.items():
+            logging.info(f"{message_type}: {len(latencies)} sent, mean latency {sum(latencies) / len(latencies):.2f}s, "
+                         f"max {max(latencies):.2f}s")
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+######
+# Reports how long the entry points take to start. For each script, it times `python <script> --help` and
+# a plain import of the script (what a cron tick pays before doing any work), and lists the slowest imports
+# from `python -X importtime`.
+#
+# Usage:
+#     python startup_report.py chatbot.py --top 15
+######
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_command(cmd, cwd, repeats):
+    '''Returns the best wall time of running cmd `repeats` times, and the stderr of the last run'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
+        best = min(best, time.perf_counter() - start)
+    return best, result.stderr
+
+
+def parse_importtime(stderr, module):
+    '''Returns (cumulative_us, name) for the imports made directly by module, from the output of python -X importtime'''
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Each level of nesting indents the name by two more spaces
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1 or (depth == 0 and name.strip() != module):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)
+
+
+def report(script, top, repeats):
+    cwd = os.path.dirname(os.path.abspath(script))
+    module = os.path.splitext(os.path.basename(script))[0]
+    help_time, _ = time_command([sys.executable, script, '--help'], cwd, repeats)
+    import_time, _ = time_command([sys.executable, '-c', f'import {module}'], cwd, repeats)
+    _, stderr = time_command([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd, 1)
+    print(f"{script}")
+    print(f"    --help: {help_time:.3f} seconds")
+    print(f"    import: {import_time:.3f} seconds")
+    for cumulative, name in parse_importtime(stderr, module)[:top]:
+        print(f"        {cumulative / 1e6:7.3f}  {name}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scripts',
+                        nargs='*',
+                        default=[os.path.join(script_dir, 'chatbot.py')],
+                        help='Scripts to report on. They need to be safe to import (i.e., do their work under __main__).')
+    parser.add_argument('--top', type=int, default=10, help='How many of the slowest imports to list')
+    parser.add_argument('--repeats', type=int, default=5, help='Report the best of this many runs')
+    args = parser.parse_args()
+    for script in args.scripts:
+        report(script, args.top, args.repeats)
@@ -0,0 +1,361 @@
+import os
+import csv
+import json
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from conversation_store import ConversationStore, COLUMNS, DTYPES, hash_messages
+from rules_cache import RulesCache, HEADER as RULES_HEADER
+from exclusion_registry import ExclusionRegistry
+from conversation_state import ConversationStateTable, ConversationState, COLUMNS as STATE_COLUMNS
+from dataclasses import astuple
+
+######
+# Where the chatbot keeps its conversations (and the per-user conversation states), participants, subreddit
+# rules, and bad accounts. There are two
+# backends with the same interface:
+#
+# CsvStorage - the original layout: conversations, participants, and subreddit rules in CSV files and the bad
+#     accounts in a JSON list.
+# SqliteStorage - everything in one SQLite database (in WAL mode), with indexes on user ids and authors, and
+#     each batch of writes in a single transaction.
+#
+# The analysis scripts and the Snakefile read the CSV layout, so with the SQLite backend, run
+#     python storage.py export
+# to write the tables out to the CSV files in the config. `python storage.py import` goes the other way,
+# to move an existing deployment onto SQLite.
+######
+
+PARTICIPANT_COLUMNS = ['author', 'author_id', 'condition', 'subreddit', 'toxic_comments',
+                       'messaging_strategy', 'openai_model', 'first_consented_msg', 'initial_message']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS conversations (
+    key INTEGER NOT NULL UNIQUE,
+    user_id TEXT, message_type TEXT, text TEXT, created_utc REAL,
+    subreddit TEXT, conversation_or_message_id TEXT, is_modmail INTEGER, condition TEXT
+);
+CREATE INDEX IF NOT EXISTS conversations_user_id ON conversations (user_id);
+CREATE TABLE IF NOT EXISTS conversations_archive (
+    key INTEGER NOT NULL UNIQUE,
+    user_id TEXT, message_type TEXT, text TEXT, created_utc REAL,
+    subreddit TEXT, conversation_or_message_id TEXT, is_modmail INTEGER, condition TEXT
+);
+CREATE INDEX IF NOT EXISTS conversations_archive_user_id ON conversations_archive (user_id);
+CREATE TABLE IF NOT EXISTS participants (
+    author_id TEXT PRIMARY KEY, author TEXT, condition TEXT, subreddit TEXT, toxic_comments TEXT,
+    messaging_strategy TEXT, openai_model TEXT, first_consented_msg TEXT, initial_message TEXT
+);
+CREATE INDEX IF NOT EXISTS participants_author ON participants (author);
+CREATE TABLE IF NOT EXISTS subreddit_rules (subreddit TEXT PRIMARY KEY, rules TEXT, fetched_utc REAL);
+CREATE TABLE IF NOT EXISTS bad_accounts (key TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS conversation_state (
+    user_id TEXT PRIMARY KEY, consent_state TEXT, last_message_type TEXT, prev_message_type TEXT,
+    last_message_utc REAL, last_text TEXT, is_modmail INTEGER, subreddit TEXT, conversation_id TEXT,
+    n_messages INTEGER, n_seen INTEGER, has_handoff INTEGER, archived INTEGER
+);
+'''
+
+# SQLite limits how many parameters a statement can have
+MAX_PARAMS = 500
+
+
+def open_storage(config, base_dir):
+    '''Returns the storage backend chosen by config['storage_backend'], with paths relative to base_dir'''
+    if config.get('storage_backend', 'csv') == 'sqlite':
+        return SqliteStorage(os.path.join(base_dir, config['database_file']))
+    return CsvStorage(*(os.path.join(base_dir, config[x]) for x in
+                        ['conversations_file', 'participants_file', 'subreddits_file', 'bad_accounts_file']),
+                      conversation_state_file=os.path.join(base_dir, config['conversation_state_file']))
+
+
+def chunks(items, size=MAX_PARAMS):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class CsvStorage:
+
+    def __init__(self, conversations_file, participants_file, subreddits_file, bad_accounts_file, conversation_state_file=None):
+        self.conversations_file = conversations_file
+        self.conversation_state_file = conversation_state_file
+        self.participants_file = participants_file
+        self.subreddits_file = subreddits_file
+        self.bad_accounts_file = bad_accounts_file
+
+    def conversations(self):
+        return ConversationStore(self.conversations_file)
+
+    def conversation_states(self):
+        return ConversationStateTable(self.conversation_state_file)
+
+    def read_participants(self):
+        '''Returns the participants table, indexed by author_id'''
+        try:
+            return pd.read_csv(self.participants_file, index_col='author_id')
+        except FileNotFoundError:
+            return pd.DataFrame(columns=PARTICIPANT_COLUMNS).set_index('author_id')
+
+    def add_participant(self, row):
+        '''Takes a list of values in the order of PARTICIPANT_COLUMNS'''
+        is_new_file = not os.path.isfile(self.participants_file)
+        with open(self.participants_file, 'a') as f:
+            out = csv.writer(f)
+            if is_new_file:
+                out.writerow(PARTICIPANT_COLUMNS)
+            out.writerow(row)
+
+    def rules_cache(self, fetch_rules, ttl_seconds=None):
+        return RulesCache(self.subreddits_file, fetch_rules, ttl_seconds)
+
+    def exclusions(self):
+        return ExclusionRegistry(self.bad_accounts_file)
+
+    def close(self):
+        pass
+
+
+class SqliteStorage:
+
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self.db = sqlite3.connect(database_file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode, NORMAL only risks the last few transactions on power loss, not corruption
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        # Databases made before conversations could be archived don't have the column
+        state_columns = [row[1] for row in self.db.execute('PRAGMA table_info(conversation_state)')]
+        if 'archived' not in state_columns:
+            self.db.execute('ALTER TABLE conversation_state ADD COLUMN archived INTEGER DEFAULT 0')
+
+    def conversations(self):
+        return SqliteConversationStore(self.db)
+
+    def conversation_states(self):
+        return SqliteConversationStateTable(self.db)
+
+    def read_participants(self):
+        return pd.read_sql_query(f"SELECT {', '.join(PARTICIPANT_COLUMNS)} FROM participants ORDER BY rowid",
+                                 self.db, index_col='author_id')
+
+    def add_participant(self, row):
+        with self.db:
+            self.db.execute(f"INSERT OR REPLACE INTO participants ({', '.join(PARTICIPANT_COLUMNS)}) "
+                            f"VALUES ({', '.join('?' * len(PARTICIPANT_COLUMNS))})",
+                            [None if pd.isna(x) else str(x) for x in row])
+
+    def find_participant(self, author):
+        '''Returns the author_id of the participant with this username, or None'''
+        row = self.db.execute('SELECT author_id FROM participants WHERE author = ?', (author,)).fetchone()
+        return None if row is None else row[0]
+
+    def rules_cache(self, fetch_rules, ttl_seconds=None):
+        return SqliteRulesCache(self.db, fetch_rules, ttl_seconds)
+
+    def exclusions(self):
+        return SqliteExclusionRegistry(self.db)
+
+    def close(self):
+        self.db.close()
+
+    def export_csv(self, csv_storage):
+        '''Writes every table out to the CSV layout of csv_storage'''
+        self.conversations().read_all().to_csv(csv_storage.conversations_file, index=False)
+        self.read_participants().reset_index()[PARTICIPANT_COLUMNS].to_csv(csv_storage.participants_file, index=False)
+        with open(csv_storage.subreddits_file, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(RULES_HEADER)
+            out.writerows(self.db.execute('SELECT subreddit, rules, fetched_utc FROM subreddit_rules ORDER BY rowid'))
+        with open(csv_storage.bad_accounts_file, 'w') as f:
+            json.dump([key for key, in self.db.execute('SELECT key FROM bad_accounts ORDER BY rowid')], f)
+
+    def import_csv(self, csv_storage):
+        '''Copies everything from the CSV layout of csv_storage into the database. Rows that are already here are skipped.'''
+        conversations = csv_storage.conversations().read_all()[COLUMNS]
+        self.conversations().append(list(conversations.itertuples(index=False, name=None)))
+        participants = csv_storage.read_participants().reset_index().reindex(columns=PARTICIPANT_COLUMNS)
+        for row in participants.itertuples(index=False, name=None):
+            self.add_participant(row)
+        rules = csv_storage.rules_cache(fetch_rules=None)
+        SqliteRulesCache(self.db, fetch_rules=None).save(rules.rules)
+        self.exclusions().add(*csv_storage.exclusions().persisted)
+
+
+class SqliteConversationStore(ConversationStore):
+    '''A ConversationStore backed by the conversations table. Checking whether messages are stored is an indexed query.'''
+
+    def __init__(self, db):
+        self.db = db
+        self._frame = None
+        self._pending = []
+
+    def __len__(self):
+        return sum(self.db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                   for table in ['conversations', 'conversations_archive'])
+
+    def read(self, where='', params=(), table='conversations'):
+        df = pd.read_sql_query(f"SELECT {', '.join(COLUMNS)} FROM {table} {where} ORDER BY rowid", self.db, params=params)
+        df['is_modmail'] = df.is_modmail.astype(bool)
+        return df.astype({column: dtype for column, dtype in DTYPES.items() if dtype is not str})
+
+    def stored_keys(self, keys):
+        stored = set()
+        for chunk in chunks(keys):
+            for table in ['conversations', 'conversations_archive']:
+                rows = self.db.execute(f"SELECT key FROM {table} WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+                stored.update(key for key, in rows)
+        return stored
+
+    def is_stored(self, messages):
+        if len(messages) == 0:
+            return []
+        keys = hash_messages(pd.DataFrame(messages, columns=COLUMNS)).view(np.int64).tolist()
+        stored = self.stored_keys(keys)
+        return [key in stored for key in keys]
+
+    @property
+    def frame(self):
+        '''The full conversations table. It's read once, and then kept up to date with the messages we append.'''
+        if self._frame is None:
+            self._frame = self.read()
+            self._pending = []
+        return super().frame
+
+    def read_users(self, user_ids, table):
+        user_ids = [str(user_id) for user_id in user_ids]
+        return [self.read(f"WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk, table) for chunk in chunks(user_ids)]
+
+    def for_users(self, user_ids, archived_user_ids=()):
+        '''Returns the messages for the given users, using the user_id index. The archive is only read for archived_user_ids.'''
+        frames = self.read_users(archived_user_ids, 'conversations_archive') + self.read_users(user_ids, 'conversations')
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=COLUMNS)
+
+    def read_all(self):
+        return pd.concat([self.read(table='conversations_archive'), self.read()], ignore_index=True)
+
+    def active_users(self):
+        return {user_id for user_id, in self.db.execute('SELECT DISTINCT user_id FROM conversations')}
+
+    def archived_users(self):
+        return {user_id for user_id, in self.db.execute('SELECT DISTINCT user_id FROM conversations_archive')}
+
+    def archive(self, user_ids):
+        '''Moves all of the messages for user_ids to the archive table, in one transaction'''
+        user_ids = [str(user_id) for user_id in user_ids]
+        with self.db:
+            for chunk in chunks(user_ids):
+                where = f"WHERE user_id IN ({', '.join('?' * len(chunk))})"
+                self.db.execute(f"INSERT OR IGNORE INTO conversations_archive SELECT * FROM conversations {where} ORDER BY rowid", chunk)
+                self.db.execute(f"DELETE FROM conversations {where}", chunk)
+        if self._frame is not None:
+            frame = self.frame
+            self._frame = frame[~frame.user_id.isin(user_ids)].reset_index(drop=True)
+
+    def append(self, messages):
+        new_messages = pd.DataFrame(messages, columns=COLUMNS)
+        if len(new_messages) == 0:
+            return new_messages
+        new_messages['user_id'] = new_messages.user_id.astype(str)
+        keys = hash_messages(new_messages).view(np.int64)
+        # Drop duplicates within the batch, and then the ones that are already stored
+        keep = ~pd.Series(keys).duplicated().to_numpy()
+        stored = self.stored_keys(keys[keep].tolist())
+        keep &= np.array([key not in stored for key in keys.tolist()], dtype=bool)
+        new_messages, keys = new_messages[keep], keys[keep]
+        if len(new_messages) == 0:
+            return new_messages
+        rows = new_messages.astype(object).where(pd.notna(new_messages), None)
+        with self.db:
+            self.db.executemany(f"INSERT INTO conversations (key, {', '.join(COLUMNS)}) "
+                                f"VALUES (?, {', '.join('?' * len(COLUMNS))})",
+                                ((key, *row) for key, row in zip(keys.tolist(), rows.itertuples(index=False, name=None))))
+        if self._frame is not None:
+            self._pending.append(new_messages)
+        return new_messages
+
+
+class SqliteConversationStateTable(ConversationStateTable):
+
+    def __init__(self, db):
+        self.db = db
+        super().__init__(None)
+
+    def read(self):
+        rows = self.db.execute(f"SELECT {', '.join(STATE_COLUMNS)} FROM conversation_state")
+        states = {}
+        for row in rows:
+            state = ConversationState(*row)
+            state.is_modmail = None if state.is_modmail is None else bool(state.is_modmail)
+            state.has_handoff = bool(state.has_handoff)
+            state.archived = bool(state.archived)
+            states[state.user_id] = state
+        return states
+
+    def write(self, states):
+        with self.db:
+            self.db.executemany(f"INSERT OR REPLACE INTO conversation_state ({', '.join(STATE_COLUMNS)}) "
+                                f"VALUES ({', '.join('?' * len(STATE_COLUMNS))})",
+                                (astuple(state) for state in states))
+
+    def rewrite(self, states):
+        with self.db:
+            self.db.execute('DELETE FROM conversation_state')
+            self.db.executemany(f"INSERT INTO conversation_state ({', '.join(STATE_COLUMNS)}) "
+                                f"VALUES ({', '.join('?' * len(STATE_COLUMNS))})",
+                                (astuple(state) for state in states))
+
+
+class SqliteRulesCache(RulesCache):
+
+    def __init__(self, db, fetch_rules, ttl_seconds=None):
+        self.db = db
+        super().__init__(None, fetch_rules, ttl_seconds)
+
+    def read(self):
+        return {subreddit: (rules, fetched_utc or 0) for subreddit, rules, fetched_utc in
+                self.db.execute('SELECT subreddit, rules, fetched_utc FROM subreddit_rules')}
+
+    def save(self, rules=None):
+        rules = self.rules if rules is None else rules
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO subreddit_rules (subreddit, rules, fetched_utc) VALUES (?, ?, ?)',
+                                ((subreddit, r, fetched_utc) for subreddit, (r, fetched_utc) in rules.items()))
+
+
+class SqliteExclusionRegistry(ExclusionRegistry):
+
+    def __init__(self, db):
+        self.db = db
+        self.persisted = set(self.read_keys())
+        self.excluded = set(self.persisted)
+
+    def read_keys(self):
+        return (key for key, in self.db.execute('SELECT key FROM bad_accounts'))
+
+    def write_keys(self, keys):
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO bad_accounts (key) VALUES (?)', ((key,) for key in keys))
+
+    def compact(self):
+        pass
+
+
+if __name__ == '__main__':
+    from config_loader import load_config
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['export', 'import'],
+                        help='export: write the SQLite database out to the CSV files in the config. import: load the CSV files into the database.')
+    parser.add_argument('--config', default='shared_config.yaml')
+    args = parser.parse_args()
+    config = load_config(args.config)
+    base_dir = os.path.dirname(os.path.abspath(args.config))
+    database = SqliteStorage(os.path.join(base_dir, config['database_file']))
+    csv_storage = CsvStorage(*(os.path.join(base_dir, config[x]) for x in
+                               ['conversations_file', 'participants_file', 'subreddits_file', 'bad_accounts_file']))
+    if args.command == 'export':
+        database.export_csv(csv_storage)
+    else:
+        database.import_csv(csv_storage)
+    database.close()
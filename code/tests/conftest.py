@@ -0,0 +1,30 @@
+import os
+import sys
+import types
+import shutil
+import pytest
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The scripts in code/ import each other by name (they're run from code/), so the tests do too
+sys.path.insert(0, CODE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# auth.py holds the real credentials and isn't in the repo. The tests use placeholders, and never talk to reddit or
+# OpenAI (see fake_reddit.py and fake_openai.py).
+auth = types.ModuleType('auth')
+auth.client_id = auth.client_secret = auth.password = auth.openai_key = auth.perspective_api_key = 'test'
+auth.u_agent = 'chatbot tests'
+auth.username = 'toxictalk_bot'
+sys.modules['auth'] = auth
+
+
+@pytest.fixture
+def chatbot(tmp_path, monkeypatch):
+    '''The chatbot module, with the config from example_config.yaml and all of its data files in tmp_path'''
+    shutil.copy(os.path.join(CODE_DIR, 'example_config.yaml'), tmp_path / 'shared_config.yaml')
+    monkeypatch.chdir(tmp_path)
+    import chatbot
+    for key in [key for key in chatbot.config if key.endswith('_file')]:
+        monkeypatch.setitem(chatbot.config, key, str(tmp_path / os.path.basename(chatbot.config[key])))
+    return chatbot
@@ -0,0 +1,37 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+######
+# A stand-in for openai.AsyncOpenAI, for running the chatbot and the CompletionPool without OpenAI. Pass it to
+# CompletionPool as client_factory=lambda: fake. Each completion takes `delay` seconds and replies with
+# reply(model, messages) (by default, an echo of the last message). It records when each request started and
+# how many were in flight at once.
+######
+
+
+class FakeAsyncOpenAI:
+
+    def __init__(self, delay=0.05, reply=None):
+        self.delay = delay
+        self.reply = reply or (lambda model, messages: f"You said: {messages[-1]['content']}")
+        self.started = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages):
+        self.started.append((time.monotonic(), model))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        content = self.reply(model, messages)
+        total_tokens = sum(len(message['content'].split()) for message in messages) + len(content.split())
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                               usage=SimpleNamespace(total_tokens=total_tokens))
+
+    async def close(self):
+        pass
@@ -0,0 +1,211 @@
+import time
+import threading
+from datetime import datetime, timezone
+import praw
+
+######
+# A local stand-in for praw.Reddit, with just the parts of the API that the chatbot uses: the inbox (unread
+# messages, replies, mark_read), modmail conversations (listing, replying, archiving, creating), DMs to redditors,
+# and subreddit rules. Nothing leaves the process.
+#
+# Tests play the part of the users with deliver_dm() and deliver_modmail(), which can be called from another
+# thread while the chatbot is polling (e.g., to feed a stream of messages into chatbot.stream_replies). Every
+# message the bot sends is recorded in `sent`, with how long after the user's message it was sent.
+######
+
+
+def to_date(timestamp):
+    '''Modmail messages have ISO dates instead of timestamps'''
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+class FakeRedditor:
+
+    def __init__(self, reddit, name):
+        self._reddit = reddit
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        # Like praw's Redditor, compares equal to its name
+        return str(self).lower() == str(other).lower()
+
+    def __hash__(self):
+        return hash(self.name.lower())
+
+    def message(self, subject, message):
+        self._reddit.record(self.name, 'dm', message, None)
+
+
+class FakeListing:
+    '''Iterates over a snapshot of items a page at a time, like a praw ListingGenerator (whose current page is _listing)'''
+
+    def __init__(self, items, page_size=100):
+        self.items = list(items)
+        self.page_size = page_size
+        self._listing = None
+
+    def __iter__(self):
+        for start in range(0, max(len(self.items), 1), self.page_size):
+            self._listing = self.items[start:start + self.page_size]
+            yield from self._listing
+
+
+class FakeMessage(praw.models.Message):
+    '''An inbox message. It's a real praw Message (the chatbot skips anything else in the inbox), but replies stay local.'''
+
+    def __init__(self, reddit, id, author, body, created_utc, subject='re: Chat with our chatbot', parent_id='t4_0'):
+        super().__init__(reddit, _data={'id': id, 'author': FakeRedditor(reddit, author), 'body': body,
+                                        'created_utc': created_utc, 'subject': subject, 'parent_id': parent_id,
+                                        'subreddit': None, 'dest': reddit.username, 'replies': []})
+
+    def reply(self, body):
+        self._reddit.record(self.author.name, 'dm_reply', body, self.created_utc)
+
+
+class FakeModmailMessage:
+
+    def __init__(self, reddit, author, body, created_utc):
+        self.author = FakeRedditor(reddit, author)
+        self.body_markdown = body
+        self.created_utc = created_utc
+        self.date = to_date(created_utc)
+
+
+class FakeModmailConversation:
+
+    # Reddit's states: 0 is new, 1 is in progress, and 2 is archived
+    def __init__(self, reddit, id, subreddit, user):
+        self._reddit = reddit
+        self.id = id
+        self.owner = FakeSubreddit(reddit, subreddit)
+        self.user = user
+        self.messages = []
+        self.state = 0
+
+    def __str__(self):
+        return self.id
+
+    @property
+    def authors(self):
+        return [FakeRedditor(self._reddit, name) for name in dict.fromkeys(m.author.name for m in self.messages)]
+
+    def add(self, author, body, created_utc=None):
+        self.messages.append(FakeModmailMessage(self._reddit, author, body, created_utc or time.time()))
+        self.state = 1
+
+    def reply(self, body):
+        in_reply_to = self.messages[-1].created_utc if self.messages[-1].author.name == self.user else None
+        self.add(self._reddit.username, body)
+        self._reddit.record(self.user, 'modmail_reply', body, in_reply_to)
+
+    def archive(self):
+        self.state = 2
+
+
+class FakeModmail:
+
+    def __init__(self, reddit, subreddit):
+        self._reddit = reddit
+        self.subreddit = subreddit
+
+    def __call__(self, id):
+        return self._reddit.modmail_conversations[id]
+
+    def conversations(self, state='all', sort='recent'):
+        # Nothing is ever filtered
+        if state == 'filtered':
+            return FakeListing([])
+        conversations = [c for c in self._reddit.modmail_conversations.values()
+                         if self.subreddit == 'all' or c.owner.display_name == self.subreddit]
+        return FakeListing(sorted(conversations, key=lambda c: c.messages[-1].created_utc, reverse=True))
+
+    def create(self, subject, body, recipient):
+        conversation = self._reddit.new_modmail_conversation(self.subreddit, recipient)
+        conversation.add(self._reddit.username, body)
+        self._reddit.record(recipient, 'modmail', body, None)
+        return conversation
+
+
+class FakeSubreddit:
+
+    def __init__(self, reddit, display_name):
+        self._reddit = reddit
+        self.display_name = display_name
+        self.modmail = FakeModmail(reddit, display_name)
+
+    @property
+    def rules(self):
+        return list(self._reddit.rules.get(self.display_name, []))
+
+
+class FakeInbox:
+
+    def __init__(self, reddit):
+        self._reddit = reddit
+        self.messages = dict()
+        self.unread_ids = []
+
+    def unread(self, limit=None):
+        return FakeListing([self.messages[id] for id in list(self.unread_ids)])
+
+    def mark_read(self, items):
+        for item in items:
+            if item.id in self.unread_ids:
+                self.unread_ids.remove(item.id)
+
+    def message(self, id):
+        return self.messages[id]
+
+
+class FakeReddit:
+
+    def __init__(self, username, rules=None):
+        self.username = username
+        self.rules = rules or {}
+        self.inbox = FakeInbox(self)
+        self.modmail_conversations = dict()
+        # (user, kind, text, seconds between the user's message and our reply (None if it's not a reply))
+        self.sent = []
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return f"fake{self.next_id}"
+
+    def record(self, user, kind, text, in_reply_to):
+        latency = time.time() - in_reply_to if in_reply_to is not None else None
+        with self.lock:
+            self.sent.append((user, kind, text, latency))
+
+    def replies(self):
+        with self.lock:
+            return [x for x in self.sent if x[3] is not None]
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def redditor(self, name):
+        return FakeRedditor(self, name)
+
+    def new_modmail_conversation(self, subreddit, user):
+        conversation = FakeModmailConversation(self, self.new_id(), subreddit, user)
+        self.modmail_conversations[conversation.id] = conversation
+        return conversation
+
+    def deliver_dm(self, author, body):
+        '''A user replies to one of our DMs. Returns the message.'''
+        message = FakeMessage(self, self.new_id(), author, body, time.time())
+        self.inbox.messages[message.id] = message
+        self.inbox.unread_ids.append(message.id)
+        return message
+
+    def deliver_modmail(self, conversation_id, body):
+        '''The user in a modmail conversation replies to it'''
+        conversation = self.modmail_conversations[conversation_id]
+        conversation.add(conversation.user, body)
+        return conversation
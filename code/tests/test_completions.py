@@ -0,0 +1,71 @@
+import asyncio
+import time
+from completions import CompletionPool, TokenBucket
+from fake_openai import FakeAsyncOpenAI
+
+MESSAGES = [{'role': 'user', 'content': 'hello there'}]
+
+
+def complete_all(pool, n, model='gpt-3.5-turbo'):
+    async def run():
+        return await asyncio.gather(*(pool.complete(model, MESSAGES) for _ in range(n)))
+    return pool.run(run())
+
+
+def test_requests_share_one_client_and_run_concurrently():
+    fake = FakeAsyncOpenAI(delay=0.2)
+    pool = CompletionPool(api_key=None, client_factory=lambda: fake)
+    start = time.monotonic()
+    replies = complete_all(pool, 8)
+    elapsed = time.monotonic() - start
+    assert replies == ['You said: hello there'] * 8
+    assert fake.max_in_flight == 8
+    # One after the other, they would take 1.6 seconds
+    assert elapsed < 0.8
+
+
+def test_requests_per_minute_limit_spaces_out_requests():
+    fake = FakeAsyncOpenAI(delay=0)
+    pool = CompletionPool(api_key=None, rate_limits={'gpt-3.5-turbo': {'requests_per_minute': 2}},
+                          client_factory=lambda: fake)
+    # A burst of 2, then one every 0.25 seconds (instead of every 30 seconds)
+    pool.request_buckets['gpt-3.5-turbo'] = TokenBucket(2, period=0.5)
+    complete_all(pool, 6)
+    starts = sorted(started for started, _ in fake.started)
+    assert starts[1] - starts[0] < 0.1
+    # The other 4 had to wait for the bucket to refill
+    assert starts[-1] - starts[0] >= 0.9
+
+
+def test_models_without_limits_are_not_limited():
+    fake = FakeAsyncOpenAI(delay=0)
+    pool = CompletionPool(api_key=None, rate_limits={'gpt-4': {'requests_per_minute': 1}},
+                          client_factory=lambda: fake)
+    start = time.monotonic()
+    complete_all(pool, 20, model='gpt-3.5-turbo')
+    assert time.monotonic() - start < 0.5
+
+
+def test_tokens_per_minute_limit_waits_for_tokens():
+    fake = FakeAsyncOpenAI(delay=0)
+    pool = CompletionPool(api_key=None, rate_limits={'gpt-3.5-turbo': {'tokens_per_minute': 100}},
+                          client_factory=lambda: fake)
+    # Each request is estimated at 7 tokens and uses 6, so a full bucket holds 2 of them, and the other 4 have to
+    # wait for about 20 tokens (0.6 seconds)
+    pool.token_buckets['gpt-3.5-turbo'] = TokenBucket(16, period=0.5)
+    complete_all(pool, 6)
+    starts = sorted(started for started, _ in fake.started)
+    assert starts[-1] - starts[0] >= 0.4
+
+
+def test_changing_the_limits_keeps_the_tokens_in_the_buckets():
+    pool = CompletionPool(api_key=None, rate_limits={'gpt-3.5-turbo': {'requests_per_minute': 10, 'tokens_per_minute': 1000},
+                                                     'gpt-4': {'requests_per_minute': 5}})
+    bucket = pool.request_buckets['gpt-3.5-turbo']
+    bucket.tokens = 0
+    pool.set_rate_limits({'gpt-3.5-turbo': {'requests_per_minute': 20}})
+    # Still nearly empty, so the new limit doesn't allow a burst of 20
+    assert pool.request_buckets['gpt-3.5-turbo'] is bucket
+    assert bucket.capacity == 20 and bucket.tokens < 1
+    assert 'gpt-3.5-turbo' not in pool.token_buckets
+    assert 'gpt-4' not in pool.request_buckets
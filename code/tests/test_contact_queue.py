@@ -0,0 +1,55 @@
+from contact_queue import ContactLog, ContactQueue
+
+
+def make_queue(tmp_path, authors, max_attempts=3):
+    log = ContactLog(str(tmp_path / 'to_contact.csv'))
+    for author in authors:
+        log.add(author, 'aww', 'you suck')
+    return ContactQueue(log.to_contact_file, str(tmp_path / 'contact_queue.json'), max_attempts=max_attempts)
+
+
+def test_failed_user_goes_behind_untried_users(tmp_path):
+    queue = make_queue(tmp_path, ['alice', 'bob', 'carol'])
+    never_excluded = lambda author: False
+    # alice's message fails to send, so she isn't excluded or removed
+    assert [row['author'] for row in queue.next_candidates(1, never_excluded)] == ['alice']
+    assert [row['author'] for row in queue.next_candidates(2, never_excluded)] == ['bob', 'carol']
+    queue.remove(['bob', 'carol'])
+    assert [row['author'] for row in queue.next_candidates(2, never_excluded)] == ['alice']
+
+
+def test_failed_user_is_dropped_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, ['alice', 'bob'], max_attempts=2)
+    never_excluded = lambda author: False
+    for _ in range(2):
+        assert [row['author'] for row in queue.next_candidates(1, never_excluded)] == ['alice']
+        queue.remove(['bob'])
+    assert queue.next_candidates(1, never_excluded) == []
+    # The attempts are saved with the queue
+    reloaded = ContactQueue(queue.to_contact_file, str(tmp_path / 'contact_queue.json'), max_attempts=2)
+    assert reloaded.next_candidates(1, never_excluded) == []
+    assert reloaded.pending_authors == set()
+
+
+def test_contact_log_tracks_the_newest_row_in_each_subreddit(tmp_path):
+    log = ContactLog(str(tmp_path / 'to_contact.csv'))
+    log.add('alice', 'aww', 'you suck', timestamp=10.0)
+    log.add('bob', 'aww', 'you suck', timestamp=5.0)
+    log.add('carol', 'tifu', 'you suck')
+    assert not log.add('alice', 'aww', 'you suck', timestamp=20.0)
+    for log in [log, ContactLog(log.to_contact_file)]:
+        assert log.last_timestamp('aww') == 10.0
+        assert log.last_timestamp('tifu') == 0
+        assert 'carol' in log
+
+
+def test_easter_eggs_share_one_contact_log(chatbot, monkeypatch):
+    from fake_reddit import FakeReddit
+    monkeypatch.setattr(chatbot, 'connect', lambda scheduler, **kwargs: FakeReddit(chatbot.auth.username))
+    logs = []
+    monkeypatch.setattr(chatbot, 'ContactLog', lambda to_contact_file: logs.append(ContactLog(to_contact_file)) or logs[-1])
+    run = chatbot.Run()
+    for author in ['alice', 'bob', 'alice']:
+        run.add_to_contact(author, 'toxictalk')
+    assert len(logs) == 1
+    assert ContactLog(run.to_contact_file).authors == {'alice', 'bob'}
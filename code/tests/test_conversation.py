@@ -0,0 +1,34 @@
+import pandas as pd
+from conversation_store import COLUMNS
+
+
+def rows(user_id, types, is_modmail):
+    return [[user_id, message_type, f"{user_id} {i}", float(i), 'aww', 'c1', modmail, 'casual']
+            for i, (message_type, modmail) in enumerate(zip(types, is_modmail))]
+
+
+def test_conversations_are_views_with_the_message_interface(chatbot):
+    df = pd.DataFrame(rows('b1', ['initial', 'user', 'handoff', 'user', 'AI_reply', 'user'], [True, True, True, True, False, False]) +
+                      rows('a1', ['initial', 'user'], [True, True]), columns=COLUMNS)
+    conversations = chatbot.split_conversations(df)
+    assert list(conversations) == ['a1', 'b1']
+
+    b1 = conversations['b1']
+    # The modmail message after the handoff is dropped
+    assert [message.text for message in b1.messages] == ['b1 0', 'b1 1', 'b1 2', 'b1 4', 'b1 5']
+    assert b1.messages[-1] == chatbot.Message('b1', 'user', 'b1 5', 5.0, 'aww', 'c1', False, 'casual')
+    assert [message.message_type for message in b1.messages[-2:]] == ['AI_reply', 'user']
+    assert len(b1.messages[1:]) == 4
+    assert b1.user_id == 'b1' and b1.subreddit == 'aww'
+
+    a1 = conversations['a1']
+    assert a1.messages[-1].is_modmail is True
+    assert a1.get_conversation_status(user=None) == 'needs_clarification'
+
+
+def test_missing_initial_message_is_filled_in(chatbot):
+    user = chatbot.User('alice', 'a1', 'casual', 'dm', 'aww', 'you suck', 'gpt-3.5-turbo', 'general',
+                        next(iter(chatbot.config['initial_message'])))
+    conversation = chatbot.Conversation(pd.DataFrame(rows('a1', ['user'], [False]), columns=COLUMNS))
+    conversation.get_conversation_status(user=user)
+    assert [message.message_type for message in conversation.messages] == ['initial', 'user']
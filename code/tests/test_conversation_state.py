@@ -0,0 +1,52 @@
+import pandas as pd
+from conversation_store import ConversationStore, COLUMNS
+from conversation_state import ConversationStateTable
+
+
+def write_log(path, rows):
+    pd.DataFrame(rows, columns=COLUMNS).to_csv(path, index=False)
+
+
+def test_rebuilt_states_match_a_log_with_duplicated_rows(tmp_path):
+    initial = ['a1', 'initial', 'hello', 1.0, 'aww', None, True, 'casual']
+    reply = ['a1', 'user', 'yes', 2.0, 'aww', 'c1', True, 'casual']
+    write_log(tmp_path / 'conversations.csv', [initial, reply, reply])
+    store = ConversationStore(str(tmp_path / 'conversations.csv'))
+    states = ConversationStateTable(str(tmp_path / 'conversation_state.csv'))
+    states.rebuild(store.read_all())
+    assert len(store) == 2
+    # Otherwise every start-up would see the states as behind and rebuild them again
+    assert states.n_seen() == len(store)
+    assert ConversationStateTable(str(tmp_path / 'conversation_state.csv')).n_seen() == len(store)
+
+
+def test_continue_convos_skips_users_without_stored_messages(chatbot, monkeypatch, caplog):
+    from fake_reddit import FakeReddit
+    monkeypatch.setattr(chatbot, 'connect', lambda scheduler, **kwargs: FakeReddit(chatbot.auth.username))
+    run = chatbot.Run()
+    # A state that says a1 is waiting, with nothing in the conversations table
+    run.conversation_states.apply(pd.DataFrame([['a1', 'user', 'yes', 2.0, 'aww', 'c1', True, 'casual']], columns=COLUMNS))
+    run.continue_convos()
+    assert 'a1 is waiting for a reply, but has no stored messages' in caplog.text
+
+
+def test_finished_conversations_are_archived_in_batches(chatbot, monkeypatch):
+    from fake_reddit import FakeReddit
+    monkeypatch.setattr(chatbot, 'connect', lambda scheduler, **kwargs: FakeReddit(chatbot.auth.username))
+    monkeypatch.setitem(chatbot.config, 'archive_min_messages', 5)
+    run = chatbot.Run()
+
+    def chat(user_id):
+        run.write_conversations([chatbot.Message(user_id, message_type, text, float(i), 'aww', 'c1', True, 'casual')
+                                 for i, (message_type, text) in enumerate([('initial', 'hello'), ('user', 'no'), ('user', 'go away')])])
+        run.exclusions.add(user_id)
+
+    chat('a1')
+    run.archive_finished()
+    # Too few messages to be worth rewriting the conversations file
+    assert run.conversations.active_users() == {'a1'}
+    chat('b1')
+    run.archive_finished()
+    assert run.conversations.active_users() == set()
+    assert run.conversations.archived_users() == {'a1', 'b1'}
+    assert run.conversation_states.unarchived() == []
@@ -0,0 +1,46 @@
+import pandas as pd
+import conversation_store
+from conversation_store import ConversationStore, COLUMNS
+
+
+def message(i, user_id='a1'):
+    return (user_id, 'user', f"message {i}", float(i), 'aww', 'c1', False, 'casual')
+
+
+def test_start_up_only_hashes_the_rows_appended_since_the_last_index(tmp_path, monkeypatch):
+    conversations_file = str(tmp_path / 'conversations.csv')
+    store = ConversationStore(conversations_file)
+    store.append([message(i) for i in range(100)])
+    assert len(ConversationStore(conversations_file)) == 100
+
+    # Rows appended by the last run (after the index was saved)
+    ConversationStore(conversations_file).append([message(i) for i in range(100, 103)])
+    hashed = []
+    hash_messages = conversation_store.hash_messages
+    monkeypatch.setattr(conversation_store, 'hash_messages', lambda df: hashed.append(len(df)) or hash_messages(df))
+    store = ConversationStore(conversations_file)
+    assert hashed == [3]
+    assert len(store) == 103
+    assert store.is_stored([message(0), message(102), message(103)]) == [True, True, False]
+    assert len(store.frame) == 103
+
+
+def test_index_is_rebuilt_when_the_file_is_replaced(tmp_path):
+    conversations_file = str(tmp_path / 'conversations.csv')
+    ConversationStore(conversations_file).append([message(i) for i in range(10)])
+    # Replaced by a longer file with different messages (e.g., exported from the database)
+    pd.DataFrame([message(i, 'b1') for i in range(20)], columns=COLUMNS).to_csv(conversations_file, index=False)
+    store = ConversationStore(conversations_file)
+    assert len(store) == 20
+    assert store.is_stored([message(0), message(0, 'b1')]) == [False, True]
+
+
+def test_archiving_keeps_the_index_in_step(tmp_path):
+    conversations_file = str(tmp_path / 'conversations.csv')
+    store = ConversationStore(conversations_file)
+    store.append([message(i) for i in range(5)] + [message(i, 'b1') for i in range(5)])
+    store.archive(['a1'])
+    store = ConversationStore(conversations_file)
+    assert len(store) == 10
+    assert store.is_stored([message(0), message(0, 'b1')]) == [True, True]
+    assert store.active_users() == {'b1'}
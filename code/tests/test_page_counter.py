@@ -0,0 +1,22 @@
+from fake_reddit import FakeListing
+
+
+def test_counts_the_pages_fetched(chatbot):
+    # praw's params say 1024 items a page when limit=None, but reddit sends 100
+    listing = chatbot.PageCounter(FakeListing(range(250)))
+    assert len(list(listing)) == 250
+    assert listing.pages == 3
+
+
+def test_counts_an_empty_listing_as_one_request(chatbot):
+    listing = chatbot.PageCounter(FakeListing([]))
+    assert list(listing) == []
+    assert listing.pages == 1
+
+
+def test_stops_counting_when_we_stop_early(chatbot):
+    listing = chatbot.PageCounter(FakeListing(range(250)))
+    for i in listing:
+        if i == 120:
+            break
+    assert listing.pages == 2
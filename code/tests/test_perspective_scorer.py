@@ -0,0 +1,60 @@
+import os
+import sys
+import pytest
+import requests
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'augment_data'))
+from get_toxicity import PerspectiveScorer, ScoringEngine
+
+
+def response(status_code=200, json=None):
+    def read_json():
+        if isinstance(json, Exception):
+            raise json
+        return json
+    return SimpleNamespace(status_code=status_code, json=read_json, text=str(json))
+
+
+def scores(*values):
+    return {'attributeScores': {test: {'summaryScore': {'value': value}}
+                                for test, value in zip(['TOXICITY', 'SEVERE_TOXICITY'], values) if value is not None}}
+
+
+class FakeSession:
+    '''Answers each text with the response in `responses`, or raises it'''
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def post(self, url, params, json, timeout):
+        answer = self.responses[json['comment']['text']]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+@pytest.fixture
+def engine(tmp_path):
+    scorer = PerspectiveScorer(api_key='test', qps=1000, max_attempts=1)
+    scorer.session = FakeSession({
+        'fine': response(json=scores(0.9, 0.5)),
+        # E.g., a language where Perspective only has TOXICITY
+        'no severe toxicity': response(json=scores(0.8, None)),
+        'not json': response(json=ValueError('Expecting value')),
+        'unexpected': response(json={'error': 'something else'}),
+        'unsupported language': response(status_code=400, json={'error': 'language'}),
+        'broken connection': requests.ConnectionError('reset'),
+        'bug': response(json=RuntimeError('not a response error')),
+    })
+    return ScoringEngine(scorer, cache_file=str(tmp_path / 'score_cache.sqlite'))
+
+
+def test_a_bad_response_only_fails_its_own_text(engine, monkeypatch):
+    # Don't wait between the retries of the broken connection
+    monkeypatch.setattr('get_toxicity.time.sleep', lambda seconds: None)
+    texts = ['fine', 'no severe toxicity', 'not json', 'unexpected', 'unsupported language', 'broken connection', 'bug']
+    assert engine.score_batch(texts) == [(0.9, 0.5), (0.8, None)] + [(None, None)] * 5
+    # The scores that came back are cached, and the failures will be tried again
+    assert engine.cache.get('fine', engine.tests) == (0.9, 0.5)
+    assert engine.cache.get('no severe toxicity', engine.tests) is None
@@ -0,0 +1,79 @@
+import pytest
+from types import SimpleNamespace
+from prawcore import Requestor
+import reddit_scheduler
+from reddit_scheduler import RequestScheduler, ScheduledRequestor
+
+
+class Clock:
+    '''Stands in for time.time and time.sleep, so the tests don't wait'''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(reddit_scheduler, 'time', clock)
+    return clock
+
+
+def headers(remaining, reset):
+    return {'x-ratelimit-remaining': str(remaining), 'x-ratelimit-reset': str(reset), 'x-ratelimit-used': '0'}
+
+
+def test_scripts_sharing_a_state_file_share_the_spacing(tmp_path, clock):
+    chatbot, collector = (RequestScheduler(str(tmp_path / 'rate_limit.json')) for _ in range(2))
+    # Nothing is known before reddit answers
+    assert chatbot.reserve() == clock.now
+    chatbot.update(headers(remaining=10, reset=100))
+    # 100 seconds for 10 requests: one every 10 seconds, whichever script makes them
+    assert chatbot.reserve() == 1000
+    assert collector.reserve() == 1010
+    assert chatbot.reserve() == 1020
+    clock.now = 1015
+    assert collector.reserve() == 1030
+
+
+def test_hit_limit_holds_every_script_until_the_reset(tmp_path, clock):
+    chatbot, collector = (RequestScheduler(str(tmp_path / 'rate_limit.json')) for _ in range(2))
+    chatbot.update(headers(remaining=10, reset=100))
+    collector.hit_limit()
+    assert chatbot.reserve() == 1100
+    # Even a request that prawcore is pacing waits for the reset
+    assert chatbot.reserve(paced=True) == 1100
+    # Once the window resets, we go again
+    clock.now = 1101
+    assert collector.reserve() == 1101
+
+
+def test_hit_limit_without_a_known_reset_waits_the_default(tmp_path, clock):
+    scheduler = RequestScheduler(str(tmp_path / 'rate_limit.json'))
+    scheduler.hit_limit(default_seconds=60)
+    assert scheduler.reserve() == 1060
+
+
+def test_requestor_locks_once_per_request_and_lets_prawcore_pace(tmp_path, clock, monkeypatch):
+    scheduler = RequestScheduler(str(tmp_path / 'rate_limit.json'))
+    locks = []
+    shared_state = scheduler.shared_state
+    monkeypatch.setattr(scheduler, 'shared_state', lambda: locks.append(clock.now) or shared_state())
+    monkeypatch.setattr(Requestor, 'request', lambda self, *args, **kwargs: SimpleNamespace(headers=headers(remaining=10, reset=100)))
+    requestor = ScheduledRequestor(user_agent='chatbot tests', scheduler=scheduler)
+    for _ in range(3):
+        requestor.request('GET', 'https://oauth.reddit.com/message/unread')
+    assert len(locks) == 3
+    # prawcore spaces these requests by the same headers, so we don't wait as well
+    assert clock.slept == []
+    # ...but they're counted in the shared budget, so another script spaces itself around them
+    other = RequestScheduler(str(tmp_path / 'rate_limit.json'))
+    assert other.reserve() > clock.now
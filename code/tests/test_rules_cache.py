@@ -0,0 +1,36 @@
+import time
+from rules_cache import RulesCache
+
+
+class FlakyRules:
+    '''Fails the first `failures` times, and then returns the rules'''
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, subreddit):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError("503 Service Unavailable")
+        return f"Rules for {subreddit}"
+
+
+def test_failed_fetches_are_retried_after_retry_seconds(tmp_path):
+    fetch = FlakyRules(failures=1)
+    cache = RulesCache(str(tmp_path / 'subreddit_rules.csv'), fetch, retry_seconds=0.2)
+    assert cache.get('aww') == ''
+    # Not retried right away
+    assert cache.get('aww') == ''
+    assert fetch.calls == 1
+    time.sleep(0.25)
+    assert cache.get('aww') == 'Rules for aww'
+    assert 'aww' not in cache.failed
+
+
+def test_entry_changes_when_the_rules_are_fetched_again(tmp_path):
+    cache = RulesCache(str(tmp_path / 'subreddit_rules.csv'), FlakyRules(failures=0), ttl_seconds=0.1)
+    rules, fetched_utc = cache.entry('aww')
+    assert cache.entry('aww') == (rules, fetched_utc)
+    time.sleep(0.15)
+    assert cache.entry('aww')[1] > fetched_utc
@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'augment_data'))
+from score_cache import ScoreCache
+
+TESTS = ['TOXICITY', 'SEVERE_TOXICITY']
+
+
+def test_storing_a_score_again_does_not_grow_the_cache(tmp_path):
+    cache = ScoreCache(str(tmp_path / 'score_cache.sqlite'), max_entries=3)
+    for _ in range(3):
+        cache.put_many({'a': (0.1, 0.0), 'b': (0.2, 0.0)}, TESTS)
+    assert cache.size == 2
+    # Nothing was evicted early
+    assert cache.get_many(['a', 'b'], TESTS) == {'a': (0.1, 0.0), 'b': (0.2, 0.0)}
+
+
+def test_evicts_the_least_recently_used_scores(tmp_path):
+    cache = ScoreCache(str(tmp_path / 'score_cache.sqlite'), max_entries=10)
+    cache.put_many({str(i): (i / 10, 0.0) for i in range(10)}, TESTS)
+    assert cache.size == 10
+    cache.put('new', TESTS, (0.5, 0.0))
+    # Down to 90% of max_entries, without the oldest ones
+    assert cache.size == 9
+    assert cache.get('new', TESTS) == (0.5, 0.0)
@@ -0,0 +1,83 @@
+import time
+import threading
+import statistics
+import pytest
+from storage import open_storage
+from fake_reddit import FakeReddit
+from fake_openai import FakeAsyncOpenAI
+
+# How long a message can wait for a reply. The stream polls every stream_min_wait_seconds while messages are
+# arriving, and at most every `interval` seconds when they're not.
+MIN_WAIT = 0.05
+INTERVAL = 0.2
+MAX_LATENCY = 1.5
+
+
+@pytest.fixture
+def run(chatbot, monkeypatch):
+    '''
+    A Run against a fake reddit, with two consented participants waiting for the user's next message: alice, who
+    chats with us through DMs, and bob, who chats through modmail
+    '''
+    monkeypatch.setitem(chatbot.config, 'stream_min_wait_seconds', MIN_WAIT)
+    reddit = FakeReddit(chatbot.auth.username, rules={'aww': ['Be nice']})
+    bot = reddit.username
+    conversation = reddit.new_modmail_conversation('aww', 'bob')
+    conversation.add(bot, 'Hello, I am a bot', time.time() - 30)
+    conversation.add('bob', 'yes', time.time() - 20)
+    conversation.add(bot, 'Thank you for agreeing to chat', time.time() - 10)
+
+    storage = open_storage(chatbot.config, chatbot.script_dir)
+    for name, user_id, strategy in [('alice', 'a1', 'dm'), ('bob', 'b1', 'modmail')]:
+        storage.add_participant([name, user_id, 'casual', 'aww', 'you suck', strategy, 'gpt-3.5-turbo', 'general', 'toxic_content'])
+    Message = chatbot.Message
+    storage.conversations().append([
+        Message('a1', 'initial', 'Hello, I am a bot', time.time() - 30, 'aww', None, False, 'casual'),
+        Message('a1', 'user', 'yes', time.time() - 20, 'aww', 'fake_dm', False, 'casual'),
+        Message('a1', 'first_consented_message', 'Thank you for agreeing to chat', time.time() - 10, 'aww', None, False, 'casual'),
+        Message('b1', 'initial', 'Hello, I am a bot', time.time() - 30, 'aww', conversation.id, True, 'casual'),
+        Message('b1', 'user', 'yes', time.time() - 20, 'aww', conversation.id, True, 'casual'),
+        Message('b1', 'first_consented_message', 'Thank you for agreeing to chat', time.time() - 10, 'aww', conversation.id, True, 'casual'),
+    ])
+
+    monkeypatch.setattr(chatbot, 'connect', lambda scheduler, **kwargs: reddit)
+    curr_run = chatbot.Run()
+    curr_run.completions.client_factory = lambda: FakeAsyncOpenAI(delay=0.05)
+    # Otherwise the first reply would also wait for openai to be imported
+    import openai
+    return curr_run
+
+
+def test_stream_replies_to_each_message_as_it_arrives(chatbot, run):
+    reddit = run.reddit
+    conversation_id = next(iter(reddit.modmail_conversations))
+    deliveries = [lambda: reddit.deliver_dm('alice', 'I was just having a bad day'),
+                  lambda: reddit.deliver_modmail(conversation_id, 'They started it'),
+                  lambda: reddit.deliver_dm('alice', 'Maybe I could have been nicer'),
+                  lambda: reddit.deliver_modmail(conversation_id, 'Fine, I see your point')]
+    stop = threading.Event()
+
+    def users_write():
+        # Each user waits for our reply before they write again; the pause lets the stream back off to INTERVAL
+        for i, deliver in enumerate(deliveries):
+            stop.wait(0.3)
+            deliver()
+            deadline = time.monotonic() + 5
+            while len(reddit.replies()) <= i and time.monotonic() < deadline:
+                time.sleep(0.01)
+        stop.set()
+
+    users = threading.Thread(target=users_write)
+    users.start()
+    chatbot.stream_replies(run, stop, INTERVAL, chatbot.ConfigWatcher(run))
+    users.join()
+
+    replies = reddit.replies()
+    assert [(user, kind) for user, kind, _, _ in replies] == [('alice', 'dm_reply'), ('bob', 'modmail_reply')] * 2
+    assert all(text.startswith('You said: ') for _, _, text, _ in replies)
+    latencies = [latency for _, _, _, latency in replies]
+    print(f"\nMessage-to-reply latency over {len(latencies)} messages: median {statistics.median(latencies):.3f}s, "
+          f"max {max(latencies):.3f}s")
+    assert max(latencies) < MAX_LATENCY
+    # The replies were stored, so nobody is left waiting
+    assert list(run.conversation_states.awaiting_reply()) == []
@@ -0,0 +1,32 @@
+import time
+import asyncio
+import pandas as pd
+from conversation_store import COLUMNS
+from fake_reddit import FakeReddit
+from fake_openai import FakeAsyncOpenAI
+
+
+def make_run(chatbot, monkeypatch):
+    monkeypatch.setattr(chatbot, 'connect', lambda scheduler, **kwargs: FakeReddit(chatbot.auth.username))
+    monkeypatch.setitem(chatbot.config, 'summary_compaction',
+                        dict(chatbot.config['summary_compaction'], enabled=True, threshold_tokens=200, recent_tokens=100))
+    run = chatbot.Run()
+    run.completions.client_factory = lambda: FakeAsyncOpenAI(delay=0, reply=lambda model, messages: 'A summary')
+    return run
+
+
+def test_long_system_prompt_does_not_summarize_the_latest_message(chatbot, monkeypatch):
+    run = make_run(chatbot, monkeypatch)
+    # Like the norms prompt with a long list of subreddit rules: longer than recent_tokens on its own
+    bot_instructions = ' '.join(['Be kind to each other and stay on topic.'] * 150)
+    rows = [['a1', 'user' if i % 2 else 'AI_reply', f"message {i} " + 'word ' * 30, time.time() + i, 'aww', 'c1', False, 'casual']
+            for i in range(30)]
+    conversation = chatbot.Conversation(pd.DataFrame(rows, columns=COLUMNS), clean_modmail=False)
+
+    summary, n_summarized = asyncio.run(run.update_summary(conversation, bot_instructions, 'gpt-3.5-turbo'))
+    assert summary == 'A summary'
+    assert 0 < n_summarized < len(conversation.messages)
+    messages, reply = run.build_ai_request(conversation, bot_instructions, 'gpt-3.5-turbo',
+                                           summary=summary, summary_start=n_summarized)
+    assert reply is None
+    assert messages[-1]['content'] == conversation.messages[-1].text
@@ -0,0 +1,121 @@
+import os
+import re
+import random
+import logging
+from collections import Counter
+
+######
+# A cheap first stage in front of the toxicity scorer for get_toxic_moderated_comments.py. Removed comments that
+# are empty (or deleted), very short, or don't match any of the toxic words and patterns are rejected without
+# being scored; only the rest are sent to Perspective. Texts that were scored before don't cost anything, since
+# they come from the score cache.
+#
+# The settings are in the toxicity_prefilter section of the config, and any of them can be overridden for a
+# subreddit (under subreddits: <name>:).
+#
+# To check that the prefilter isn't dropping comments we would have contacted, a random sample (audit_rate) of the
+# rejected ones is scored anyway. Its recall is the share of the candidates (comments that pass the toxicity
+# thresholds) that it lets through, estimated from the passed candidates and the audited sample.
+######
+
+DELETED = ['[deleted]', '[removed]']
+
+
+class ToxicityPrefilter:
+
+    def __init__(self, settings, base_dir='.'):
+        '''settings is the toxicity_prefilter section of the config. Paths are relative to base_dir.'''
+        settings = dict(settings or {})
+        self.overrides = settings.pop('subreddits', None) or {}
+        self.defaults = settings
+        self.base_dir = base_dir
+        self.compiled = dict()
+        self.rejected = Counter()
+        self.passed = 0
+        self.audited = 0
+        # Candidates among the texts that passed, and among the rejected texts that we audited
+        self.passed_candidates = 0
+        self.audited_candidates = 0
+        # How many candidates were rejected, estimated from the audit sample
+        self.missed_candidates = 0
+
+    def settings(self, subreddit):
+        return {**self.defaults, **self.overrides.get(subreddit, {})}
+
+    def enabled(self, subreddit):
+        return self.settings(subreddit).get('enabled', False)
+
+    def pattern(self, subreddit):
+        '''The toxic words (from the lexicon file) and patterns for the subreddit, compiled into one regex'''
+        if subreddit not in self.compiled:
+            settings = self.settings(subreddit)
+            patterns = list(settings.get('patterns') or [])
+            if settings.get('lexicon_file'):
+                try:
+                    with open(os.path.join(self.base_dir, settings['lexicon_file']), 'r') as f:
+                        words = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+                    patterns.append(r'\b(?:' + '|'.join(re.escape(word) for word in words) + r')')
+                except FileNotFoundError:
+                    logging.warning(f"Didn't find the lexicon file {settings['lexicon_file']}")
+            self.compiled[subreddit] = re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE) if patterns else None
+        return self.compiled[subreddit]
+
+    def check(self, subreddit, text):
+        '''Returns why the text is rejected ('empty', 'too_short' or 'no_match'), or None if it should be scored'''
+        if not self.enabled(subreddit):
+            return None
+        if not isinstance(text, str) or text.strip() == '' or text.strip() in DELETED:
+            return 'empty'
+        if len(text.strip()) < self.settings(subreddit).get('min_length', 0):
+            return 'too_short'
+        pattern = self.pattern(subreddit)
+        if pattern is not None and pattern.search(text) is None:
+            return 'no_match'
+        return None
+
+    def select(self, subreddit, items, text=lambda item: item):
+        '''
+        Yields (item, passed) for the items that should be scored: the ones that pass the prefilter, plus a
+        sample of the rejected ones (passed=False) to audit its recall. Empty texts are never audited.
+        '''
+        audit_rate = self.settings(subreddit).get('audit_rate', 0)
+        for item in items:
+            reason = self.check(subreddit, text(item))
+            if reason is None:
+                self.passed += 1
+                yield item, True
+            elif reason != 'empty' and random.random() < audit_rate:
+                self.audited += 1
+                yield item, False
+            else:
+                self.rejected[reason] += 1
+
+    def record(self, subreddit, passed, is_candidate):
+        '''Records whether an item from select() turned out to be a candidate'''
+        if not is_candidate:
+            return
+        if passed:
+            self.passed_candidates += 1
+        else:
+            self.audited_candidates += 1
+            # Each audited candidate stands for 1/audit_rate rejected candidates
+            self.missed_candidates += 1 / self.settings(subreddit)['audit_rate']
+
+    def recall(self):
+        '''The estimated share of the candidates that pass the prefilter, or None if there's nothing to go on'''
+        if self.audited == 0:
+            return None
+        total = self.passed_candidates + self.missed_candidates
+        return self.passed_candidates / total if total > 0 else None
+
+    def report(self):
+        n_rejected = sum(self.rejected.values())
+        lines = [f"Prefilter: {self.passed} passed, {n_rejected} rejected ({dict(self.rejected)}), "
+                 f"{self.audited} rejected texts audited"]
+        if n_rejected + self.audited > 0:
+            lines.append(f"Saved {n_rejected} of {self.passed + n_rejected + self.audited} scoring calls")
+        recall = self.recall()
+        if recall is not None:
+            lines.append(f"Candidates: {self.passed_candidates} passed, {self.audited_candidates} in the audit sample; "
+                         f"estimated recall {recall:.1%}")
+        return '\n'.join(lines)